@@ -0,0 +1,156 @@
+"""Merkle tree builder for the ``cvrDropRoot`` / ``claimDrop`` airdrops.
+
+Leaves are ``blake2b(PACK(Pair index (Pair address amount)))`` and an inner
+node is ``blake2b(left + right)``, the last node of an odd level being paired
+with itself, exactly as checked by ``CVR.claimDrop``. Every level is written
+to its own file of 32-byte hashes, so building the tree and producing the
+proofs only keeps one chunk of hashes in memory, whatever the number of leaves.
+
+Usage::
+
+    python airdrop.py holders.csv outdir > proofs.jsonl
+
+where ``holders.csv`` has one ``address,amount`` line per recipient. The root
+and the total to reserve with ``cvrDropRoot`` are printed on stderr. A tree
+rebuilt in the same directory replaces the former one, whatever their sizes.
+"""
+
+import csv
+import json
+import mmap
+import os
+import sys
+
+from micheline import blake2b, encode_address, forge_int
+
+
+HASH_SIZE = 32
+CHUNK = 1 << 16
+
+
+def leaf_hash(index, address, amount):
+    packed = (b"\x05\x07\x07\x00" + forge_int(index) + b"\x07\x07\x0a\x00\x00\x00\x16"
+              + encode_address(address) + b"\x00" + forge_int(amount))
+    return blake2b(packed)
+
+
+def node_hash(left, right):
+    return blake2b(left + right)
+
+
+def verify(root, index, address, amount, proof):
+    node = leaf_hash(index, address, amount)
+    for sibling in proof:
+        node = node_hash(node, sibling) if index % 2 == 0 else node_hash(sibling, node)
+        index //= 2
+    return node == root
+
+
+class MerkleTree:
+    def __init__(self, directory):
+        self.directory = directory
+        self.levels = []
+        # the root is the first level with a single hash
+        while not self.levels or len(self.levels[-1]) > HASH_SIZE:
+            if not os.path.exists(self._path(len(self.levels))):
+                raise FileNotFoundError("no complete Merkle tree in %s" % directory)
+            self.levels.append(self._open(len(self.levels)))
+
+    @classmethod
+    def build(cls, leaves, directory):
+        """Write the tree of ``(address, amount)`` leaves to ``directory``."""
+        os.makedirs(directory, exist_ok=True)
+        level = 0
+        count = 0
+        total = 0
+        with open(cls._level_path(directory, 0), "wb") as out:
+            buffer = []
+            for address, amount in leaves:
+                buffer.append(leaf_hash(count, address, amount))
+                count += 1
+                total += amount
+                if len(buffer) == CHUNK:
+                    out.write(b"".join(buffer))
+                    buffer = []
+            out.write(b"".join(buffer))
+        if not count:
+            raise ValueError("no leaves")
+        while count > 1:
+            count = cls._build_level(directory, level)
+            level += 1
+        # levels left by a larger tree built in the same directory
+        level += 1
+        while os.path.exists(cls._level_path(directory, level)):
+            os.remove(cls._level_path(directory, level))
+            level += 1
+        tree = cls(directory)
+        tree.total = total
+        return tree
+
+    @classmethod
+    def _build_level(cls, directory, level):
+        with open(cls._level_path(directory, level), "rb") as src, \
+                open(cls._level_path(directory, level + 1), "wb") as out:
+            count = 0
+            while True:
+                data = src.read(2 * HASH_SIZE * CHUNK)
+                if not data:
+                    break
+                nodes = []
+                for offset in range(0, len(data), 2 * HASH_SIZE):
+                    left = data[offset:offset + HASH_SIZE]
+                    right = data[offset + HASH_SIZE:offset + 2 * HASH_SIZE] or left
+                    nodes.append(node_hash(left, right))
+                count += len(nodes)
+                out.write(b"".join(nodes))
+        return count
+
+    @staticmethod
+    def _level_path(directory, level):
+        return os.path.join(directory, "level%02d.bin" % level)
+
+    def _path(self, level):
+        return self._level_path(self.directory, level)
+
+    def _open(self, level):
+        with open(self._path(level), "rb") as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return len(self.levels[0]) // HASH_SIZE
+
+    @property
+    def root(self):
+        return self.levels[-1][:HASH_SIZE]
+
+    def proof(self, index):
+        proof = []
+        for level in self.levels[:-1]:
+            sibling = index ^ 1
+            if sibling * HASH_SIZE >= len(level):
+                sibling = index
+            proof.append(level[sibling * HASH_SIZE:(sibling + 1) * HASH_SIZE])
+            index //= 2
+        return proof
+
+    def claims(self, leaves):
+        """Yield the ``claimDrop`` parameters for the same ``leaves`` used to build the tree."""
+        for index, (address, amount) in enumerate(leaves):
+            yield {"index": index, "address": address, "amount": amount, "proof": [p.hex() for p in self.proof(index)]}
+
+
+def read_leaves(path):
+    with open(path, newline="") as f:
+        for row in csv.reader(f):
+            if row:
+                yield row[0].strip(), int(row[1])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit(__doc__)
+    source, directory = sys.argv[1:]
+    tree = MerkleTree.build(read_leaves(source), directory)
+    for claim in tree.claims(read_leaves(source)):
+        sys.stdout.write(json.dumps(claim) + "\n")
+    sys.stderr.write("root: %s\nleaves: %d\ntotal: %d\n" % (tree.root.hex(), len(tree), tree.total))
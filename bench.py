@@ -0,0 +1,389 @@
+"""Gas and storage benchmarks of the compiled CVR contract.
+
+The contract is originated in an ``octez-client`` mockup, its ``accounts``
+big_map is seeded with ``mintBatch`` (or ``cvrDrop``) up to each ledger size, and every case
+below is run at each size (and each list size for the entry points taking a
+list). Consumed gas, paid storage, storage size and parameter size are written
+as JSON and compared with a stored baseline, together with the origination
+(gas, storage, size of the code, which every call loads, and size of the lazy
+entry points kept in the storage, which only their own calls load)::
+
+    python bench.py --contract compiled/cvr.tz --storage compiled/storage.tz \\
+        --accounts 1000,10000,100000 --lists 1,10,100 \\
+        --output bench.json --baseline bench_baseline.json
+
+The run fails (exit code 1) if a case uses more gas than the baseline plus the
+tolerance, or more storage or parameter bytes. It does not start without a
+baseline, unless ``--update-baseline`` is given to write the results as the new
+baseline. ``--find-limits`` also searches, with dry runs,
+the largest list each list entry point accepts within the operation limits.
+
+The script and its initial storage are those SmartPy compiles from ``cvr.py``;
+no compiled script is committed.
+
+``--compare-layouts N`` needs no client: it runs an airdrop to ``N`` accounts,
+most of which then sell everything to a few exchanges, through the ledger
+model, and prints the big_map storage of the balances in the former layout
+(a ``Pair balance lock`` kept for every address ever credited) and of every
+per-account big_map in the current one: the accounts (balance, holder number,
+royalties and last checkpoint in one record, kept while one of them is
+needed), the holders by number, the locks and the checkpoints.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+
+from ledger import ROYALTY_SCALE, Ledger
+from micheline import (IMPLICIT_PREFIXES, b58check_encode, blake2b, encode, encode_address, entrypoints, expand,
+                       field_paths, forge, parse, script_section, to_michelson)
+
+
+SEED_CHUNK = 400
+# Bytes paid for each big_map entry on top of its key and value
+BIG_MAP_ENTRY_OVERHEAD = 65
+ROLES = {"owner": "bootstrap1", "administrator": "bootstrap2", "saleManager": "bootstrap3",
+         "octopus": "bootstrap4", "covir": "bootstrap5"}
+
+
+def synthetic_address(i):
+    return b58check_encode(IMPLICIT_PREFIXES["tz1"][0], blake2b(b"cvr-bench-%d" % i)[:20])
+
+
+def transfers(fromAddr, addresses, amount=1):
+    """FA2 ``transfer`` parameter of ``amount`` from ``fromAddr`` to each of ``addresses``."""
+    return [{"from_": fromAddr, "txs": [{"to_": a, "token_id": 0, "amount": amount} for a in addresses]}]
+
+
+def sales(addresses, amount=10**6):
+    """``offchainSaleBatch`` parameter selling ``amount`` to each of ``addresses``."""
+    return {"sales": [{"address": a, "amount": amount} for a in addresses], "skipLocked": False, "callback": None}
+
+
+class CallFailed(Exception):
+    pass
+
+
+class Mockup:
+    def __init__(self, client="octez-client", protocol=None):
+        self.client = client
+        self.base_dir = tempfile.mkdtemp(prefix="cvr-mockup-")
+        args = ["create", "mockup"] + (["--protocol", protocol] if protocol else [])
+        self.run(*args)
+        self.addresses = {alias: self.address(alias) for alias in ROLES.values()}
+
+    def run(self, *args):
+        command = [self.client, "--base-dir", self.base_dir, "--mode", "mockup"] + list(args)
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode:
+            raise CallFailed(result.stderr.strip() or result.stdout.strip())
+        return result.stdout
+
+    def address(self, alias):
+        return re.search(r"Hash: (\w+)", self.run("show", "address", alias)).group(1)
+
+    def originate(self, script_path, storage):
+        return receipt(self.run("originate", "contract", "cvr", "transferring", "0", "from", ROLES["owner"],
+                                "running", script_path, "--init", storage, "--burn-cap", "100", "--force"))
+
+    def call(self, source, entrypoint, arg, amount=0, dry_run=False):
+        return receipt(self.run("transfer", "%.6f" % (amount / 10**6), "from", source, "to", "cvr",
+                                "--entrypoint", entrypoint, "--arg", arg, "--burn-cap", "100",
+                                *(["--dry-run"] if dry_run else [])))
+
+
+def receipt(output):
+    """Gas and storage figures of an ``octez-client`` operation receipt."""
+    return {
+        "gas": sum(float(g) for g in re.findall(r"Consumed gas: ([\d.]+)", output)),
+        "storageSize": int((re.findall(r"Storage size: (\d+) bytes", output) or [0])[0]),
+        "paidStorage": sum(int(s) for s in re.findall(r"Paid storage size diff: (\d+) bytes", output)),
+    }
+
+
+class Bench:
+    def __init__(self, mockup, script_path, storage_path=None):
+        self.mockup = mockup
+        self.script_path = script_path
+        with open(script_path) as f:
+            script = parse(f.read())
+        self.code_bytes = len(forge(expand(script_section(script, "code"))))
+        self.storage_type = script_section(script, "storage")
+        self.entrypoints = entrypoints(script_section(script, "parameter"))
+        self.storage_path = storage_path
+        self.seeded = 0
+        self.fresh = 10**9
+        self.addr = {role: mockup.addresses[alias] for role, alias in ROLES.items()}
+
+    def originate(self):
+        if self.storage_path:
+            with open(self.storage_path) as f:
+                storage = parse(f.read())
+        else:
+            storage = encode(self.storage_type, self.default_storage())
+        for field, value in (("transferStatus", {"prim": "True"}), ("saleStatus", {"prim": "True"})):
+            self.set_field(storage, field, value)
+        for role, address in self.addr.items():
+            self.set_field(storage, role, {"string": address})
+        result = self.mockup.originate(self.script_path, to_michelson(storage))
+        result.update(entrypoint="origination", accounts=0, listSize=None, parameterBytes=0, codeBytes=self.code_bytes,
+                      lazyBytes=lambda_bytes(self.storage_type, storage))
+        return result
+
+    def default_storage(self):
+        defaults = {"int": 0, "nat": 0, "mutez": 0, "bool": False, "string": "", "bytes": b"",
+                    "map": {}, "big_map": {}, "list": [], "set": [], "option": None}
+        values = {name: defaults.get(t["prim"]) for name, (_, t) in field_paths(self.storage_type).items()}
+        values.update(saleLimit=200000000 * 10**6, supplyLimit=400000000 * 10**6)
+        return values
+
+    def set_field(self, storage, name, value):
+        path = field_paths(self.storage_type).get(name, (None,))[0]
+        if path is None:
+            return
+        node = storage
+        for step in path[:-1]:
+            node = node["args"][step]
+        node["args"][path[-1]] = value
+
+    def fresh_addresses(self, count):
+        self.fresh += count
+        return [synthetic_address(i) for i in range(self.fresh - count, self.fresh)]
+
+    def seed(self, accounts):
+        while self.seeded < accounts:
+            count = min(SEED_CHUNK, accounts - self.seeded)
+            addresses = [synthetic_address(i) for i in range(self.seeded, self.seeded + count)]
+            if "mintBatch" in self.entrypoints:
+                self.call("administrator", "mintBatch", [{"toAddr": a, "amount": 10**9} for a in addresses])
+            else:
+                self.call("administrator", "cvrDrop", {"addresses": addresses, "amount": 10**9})
+            self.seeded += count
+
+    def call(self, role, entrypoint, value, amount=0, dry_run=False):
+        node = encode(self.entrypoints[entrypoint], value)
+        result = self.mockup.call(ROLES[role], entrypoint, to_michelson(node), amount, dry_run)
+        result["parameterBytes"] = len(forge(node))
+        return result
+
+    def cases(self, size):
+        """``(entrypoint, role, value, amount)`` of each case for a list size (None for single calls)."""
+        holders = [synthetic_address(i) for i in range(min(size or 1, self.seeded))]
+        if size is None:
+            yield "transfer", "administrator", transfers(holders[0], [synthetic_address(1)]), 0
+            yield "transfer", "administrator", transfers(holders[0], self.fresh_addresses(1)), 0
+            yield "sale", "octopus", None, 10**6
+            yield "offchainSale", "saleManager", {"address": self.fresh_addresses(1)[0], "amount": 10**6}, 0
+            yield "mint", "administrator", {"toAddr": self.fresh_addresses(1)[0], "amount": 10**6}, 0
+            yield "burn", "administrator", {"fromAddr": self.addr["administrator"], "amount": 1}, 0
+            yield "claimSale", "administrator", {"amount": 10**4}, 0
+            return
+        yield "cvrDrop", "administrator", {"addresses": self.fresh_addresses(size), "amount": 10**6}, 0
+        yield "mintBatch", "administrator", [{"toAddr": a, "amount": 10**6} for a in self.fresh_addresses(size)], 0
+        yield "transfer", "administrator", transfers(holders[0], self.fresh_addresses(size)), 0
+        yield "offchainSaleBatch", "saleManager", sales(self.fresh_addresses(size)), 0
+        yield "dispatchRoyalties", "administrator", {"addresses": holders, "amount": 10**6, "snapshotId": None}, 10**6
+        yield "lockAddresses", "administrator", {"addresses": holders, "until": None}, 0
+        yield "unlockAddresses", "administrator", holders, 0
+
+    def run(self, accounts, lists):
+        results = []
+        for size in [None] + lists:
+            for entrypoint, role, value, amount in self.cases(size):
+                if entrypoint not in self.entrypoints:
+                    continue
+                if entrypoint == "burn":
+                    self.call("administrator", "mint", {"toAddr": self.addr["administrator"], "amount": 10**6})
+                result = self.call(role, entrypoint, value, amount)
+                result.update(entrypoint=entrypoint, accounts=accounts, listSize=size)
+                results.append(result)
+        return results
+
+    def largest_list(self, entrypoint, role, make_value, amount=0, start=16):
+        """Largest list size accepted by a dry run of ``entrypoint``."""
+        def fits(size):
+            try:
+                self.call(role, entrypoint, make_value(size), amount, dry_run=True)
+                return True
+            except CallFailed:
+                return False
+        low, high = 0, start
+        while fits(high):
+            low, high = high, high * 2
+        while high - low > 1:
+            middle = (low + high) // 2
+            low, high = (middle, high) if fits(middle) else (low, middle)
+        return low
+
+    def limits(self):
+        cases = {
+            "cvrDrop": ("administrator", lambda n: {"addresses": [synthetic_address(10**8 + i) for i in range(n)], "amount": 1}, 0),
+            "mintBatch": ("administrator", lambda n: [{"toAddr": synthetic_address(10**8 + i), "amount": 1} for i in range(n)], 0),
+            "transfer": ("administrator", lambda n: transfers(synthetic_address(0), [synthetic_address(10**8 + i) for i in range(n)]), 0),
+            "offchainSaleBatch": ("saleManager", lambda n: sales([synthetic_address(10**8 + i) for i in range(n)], 1), 0),
+            "dispatchRoyalties": ("administrator", lambda n: {"addresses": [synthetic_address(i % max(self.seeded, 1)) for i in range(n)], "amount": 10**6, "snapshotId": None}, 10**6),
+            "lockAddresses": ("administrator", lambda n: {"addresses": [synthetic_address(i % max(self.seeded, 1)) for i in range(n)], "until": None}, 0),
+        }
+        return {entrypoint: self.largest_list(entrypoint, role, make_value, amount)
+                for entrypoint, (role, make_value, amount) in cases.items() if entrypoint in self.entrypoints}
+
+
+def lambda_bytes(type_, value):
+    """Forged size of the lambdas kept in the ``map`` and ``big_map`` values of a storage.
+
+    The lazy entry points are stored as such lambdas: their code is only
+    loaded by the calls that run them, unlike the code of the script.
+    """
+    if type_["prim"] in ("map", "big_map"):
+        if type_["args"][1]["prim"] != "lambda" or not isinstance(value, list):
+            return 0
+        return sum(len(forge(elt["args"][1])) for elt in value)
+    if type_["prim"] == "pair" and value.get("prim") == "Pair":
+        return sum(lambda_bytes(t, v) for t, v in zip(type_["args"], value["args"]))
+    return 0
+
+
+def entry_size(key, value):
+    return BIG_MAP_ENTRY_OVERHEAD + len(forge(key)) + len(forge(value))
+
+
+def compare_layouts(accounts, drained=0.7, locked=0.01, exchanges=10, seed=0):
+    """Storage in bytes of the per-account big_maps for a simulated distribution.
+
+    Returns the size of the former balances and ``{big_map: size}`` for the
+    current layout, where an address can have an account, a holder number, a
+    lock and checkpoints.
+    """
+    rng = random.Random(seed)
+    roles = [synthetic_address(-i) for i in range(1, 6)]
+    ledger = Ledger(*roles)
+    ledger.supplyLimit, ledger.saleLimit = 10**18, 0
+    holders = [synthetic_address(i) for i in range(accounts)]
+    sinks = [synthetic_address(accounts + i) for i in range(exchanges)]
+    ledger.call("mintBatch", [{"toAddr": a, "amount": int(10**6 * rng.paretovariate(1.2))} for a in holders],
+                ledger.administrator)
+    ledger.call("resumeTransfer", None, ledger.administrator)
+    for address in holders:
+        if rng.random() < drained:
+            ledger.call("transfer", transfers(address, [rng.choice(sinks)], ledger.getBalance(address)), address)
+        elif rng.random() < locked:
+            ledger.call("lockAddress", {"address": address, "until": None}, ledger.administrator)
+    for role in roles[1:3]:
+        ledger.call("setManager", role, ledger.administrator)
+
+    def key(address):
+        return {"bytes": encode_address(address).hex()}
+    former = set(ledger.accounts) | set(roles[1:3])
+    before = sum(entry_size(key(a), {"prim": "Pair", "args": [{"int": str(ledger.getBalance(a))},
+                                                               {"prim": "True" if a in ledger.locks else "False"}]})
+                 for a in former)
+    rpt = ledger.royaltyPerToken
+
+    def nat(value):
+        return {"int": str(value)}
+    after = {"accounts": 0, "holders": 0, "locks": 0, "checkpoints": 0}
+    for a, account in ledger.accounts.items():
+        owed = account.owed + account.balance * (rpt - account.paid) // ROYALTY_SCALE
+        if account.balance or owed or account.checkpoint:
+            after["accounts"] += entry_size(key(a), {"prim": "Pair", "args": [
+                {"prim": "Pair", "args": [nat(account.balance), nat(account.position)]},
+                {"prim": "Pair", "args": [nat(owed), {"prim": "Pair", "args": [nat(rpt), nat(account.checkpoint)]}]}]})
+        if account.balance:
+            after["holders"] += entry_size(nat(account.position), key(a))
+    for (a, snapshotId), (balance, previous) in ledger.checkpoints.items():
+        after["checkpoints"] += entry_size({"prim": "Pair", "args": [key(a), nat(snapshotId)]},
+                                           {"prim": "Pair", "args": [nat(balance), nat(previous)]})
+    after["locks"] = sum(entry_size(key(a), {"prim": "None"}) for a in ledger.locks)
+    return before, after
+
+
+def key(result):
+    return result["entrypoint"], result["accounts"], result["listSize"]
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of ``results`` against ``baseline`` results."""
+    reference = {key(r): r for r in baseline}
+    regressions = []
+    for result in results:
+        base = reference.get(key(result))
+        if base is None:
+            continue
+        if result["gas"] > base["gas"] * (1 + tolerance):
+            regressions.append("%s: gas %.3f > %.3f" % (key(result), result["gas"], base["gas"]))
+        for field in ("paidStorage", "parameterBytes", "codeBytes"):
+            if result.get(field, 0) > base.get(field, 0):
+                regressions.append("%s: %s %d > %d" % (key(result), field, result[field], base[field]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contract", help="script compiled from cvr.py by SmartPy")
+    parser.add_argument("--storage", help="initial storage as compiled by SmartPy (required for lazy entry points)")
+    parser.add_argument("--client", default="octez-client")
+    parser.add_argument("--protocol")
+    parser.add_argument("--accounts", default="1000,10000,100000,1000000")
+    parser.add_argument("--lists", default="1,10,100")
+    parser.add_argument("--output", default="bench.json")
+    parser.add_argument("--baseline", default="bench_baseline.json")
+    parser.add_argument("--tolerance", type=float, default=0.02)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--find-limits", action="store_true")
+    parser.add_argument("--compare-layouts", type=int, metavar="ACCOUNTS")
+    args = parser.parse_args(argv)
+
+    if args.compare_layouts:
+        before, after = compare_layouts(args.compare_layouts)
+        total = sum(after.values())
+        print("per-account storage for %d accounts: %d bytes before, %d bytes now (%.1f%%)" % (
+            args.compare_layouts, before, total, 100.0 * total / before))
+        for name, size in after.items():
+            print("    %-16s %12d" % (name, size))
+        return 0
+    if not args.contract:
+        parser.error("--contract is required (the script SmartPy compiles from cvr.py)")
+    if not args.update_baseline and not os.path.exists(args.baseline):
+        parser.error("no baseline %s, run with --update-baseline to create it" % args.baseline)
+
+    bench = Bench(Mockup(args.client, args.protocol), args.contract, args.storage)
+    results = [bench.originate()]
+    limits = {}
+    for accounts in (int(a) for a in args.accounts.split(",")):
+        bench.seed(accounts)
+        results.extend(bench.run(accounts, [int(n) for n in args.lists.split(",")]))
+        if args.find_limits:
+            limits[accounts] = bench.limits()
+    with open(args.contract, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    report = {"contract": digest, "results": results, "limits": limits}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+    print("origination: gas=%.3f storage=%d paid=%d code=%d lazy=%d" % (
+        results[0]["gas"], results[0]["storageSize"], results[0]["paidStorage"], results[0]["codeBytes"], results[0]["lazyBytes"]))
+    for r in results[1:]:
+        per_item = " (%.3f per item)" % (r["gas"] / r["listSize"]) if r["listSize"] else ""
+        print("%-18s accounts=%-8d list=%-5s gas=%.3f%s storage=%d paid=%d param=%d" % (
+            r["entrypoint"], r["accounts"], r["listSize"], r["gas"], per_item, r["storageSize"], r["paidStorage"], r["parameterBytes"]))
+    for accounts, found in limits.items():
+        print("largest lists at %d accounts: %s" % (accounts, found))
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=1)
+        return 0
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f)["results"], args.tolerance)
+    for regression in regressions:
+        print("REGRESSION " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
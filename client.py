@@ -0,0 +1,666 @@
+"""Asynchronous client for the administrator and sale manager calls of the CVR contract.
+
+Calls are typed on the entry points of the contract, as the node reports
+them (or as in ``--script``), and queued; ``flush`` packs
+them into operation groups that fit the gas and size limits (measured by a
+simulation of each group), and submits the groups one after the other. The
+protocol accepts one operation group per manager and per block, so while a
+group waits for its inclusion the next one is already simulated. The counter
+of the source is kept locally and only read again after a failure. The node
+(and a remote signer) are reached through a small pool of kept-alive HTTP
+connections, with ``asyncio`` and no third-party package::
+
+    python royalties.py --amount 1000000 --indexer snapshotdir \\
+        | python client.py KT1... --rpc http://localhost:8732 \\
+            --signer http://localhost:6732 --source tz1... --entrypoint dispatchRoyalties -
+    python client.py KT1... --rpc ... --signer ... --source tz1... calls.jsonl
+
+Each line of the input is a call ``{"entrypoint", "value", "amount"}``, or with
+``--entrypoint`` the value itself, whose ``mutez`` field (as printed by
+``royalties.py``) is the amount. ``MockNode``, a local stand-in of the node RPC,
+runs the client in the tests.
+"""
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import ssl
+import sys
+import urllib.parse
+
+from micheline import (SIGNATURE_PREFIX, b58check_decode, b58check_encode, blake2b, check_signature, decode_address,
+                       decode_signature, encode, encode_address, entrypoints, forge, key_address, parse, public_key,
+                       script_section, secret_key, sign)
+from ledger import ENTRYPOINT_TYPES
+from royalties import MAX_OPERATION_BYTES, MAX_OPERATION_GAS, SAFETY
+
+
+MAX_BLOCK_GAS = 2600000
+MAX_OPERATION_STORAGE = 60000
+MINIMAL_FEE = 100
+FEE_NANOTEZ_PER_GAS = 100
+FEE_MUTEZ_PER_BYTE = 1
+GAS_MARGIN = 100
+STORAGE_MARGIN = 100
+# a branch is valid for 120 blocks
+OPERATION_TTL = 120
+TRANSACTION_TAG = 108
+OPERATION_WATERMARK = b"\x03"
+BLOCK_PREFIX = b"\x01\x34"
+OPERATION_PREFIX = b"\x05\x74"
+ZERO_SIGNATURE = b58check_encode(SIGNATURE_PREFIX, bytes(64))
+MANAGER_PASS = 3
+
+
+class RpcError(Exception):
+    pass
+
+
+class CallFailed(Exception):
+    """A call rejected by the simulation or failed on chain; ``errors`` are those of the node."""
+
+    def __init__(self, message, errors=()):
+        Exception.__init__(self, message)
+        self.errors = list(errors)
+
+
+# HTTP
+
+class Rpc:
+    """JSON over HTTP/1.1, on a pool of at most ``connections`` kept-alive connections."""
+
+    def __init__(self, url, connections=4):
+        parts = urllib.parse.urlsplit(url)
+        secure = parts.scheme == "https"
+        self.host = parts.hostname
+        self.port = parts.port or (443 if secure else 80)
+        self.ssl = ssl.create_default_context() if secure else None
+        self.prefix = parts.path.rstrip("/")
+        self.idle = []
+        self.slots = asyncio.Semaphore(connections)
+        self.opened = 0
+
+    async def _connect(self):
+        self.opened += 1
+        return await asyncio.open_connection(self.host, self.port, ssl=self.ssl)
+
+    async def get(self, path):
+        return await self.request("GET", path)
+
+    async def post(self, path, body):
+        return await self.request("POST", path, body)
+
+    async def request(self, method, path, body=None):
+        data = b"" if body is None else json.dumps(body).encode()
+        async with self.slots:
+            reused = bool(self.idle)
+            connection = self.idle.pop() if reused else await self._connect()
+            try:
+                status, payload, keep = await self._exchange(connection, method, path, data)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                connection[1].close()
+                if not reused or method != "GET":
+                    raise
+                # closed by the server while idle; only a GET is sent again, as
+                # another request (an injection) may have reached the node
+                connection = await self._connect()
+                status, payload, keep = await self._exchange(connection, method, path, data)
+            if keep:
+                self.idle.append(connection)
+            else:
+                connection[1].close()
+        if status >= 300:
+            raise RpcError("%s %s: %d %s" % (method, path, status, payload[:500].decode(errors="replace")))
+        return json.loads(payload) if payload else None
+
+    async def _exchange(self, connection, method, path, data):
+        reader, writer = connection
+        writer.write(("%s %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n"
+                      % (method, self.prefix + path, self.host, len(data))).encode() + data)
+        await writer.drain()
+        line = await reader.readline()
+        if not line:
+            raise ConnectionResetError("connection closed by the server")
+        status = int(line.split()[1])
+        headers = await read_headers(reader)
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            payload = await read_chunks(reader)
+        elif "content-length" in headers:
+            payload = await reader.readexactly(int(headers["content-length"]))
+        else:
+            return status, await reader.read(), False
+        return status, payload, headers.get("connection", "").lower() != "close"
+
+    def close(self):
+        for _, writer in self.idle:
+            writer.close()
+        self.idle = []
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = (await reader.readline()).decode()
+        if line in ("\r\n", "\n", ""):
+            return headers
+        name, _, value = line.partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def read_chunks(reader):
+    payload = b""
+    while True:
+        size = int((await reader.readline()).split(b";")[0], 16)
+        chunk = await reader.readexactly(size + 2)
+        if not size:
+            return payload
+        payload += chunk[:-2]
+
+
+# Signers
+
+class LocalSigner:
+    """Signs with an ``edsk`` key in the process: for tests, not for real keys."""
+
+    def __init__(self, secret):
+        self.secret = secret
+        self.public_key = public_key(secret)
+        self.address = key_address(self.public_key)
+
+    async def sign(self, data):
+        return sign(self.secret, data)
+
+    def close(self):
+        pass
+
+
+class RemoteSigner:
+    """Key of ``address`` held by a signer speaking the ``octez-signer`` HTTP protocol."""
+
+    def __init__(self, url, address):
+        self.rpc = Rpc(url, connections=1)
+        self.address = address
+
+    async def sign(self, data):
+        return (await self.rpc.post("/keys/" + self.address, data.hex()))["signature"]
+
+    def close(self):
+        self.rpc.close()
+
+
+# Operations
+
+def forge_nat(value):
+    """Zarith encoding of a natural number in an operation."""
+    out = bytearray()
+    while True:
+        out.append(value & 0x7F)
+        value >>= 7
+        if not value:
+            return bytes(out)
+        out[-1] |= 0x80
+
+
+def forge_transaction(content):
+    entrypoint = content["parameters"]["entrypoint"]
+    value = forge(content["parameters"]["value"])
+    name = entrypoint.encode()
+    return (bytes((TRANSACTION_TAG,)) + encode_address(content["source"])[1:]
+            + b"".join(forge_nat(int(content[key])) for key in ("fee", "counter", "gas_limit", "storage_limit", "amount"))
+            + encode_address(content["destination"])
+            + b"\xff" + (b"\x00" if entrypoint == "default" else b"\xff" + bytes((len(name),)) + name)
+            + len(value).to_bytes(4, "big") + value)
+
+
+def forge_operation(branch, contents):
+    return b58check_decode(branch, BLOCK_PREFIX) + b"".join(forge_transaction(content) for content in contents)
+
+
+def operation_hash(data):
+    return b58check_encode(OPERATION_PREFIX, blake2b(data))
+
+
+def minimal_fee(gas, size):
+    return math.ceil(gas * FEE_NANOTEZ_PER_GAS / 1000) + size * FEE_MUTEZ_PER_BYTE
+
+
+def content_errors(content):
+    return content.get("metadata", {}).get("operation_result", {}).get("errors", [])
+
+
+def content_status(content):
+    return content.get("metadata", {}).get("operation_result", {}).get("status")
+
+
+class Call:
+    def __init__(self, entrypoint, value, amount):
+        self.entrypoint = entrypoint
+        self.value = value
+        self.amount = amount
+        self.future = asyncio.get_running_loop().create_future()
+        self.gas = None
+        self.storage = None
+
+    def content(self, source, destination, counter, fee=0, gas=0, storage=0):
+        return {"kind": "transaction", "source": source, "fee": str(fee), "counter": str(counter),
+                "gas_limit": str(gas), "storage_limit": str(storage), "amount": str(self.amount),
+                "destination": destination, "parameters": {"entrypoint": self.entrypoint, "value": self.value}}
+
+    def fail(self, error):
+        if not self.future.done():
+            self.future.set_exception(error)
+
+
+class Client:
+    """Calls of ``contract`` made by the key of ``signer`` through the node at ``rpc``."""
+
+    def __init__(self, rpc, signer, contract, script_path=None, max_gas=MAX_BLOCK_GAS, max_bytes=MAX_OPERATION_BYTES,
+                 safety=SAFETY, poll=1.0):
+        self.rpc = rpc
+        self.signer = signer
+        self.contract = contract
+        self.entrypoints = None
+        if script_path is not None:
+            with open(script_path) as f:
+                self.entrypoints = entrypoints(script_section(parse(f.read()), "parameter"))
+        self.max_gas = int(max_gas * safety)
+        self.max_bytes = int(max_bytes * safety)
+        self.poll = poll
+        self.queue = []
+        self.counter = None
+        self.checked = None
+        self.groups = 0
+        self.chain_id = None
+
+    async def load(self):
+        """Read the entry points of the contract from the node, unless a script was given."""
+        if self.entrypoints is None:
+            path = "/chains/main/blocks/head/context/contracts/%s/entrypoints" % self.contract
+            self.entrypoints = (await self.rpc.get(path))["entrypoints"]
+
+    def call(self, entrypoint, value=None, amount=0):
+        """Queue a call; the future gives ``{"hash", "level"}`` once its group is included."""
+        call = Call(entrypoint, encode(self.entrypoints[entrypoint], value), amount)
+        self.queue.append(call)
+        return call.future
+
+    async def flush(self):
+        """Submit the queued calls and wait until their groups are included or failed."""
+        calls, self.queue = self.queue, []
+        if self.chain_id is None:
+            self.chain_id = await self.rpc.get("/chains/main/chain_id")
+        work = collections.deque(self._split(calls))
+        inflight = None
+        while work:
+            ready, rest = await self._simulate(work.popleft())
+            work.extendleft(reversed(rest))
+            if not ready:
+                continue
+            if inflight is not None:
+                await inflight
+            inflight = asyncio.ensure_future(self._submit(ready))
+        if inflight is not None:
+            await inflight
+        await asyncio.gather(*(call.future for call in calls), return_exceptions=True)
+
+    def _split(self, calls):
+        """Groups of calls whose forged size fits ``max_bytes``."""
+        groups = [[]]
+        size = 32 + 64
+        for call in calls:
+            item = len(forge_transaction(call.content(self.signer.address, self.contract, 2**32, 10**7, MAX_OPERATION_GAS,
+                                                      MAX_OPERATION_STORAGE)))
+            if groups[-1] and size + item > self.max_bytes:
+                groups.append([])
+                size = 32 + 64
+            groups[-1].append(call)
+            size += item
+        return [group for group in groups if group]
+
+    async def _simulate(self, group):
+        """``(calls ready to submit, groups left to simulate)``.
+
+        A group that runs out of gas is split in two; calls that fail are
+        rejected and the others simulated again.
+        """
+        head = await self.rpc.get("/chains/main/blocks/head/header")
+        counter = int(await self.rpc.get("/chains/main/blocks/head/context/contracts/%s/counter" % self.signer.address))
+        gas = min(MAX_OPERATION_GAS, self.max_gas // len(group))
+        contents = [call.content(self.signer.address, self.contract, counter + i + 1, 0, gas, MAX_OPERATION_STORAGE)
+                    for i, call in enumerate(group)]
+        operation = {"branch": head["hash"], "contents": contents, "signature": ZERO_SIGNATURE}
+        try:
+            result = await self.rpc.post("/chains/main/blocks/head/helpers/scripts/simulate_operation",
+                                         {"operation": operation, "chain_id": self.chain_id})
+        except RpcError as error:
+            if len(group) > 1:
+                return [], [group[:len(group) // 2], group[len(group) // 2:]]
+            group[0].fail(CallFailed(str(error)))
+            return [], []
+        results = result["contents"]
+        exhausted = any("gas_exhausted" in error.get("id", "") for content in results for error in content_errors(content))
+        if exhausted and len(group) > 1:
+            return [], [group[:len(group) // 2], group[len(group) // 2:]]
+        failed = [call for call, content in zip(group, results) if content_status(content) == "failed"]
+        for call in failed:
+            call.fail(CallFailed("%s failed in simulation" % call.entrypoint,
+                                 content_errors(results[group.index(call)])))
+        if failed:
+            rest = [call for call in group if call not in failed]
+            return [], [rest] if rest else []
+        for call, content in zip(group, results):
+            operation_result = content["metadata"]["operation_result"]
+            call.gas = math.ceil(int(operation_result.get("consumed_milligas", 0)) / 1000) + GAS_MARGIN
+            call.storage = int(operation_result.get("paid_storage_size_diff", 0)) + STORAGE_MARGIN
+        if sum(call.gas for call in group) > self.max_gas and len(group) > 1:
+            return [], [group[:len(group) // 2], group[len(group) // 2:]]
+        return group, []
+
+    async def _submit(self, group):
+        try:
+            if self.counter is None:
+                self.counter = int(await self.rpc.get(
+                    "/chains/main/blocks/head/context/contracts/%s/counter" % self.signer.address))
+            head = await self.rpc.get("/chains/main/blocks/head/header")
+            if self.checked is None:
+                self.checked = head["level"]
+            contents = [call.content(self.signer.address, self.contract, self.counter + i + 1, 0, call.gas, call.storage)
+                        for i, call in enumerate(group)]
+            # every call pays for its gas and the first one for the bytes of the group, measured with
+            # fee fields larger than the fees can be
+            size = 32 + 64 + sum(len(forge_transaction(dict(content, fee=str(10**7)))) for content in contents)
+            for call, content in zip(group, contents):
+                content["fee"] = str(minimal_fee(call.gas, 0))
+            contents[0]["fee"] = str(int(contents[0]["fee"]) + MINIMAL_FEE + minimal_fee(0, size))
+            data = forge_operation(head["hash"], contents)
+            signature = await self.signer.sign(OPERATION_WATERMARK + data)
+            signed = data + decode_signature(signature)
+            self.counter += len(group)
+            self.groups += 1
+            injected = await self.rpc.post("/injection/operation?chain=main", signed.hex())
+            level, operation = await self._included(injected, head["level"])
+        except Exception as error:
+            self.counter = None
+            for call in group:
+                call.fail(error)
+            return
+        for call, content in zip(group, operation["contents"]):
+            if content_status(content) == "applied":
+                call.future.set_result({"hash": injected, "level": level})
+            else:
+                call.fail(CallFailed("%s %s on chain" % (call.entrypoint, content_status(content)), content_errors(content)))
+
+    async def _included(self, hash_, injected_level):
+        """``(level, operation)`` of the block including the operation ``hash_``."""
+        while True:
+            head = await self.rpc.get("/chains/main/blocks/head/header")
+            while self.checked < head["level"]:
+                self.checked += 1
+                for operation in await self.rpc.get("/chains/main/blocks/%d/operations/%d" % (self.checked, MANAGER_PASS)):
+                    if operation["hash"] == hash_:
+                        return self.checked, operation
+            if head["level"] > injected_level + OPERATION_TTL:
+                raise CallFailed("operation %s not included after %d blocks" % (hash_, OPERATION_TTL))
+            await asyncio.sleep(self.poll)
+
+
+# Mock node
+
+def _read_nat(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, offset
+
+
+def parse_transactions(data):
+    """Transactions of a forged operation without its signature, as forged by ``forge_operation``."""
+    offset = 32
+    contents = []
+    while offset < len(data):
+        if data[offset] != TRANSACTION_TAG:
+            raise ValueError("not a transaction")
+        content = {"source": data[offset + 1:offset + 22]}
+        offset += 22
+        for key in ("fee", "counter", "gas_limit", "storage_limit", "amount"):
+            content[key], offset = _read_nat(data, offset)
+        content["destination"] = data[offset:offset + 22]
+        offset += 23
+        if data[offset] == 0:
+            content["entrypoint"] = "default"
+            offset += 1
+        else:
+            length = data[offset + 1]
+            content["entrypoint"] = data[offset + 2:offset + 2 + length].decode()
+            offset += 2 + length
+        length = int.from_bytes(data[offset:offset + 4], "big")
+        content["parameters"] = data[offset + 4:offset + 4 + length]
+        offset += 4 + length
+        contents.append(content)
+    return contents
+
+
+class MockNode:
+    """Local stand-in of the node RPC used by ``Client``.
+
+    It bakes a block every ``block_time`` seconds, with the pending groups of at
+    most one group per manager like the protocol. The gas of a call is
+    ``call_gas + byte_gas`` per byte of its parameter, and calls for which
+    ``failing(entrypoint, parameter bytes)`` is true fail. Injected groups are
+    checked for signature, counters, gas, size and fees. The entry points of
+    the contract are those of ``ENTRYPOINT_TYPES``, and the next ``drops``
+    requests are read, then their connection is closed without an answer.
+    """
+
+    def __init__(self, keys, block_time=0.05, call_gas=20000, byte_gas=50, failing=lambda entrypoint, parameter: False):
+        self.keys = {key_address(key): key for key in keys}
+        self.block_time = block_time
+        self.call_gas = call_gas
+        self.byte_gas = byte_gas
+        self.failing = failing
+        self.counters = collections.defaultdict(int)
+        self.blocks = [{"hash": self._block_hash(0), "level": 0, "operations": []}]
+        self.mempool = []
+        self.connections = 0
+        self.requests = 0
+        self.drops = 0
+
+    @staticmethod
+    def _block_hash(level):
+        return b58check_encode(BLOCK_PREFIX, blake2b(b"cvr-mock-block-%d" % level))
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, "127.0.0.1", 0)
+        self.url = "http://127.0.0.1:%d" % self.server.sockets[0].getsockname()[1]
+        self.baker = asyncio.ensure_future(self._bake())
+
+    async def stop(self):
+        self.baker.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+        # let the handlers see the clients close their connections
+        await asyncio.sleep(0.01)
+
+    async def _bake(self):
+        while True:
+            await asyncio.sleep(self.block_time)
+            level = len(self.blocks)
+            operations = []
+            for hash_, contents in self.mempool:
+                self.counters[contents[0]["source"]] = contents[-1]["counter"]
+                results = [self._apply(content["entrypoint"], content["parameters"], content["gas_limit"])
+                           for content in contents]
+                if "failed" in results:
+                    results = ["failed" if result == "failed" else "backtracked" for result in results]
+                operations.append({"hash": hash_, "contents": [
+                    {"kind": "transaction", "counter": str(content["counter"]),
+                     "metadata": {"operation_result": {"status": status}}}
+                    for content, status in zip(contents, results)]})
+            self.mempool = []
+            self.blocks.append({"hash": self._block_hash(level), "level": level, "operations": operations})
+
+    def _gas(self, parameter):
+        return self.call_gas + self.byte_gas * len(parameter)
+
+    def _apply(self, entrypoint, parameter, gas_limit):
+        if self._gas(parameter) > gas_limit or self.failing(entrypoint, parameter):
+            return "failed"
+        return "applied"
+
+    async def _serve(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, path, _ = line.decode().split(" ", 2)
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                if self.drops:
+                    self.drops -= 1
+                    break
+                try:
+                    status, result = 200, self._route(method, path, json.loads(body) if body else None)
+                except (KeyError, ValueError) as error:
+                    status, result = 400, [{"kind": "temporary", "id": "mock.rejected", "msg": str(error)}]
+                payload = json.dumps(result).encode()
+                if path.endswith("/operations/%d" % MANAGER_PASS):
+                    # streamed the way the node streams large answers
+                    writer.write(b"HTTP/1.1 %d OK\r\nTransfer-Encoding: chunked\r\n\r\n%x\r\n%s\r\n0\r\n\r\n"
+                                 % (status, len(payload), payload))
+                else:
+                    writer.write(b"HTTP/1.1 %d OK\r\nContent-Length: %d\r\n\r\n%s" % (status, len(payload), payload))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method, path, body):
+        parts = path.split("?")[0].strip("/").split("/")
+        if path == "/chains/main/chain_id":
+            return "NetXdQprcVkpaWU"
+        if path == "/chains/main/blocks/head/header":
+            return {key: self.blocks[-1][key] for key in ("hash", "level")}
+        if parts[:5] == ["chains", "main", "blocks", "head", "context"] and parts[-1] == "counter":
+            return str(self.counters[parts[6]])
+        if parts[:5] == ["chains", "main", "blocks", "head", "context"] and parts[-1] == "entrypoints":
+            return {"entrypoints": ENTRYPOINT_TYPES}
+        if path.endswith("/helpers/scripts/simulate_operation"):
+            return self._simulate(body["operation"])
+        if parts[:2] == ["injection", "operation"] and method == "POST":
+            return self._inject(bytes.fromhex(body))
+        if parts[:3] == ["chains", "main", "blocks"] and parts[4] == "operations":
+            return self.blocks[int(parts[3])]["operations"]
+        raise KeyError(path)
+
+    def _simulate(self, operation):
+        contents = []
+        failed = False
+        for content in operation["contents"]:
+            parameter = forge(content["parameters"]["value"])
+            gas = self._gas(parameter)
+            status = "skipped" if failed else self._apply(content["parameters"]["entrypoint"], parameter,
+                                                          int(content["gas_limit"]))
+            result = {"status": status, "consumed_milligas": str(1000 * gas), "paid_storage_size_diff": "0"}
+            if status == "failed":
+                failed = True
+                exhausted = gas > int(content["gas_limit"])
+                result["errors"] = [{"kind": "temporary", "id": "proto.mock.gas_exhausted.operation" if exhausted
+                                     else "proto.mock.michelson_v1.script_rejected"}]
+            contents.append(dict(content, metadata={"operation_result": result}))
+        if failed:
+            for content in contents:
+                if content["metadata"]["operation_result"]["status"] == "applied":
+                    content["metadata"]["operation_result"]["status"] = "backtracked"
+        return {"contents": contents}
+
+    def _inject(self, signed):
+        data, signature = signed[:-64], signed[-64:]
+        contents = parse_transactions(data)
+        source = contents[0]["source"]
+        address = decode_address(b"\x00" + source)
+        if address not in self.keys:
+            raise ValueError("unknown key of %s" % address)
+        if not check_signature(self.keys[address], b58check_encode(SIGNATURE_PREFIX, signature), OPERATION_WATERMARK + data):
+            raise ValueError("invalid signature")
+        if any(pending[0]["source"] == address for _, pending in self.mempool):
+            raise ValueError("only one operation per manager per block")
+        for i, content in enumerate(contents):
+            if content["source"] != source or content["counter"] != self.counters[address] + i + 1:
+                raise ValueError("counter %d expected %d" % (content["counter"], self.counters[address] + i + 1))
+            if content["gas_limit"] > MAX_OPERATION_GAS or content["storage_limit"] > MAX_OPERATION_STORAGE:
+                raise ValueError("limit too high")
+        gas = sum(content["gas_limit"] for content in contents)
+        if gas > MAX_BLOCK_GAS or len(signed) > MAX_OPERATION_BYTES:
+            raise ValueError("operation too large")
+        if sum(content["fee"] for content in contents) < MINIMAL_FEE + minimal_fee(gas, len(signed)):
+            raise ValueError("fees too low")
+        hash_ = operation_hash(signed)
+        self.mempool.append((hash_, [dict(content, source=address) for content in contents]))
+        return hash_
+
+
+def read_calls(f, entrypoint=None):
+    for line in f:
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        if entrypoint is None:
+            yield item["entrypoint"], item.get("value"), item.get("amount", 0)
+        else:
+            yield entrypoint, item, item.get("mutez", 0)
+
+
+async def run(args):
+    rpc = Rpc(args.rpc, args.connections)
+    if args.secret_key:
+        signer = LocalSigner(args.secret_key)
+    else:
+        signer = RemoteSigner(args.signer, args.source)
+    client = Client(rpc, signer, args.contract, args.script, poll=args.poll)
+    await client.load()
+    with (sys.stdin if args.calls == "-" else open(args.calls)) as f:
+        futures = [client.call(entrypoint, value, amount) for entrypoint, value, amount in read_calls(f, args.entrypoint)]
+    await client.flush()
+    failed = 0
+    for future in futures:
+        if future.exception() is not None:
+            failed += 1
+            sys.stdout.write(json.dumps({"error": str(future.exception()),
+                                         "errors": getattr(future.exception(), "errors", [])}) + "\n")
+        else:
+            sys.stdout.write(json.dumps(future.result()) + "\n")
+    rpc.close()
+    signer.close()
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("contract")
+    parser.add_argument("calls", nargs="?", default="-", help="JSON lines file of calls, - for stdin")
+    parser.add_argument("--rpc", default="http://localhost:8732")
+    parser.add_argument("--signer", help="URL of the remote signer")
+    parser.add_argument("--source", help="address whose key the remote signer holds")
+    parser.add_argument("--secret-key", help="edsk key signing in the process (tests only)")
+    parser.add_argument("--entrypoint", help="every line is a value of this entrypoint")
+    parser.add_argument("--script", help="script of the contract (entry points read from the node by default)")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--poll", type=float, default=2.0, help="seconds between checks for a new block")
+    args = parser.parse_args(argv)
+    if not (args.secret_key or (args.signer and args.source)):
+        parser.error("--signer with --source (or --secret-key) is required")
+    return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
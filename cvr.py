@@ -1,147 +1,522 @@
+import json
+
 import smartpy as sp
 
 
+def balancedLayout(names):
+    if len(names) == 1:
+        return names[0]
+    half = len(names) // 2
+    return (balancedLayout(names[:half]), balancedLayout(names[half:]))
+
+
+# TZIP-12 (FA2) parameter types, with the layouts required by the standard
+TRANSFER_TX = sp.TRecord(to_=sp.TAddress, token_id=sp.TNat, amount=sp.TNat).layout(("to_", ("token_id", "amount")))
+TRANSFER = sp.TRecord(from_=sp.TAddress, txs=sp.TList(TRANSFER_TX)).layout(("from_", "txs"))
+BALANCE_OF_REQUEST = sp.TRecord(owner=sp.TAddress, token_id=sp.TNat).layout(("owner", "token_id"))
+BALANCE_OF_RESPONSE = sp.TRecord(request=BALANCE_OF_REQUEST, balance=sp.TNat).layout(("request", "balance"))
+BALANCE_OF = sp.TRecord(requests=sp.TList(BALANCE_OF_REQUEST),
+                        callback=sp.TContract(sp.TList(BALANCE_OF_RESPONSE))).layout(("requests", "callback"))
+OPERATOR = sp.TRecord(owner=sp.TAddress, operator=sp.TAddress, token_id=sp.TNat).layout(("owner", ("operator", "token_id")))
+UPDATE_OPERATOR = sp.TVariant(add_operator=OPERATOR, remove_operator=OPERATOR).layout(("add_operator", "remove_operator"))
+
+# Batch of off-chain sales, and the callback receiving the skipped locked buyers
+SALE = sp.TRecord(address=sp.TAddress, amount=sp.TNat).layout(("address", "amount"))
+SALE_BATCH = sp.TRecord(sales=sp.TList(SALE), skipLocked=sp.TBool,
+                        callback=sp.TOption(sp.TContract(sp.TList(sp.TAddress)))).layout(("sales", ("skipLocked", "callback")))
+
+# Locks of addresses, for good or until a time
+LOCK = sp.TRecord(address=sp.TAddress, until=sp.TOption(sp.TTimestamp)).layout(("address", "until"))
+LOCKS = sp.TRecord(addresses=sp.TList(sp.TAddress), until=sp.TOption(sp.TTimestamp)).layout(("addresses", "until"))
+
+# What the contract keeps of an address: its balance, its number in the
+# holders registry, its royalties (owed when last settled, and the royalty per
+# token they were settled at) and the last snapshot its balance was
+# checkpointed for
+ACCOUNT = sp.TRecord(balance=sp.TNat, position=sp.TNat, owed=sp.TNat, paid=sp.TNat,
+                     checkpoint=sp.TNat).layout((("balance", "position"), ("owed", ("paid", "checkpoint"))))
+
+# A page of the holders view
+HOLDER = sp.TRecord(address=sp.TAddress, balance=sp.TNat).layout(("address", "balance"))
+
+# TZIP-17 permit parameter, and the permits of an account: the hashes it has
+# signed with their expiry time, and the counter of its next signature
+PERMIT = sp.TRecord(key=sp.TKey, signature=sp.TSignature, hash=sp.TBytes).layout(("key", ("signature", "hash")))
+PERMITS = sp.TRecord(counter=sp.TNat, expiries=sp.TMap(sp.TBytes, sp.TTimestamp)).layout(("counter", "expiries"))
+
+
 class CVR(sp.Contract):
+    FACTOR = 10**6
+    RATIO = 1
+    # Precision of the royalty per token accumulator
+    ROYALTY_SCALE = 10**18
+    # CVR is the single token of the FA2 interface
+    TOKEN_ID = 0
+    # Lifetime of a permit in seconds, and maximum number of pending permits per account
+    PERMIT_EXPIRY = 24 * 3600
+    MAX_PERMITS = 32
+
+    METADATA = {
+        "name": "Covir",
+        "symbol": "CVR",
+        "decimals": "6",
+        "description": "COVIR token, tokenizing the OctopusRobots licenses' rights",
+        "interfaces": ["TZIP-012", "TZIP-016", "TZIP-017"],
+        "permissions": {"operator": "owner-transfer", "receiver": "owner-no-hook", "sender": "owner-no-hook"},
+    }
+
+    TOKEN_METADATA = {"name": "Covir", "symbol": "CVR", "decimals": "6"}
+
+    # Entry points called on every transfer or sale are at the top of the
+    # parameter tree, the administrative ones below. The administrator only
+    # entry points are lazy: their code is kept in a big_map of lambdas and
+    # only loaded when they are called, so it is not deserialized and
+    # type-checked on every transfer or sale.
+    COLD_ENTRY_POINTS = [
+        "permit", "balance_of", "offchainSale", "offchainSaleBatch", "claimRoyalties", "claimDrop", "burn",
+        "mint", "mintBatch", "cvrDrop", "cvrDropRoot", "closeDrop", "snapshot", "dispatchRoyalties", "depositRoyalties",
+        "claimSale", "increaseSaleLimit", "lockAddress", "unlockAddress", "lockAddresses", "unlockAddresses",
+        "pauseTransfer", "resumeTransfer", "pauseSale", "resumeSale",
+        "setAdministrator", "setManager", "update_operators",
+    ]
+
     def __init__(self, owner, admin, manager, octo, covir):
-        self.init(factor=10**6, transferStatus=False, saleStatus=False, balances=sp.big_map(), owner=owner, administrator=admin, saleManager=manager, octopus=octo, covir=covir, circulatingSupply=0, saleLimit=200000000*10**6, supplyLimit=400000000*10**6, soldToken=0, tokenSymbol="CVR", tokenName="Covir", ratio=1)
+        self.init_type(sp.TRecord(
+            accounts=sp.TBigMap(sp.TAddress, ACCOUNT),
+            holders=sp.TBigMap(sp.TNat, sp.TAddress),
+            holderCount=sp.TNat,
+            royaltyPerToken=sp.TNat,
+            administrator=sp.TAddress,
+            transferStatus=sp.TBool,
+            saleStatus=sp.TBool,
+            circulatingSupply=sp.TInt,
+            soldToken=sp.TInt,
+            saleLimit=sp.TInt,
+            supplyLimit=sp.TInt,
+            reservedSupply=sp.TInt,
+            saleManager=sp.TAddress,
+            owner=sp.TAddress,
+            octopus=sp.TAddress,
+            covir=sp.TAddress,
+            royaltyReserve=sp.TNat,
+            airdropCount=sp.TNat,
+            airdrops=sp.TBigMap(sp.TNat, sp.TRecord(root=sp.TBytes, remaining=sp.TInt)),
+            airdropClaims=sp.TBigMap(sp.TPair(sp.TNat, sp.TNat), sp.TNat),
+            locks=sp.TBigMap(sp.TAddress, sp.TOption(sp.TTimestamp)),
+            permits=sp.TBigMap(sp.TAddress, PERMITS),
+            snapshotId=sp.TNat,
+            snapshots=sp.TBigMap(sp.TNat, sp.TNat),
+            checkpoints=sp.TBigMap(sp.TPair(sp.TAddress, sp.TNat), sp.TRecord(balance=sp.TNat, previous=sp.TNat).layout(("balance", "previous"))),
+            metadata=sp.TBigMap(sp.TString, sp.TBytes),
+            token_metadata=sp.TBigMap(sp.TNat, sp.TRecord(token_id=sp.TNat, token_info=sp.TMap(sp.TString, sp.TBytes)).layout(("token_id", "token_info"))),
+        # The fields read by every transfer or sale are 3 to 5 levels deep in
+        # the storage tree, the others are below them.
+        ).layout(
+            ((("accounts", "royaltyPerToken"),
+              (("locks", "snapshotId"), ("checkpoints", ("holders", "holderCount")))),
+             ((("administrator", "transferStatus"), ("saleStatus", "circulatingSupply")),
+              (("soldToken", "saleLimit"),
+               (((("supplyLimit", "reservedSupply"), ("saleManager", "owner")),
+                 (("octopus", "covir"), ("royaltyReserve", "airdropCount"))),
+                ((("airdrops", "airdropClaims"), ("permits", "snapshots")), ("metadata", "token_metadata"))))))
+        ))
+        self.set_entry_points_layout(("transfer", ("sale", balancedLayout(self.COLD_ENTRY_POINTS))))
+        self.init(accounts=sp.big_map(), holders=sp.big_map(), holderCount=0, royaltyPerToken=0,
+                  administrator=admin, transferStatus=False, saleStatus=False,
+                  circulatingSupply=0, soldToken=0, saleLimit=200000000*self.FACTOR, supplyLimit=400000000*self.FACTOR, reservedSupply=0,
+                  saleManager=manager, owner=owner, octopus=octo, covir=covir,
+                  royaltyReserve=0, airdropCount=0, airdrops=sp.big_map(), airdropClaims=sp.big_map(), locks=sp.big_map(), permits=sp.big_map(),
+                  snapshotId=0, snapshots=sp.big_map(), checkpoints=sp.big_map(),
+                  metadata=sp.big_map({"": sp.utils.bytes_of_string("tezos-storage:content"), "content": sp.utils.bytes_of_string(json.dumps(self.METADATA))}),
+                  token_metadata=sp.big_map({self.TOKEN_ID: sp.record(token_id=self.TOKEN_ID, token_info=sp.map({key: sp.utils.bytes_of_string(value) for key, value in self.TOKEN_METADATA.items()}))}))
 
+    # FA2 transfer: the administrator can transfer from any address, an owner
+    # only from its own address while transfers are open. There are no operators,
+    # but anyone can send a group of transfers its owner has signed a permit for.
     @sp.entry_point
     def transfer(self, params):
-        sp.verify((sp.sender == self.data.administrator) | (self.data.transferStatus & (params.fromAddr == sp.sender)))
-        sp.verify(self.data.balances.contains(params.fromAddr) & (~ self.data.balances[params.fromAddr].lock) & (self.data.balances[params.fromAddr].balance >= params.amount))
-        sp.verify(params.amount > 0)
-        self.addAddressIfNecessary(params.toAddr)
-        self.data.balances[params.fromAddr].balance -= params.amount
-        self.data.balances[params.toAddr].balance += params.amount
-        
-    def addAddressIfNecessary(self, address):
-        sp.if ~ self.data.balances.contains(address):
-            self.data.balances[address] = sp.record(balance=0, lock=False)
+        sp.set_type(params, sp.TList(TRANSFER))
+        total = sp.local("total", sp.nat(0))
+        sp.for batch in params:
+            sp.if (sp.sender != self.data.administrator) & (batch.from_ != sp.sender):
+                self.consumePermit(batch.from_, sp.blake2b(sp.pack(batch)))
+            sp.verify((sp.sender == self.data.administrator) | self.data.transferStatus, "FA2_TX_DENIED")
+            sp.verify(~ self.isLocked(batch.from_), "FA2_TX_DENIED")
+            total.value = 0
+            sp.for tx in batch.txs:
+                sp.verify(tx.token_id == self.TOKEN_ID, "FA2_TOKEN_UNDEFINED")
+                total.value += tx.amount
+            self.debitBalance(batch.from_, self.getAccount(batch.from_), total.value)
+            sp.for tx in batch.txs:
+                sp.if tx.amount > 0:
+                    self.creditBalance(tx.to_, tx.amount)
+
+    @sp.entry_point
+    def balance_of(self, params):
+        sp.set_type(params, BALANCE_OF)
+        def answer(request):
+            sp.verify(request.token_id == self.TOKEN_ID, "FA2_TOKEN_UNDEFINED")
+            sp.result(sp.record(request=request, balance=self.getAccount(request.owner).balance))
+        sp.transfer(params.requests.map(answer), sp.mutez(0), params.callback)
+
+    @sp.entry_point
+    def update_operators(self, params):
+        sp.set_type(params, sp.TList(UPDATE_OPERATOR))
+        sp.failwith("FA2_OPERATORS_UNSUPPORTED")
+
+    # TZIP-17 permits: the owner of a key signs the blake2b hash of a packed
+    # transfer group (one element of the transfer parameter) with the chain id,
+    # the contract address and its counter, and anyone can submit the
+    # signature. The expired permits of an account are removed when it gets
+    # a new one, so each account has at most MAX_PERMITS of them.
+    @sp.entry_point
+    def permit(self, params):
+        sp.set_type(params, sp.TList(PERMIT))
+        sp.for permit in params:
+            owner = sp.compute(sp.to_address(sp.implicit_account(sp.hash_key(permit.key))))
+            account = sp.compute(self.data.permits.get(owner, sp.record(counter=0, expiries={})))
+            message = sp.pack(sp.pair(sp.pair(sp.chain_id, sp.self_address), sp.pair(account.counter, permit.hash)))
+            sp.verify(sp.check_signature(permit.key, permit.signature, message), "MISSIGNED")
+            expiries = sp.local("expiries", sp.map(tkey=sp.TBytes, tvalue=sp.TTimestamp))
+            sp.for item in account.expiries.items():
+                sp.if item.value > sp.now:
+                    expiries.value[item.key] = item.value
+            sp.verify(~ expiries.value.contains(permit.hash), "DUP_PERMIT")
+            expiries.value[permit.hash] = sp.now.add_seconds(self.PERMIT_EXPIRY)
+            sp.verify(sp.len(expiries.value) <= self.MAX_PERMITS, "TOO_MANY_PERMITS")
+            self.data.permits[owner] = sp.record(counter=account.counter + 1, expiries=expiries.value)
+
+    def consumePermit(self, owner, hash):
+        account = sp.compute(self.data.permits.get(owner, sp.record(counter=0, expiries={})))
+        sp.verify(account.expiries.contains(hash), "FA2_NOT_OWNER")
+        sp.verify(account.expiries[hash] > sp.now, "PERMIT_EXPIRED")
+        expiries = sp.local("remaining", account.expiries)
+        del expiries.value[hash]
+        self.data.permits[owner] = sp.record(counter=account.counter, expiries=expiries.value)
+
+    # An address has an account while it holds tokens, is owed royalties or
+    # has a checkpoint, and the record is read once and written once (or
+    # deleted) by each balance change. Both helpers settle the royalties of the
+    # account when its balance changes. They also keep the holders numbered
+    # from 0 to holderCount - 1 for the holders view: an address gets the next
+    # number when its balance leaves 0, and when it gets back to 0 the last
+    # holder takes its number.
+    def getAccount(self, address):
+        return self.data.accounts.get(address, sp.record(balance=0, position=0, owed=0, paid=0, checkpoint=0))
+
+    def creditBalance(self, address, amount):
+        sp.if amount > 0:
+            account = sp.compute(self.getAccount(address))
+            position = sp.local("position", account.position)
+            sp.if account.balance == 0:
+                position.value = self.data.holderCount
+                self.data.holders[self.data.holderCount] = address
+                self.data.holderCount += 1
+            self.settleAccount(address, account, account.balance + amount, position.value)
+
+    def debitBalance(self, address, account, amount):
+        account = sp.compute(account)
+        sp.verify(account.balance >= amount, "FA2_INSUFFICIENT_BALANCE")
+        sp.if amount > 0:
+            sp.if account.balance == amount:
+                self.removeHolder(address, account.position)
+            self.settleAccount(address, account, sp.as_nat(account.balance - amount), account.position)
+
+    def removeHolder(self, address, position):
+        last = sp.compute(sp.as_nat(self.data.holderCount - 1))
+        lastAddress = sp.compute(self.data.holders[last])
+        sp.if lastAddress != address:
+            self.data.holders[position] = lastAddress
+            self.data.accounts[lastAddress].position = position
+        del self.data.holders[last]
+        self.data.holderCount = last
 
     @sp.entry_point
     def burn(self, params):
         sp.verify(params.fromAddr == sp.sender)
-        sp.verify(self.data.balances.contains(params.fromAddr))
-        sp.verify(self.data.balances[params.fromAddr].balance >= params.amount)
-        self.data.balances[params.fromAddr].balance -= params.amount
-        self.data.circulatingSupply -= params.amount
-        self.data.supplyLimit -= params.amount
+        self.debitBalance(params.fromAddr, self.data.accounts[params.fromAddr], params.amount)
+        self.data.circulatingSupply -= sp.to_int(params.amount)
+        self.data.supplyLimit -= sp.to_int(params.amount)
 
-    @sp.entry_point
+    # A lock with an until time is lifted at that time, without any call or
+    # storage change: it is only compared with the time of each transfer or sale.
+    # The lock is read once, then the option is tested on the stack.
+    def isLocked(self, address):
+        lock = sp.compute(self.data.locks.get_opt(address))
+        return lock.is_some() & (lock.open_some().is_none() | (sp.now < lock.open_some().open_some()))
+
+    # An address can be locked before it holds any token, so the tokens of a
+    # vesting cohort are locked from the moment they are minted.
+    def lock(self, address, until):
+        self.data.locks[address] = until
+
+    def unlock(self, address):
+        sp.verify(self.data.locks.contains(address) | (self.getAccount(address).balance > 0))
+        del self.data.locks[address]
+
+    @sp.entry_point(lazify=True)
     def lockAddress(self, params):
+        sp.set_type(params, LOCK)
         sp.verify(sp.sender == self.data.administrator)
-        sp.verify(self.data.balances.contains(params.address))
-        self.data.balances[params.address].lock = True
+        self.lock(params.address, params.until)
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def unlockAddress(self, params):
         sp.verify(sp.sender == self.data.administrator)
-        sp.verify(self.data.balances.contains(params.address))
-        self.data.balances[params.address].lock = False
+        self.unlock(params.address)
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
+    def lockAddresses(self, params):
+        sp.set_type(params, LOCKS)
+        sp.verify(sp.sender == self.data.administrator)
+        sp.for address in params.addresses:
+            self.lock(address, params.until)
+
+    @sp.entry_point(lazify=True)
+    def unlockAddresses(self, params):
+        sp.set_type(params, sp.TList(sp.TAddress))
+        sp.verify(sp.sender == self.data.administrator)
+        sp.for address in params:
+            self.unlock(address)
+
+    @sp.entry_point(lazify=True)
     def pauseTransfer(self, params):
         sp.verify(sp.sender == self.data.administrator)
         self.data.transferStatus = False
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def resumeTransfer(self, params):
         sp.verify(sp.sender == self.data.administrator)
         self.data.transferStatus = True
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def pauseSale(self, params):
         sp.verify(sp.sender == self.data.administrator)
         self.data.saleStatus = False
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def resumeSale(self, params):
         sp.verify(sp.sender == self.data.administrator)
         self.data.saleStatus = True
 
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def setAdministrator(self, params):
         sp.verify(sp.sender == self.data.owner)
-        self.addAddressIfNecessary(params)
         self.data.administrator = params
 
-    @sp.entry_point
-    def getAdministrator(self, params):
-        sp.transfer(self.data.administrator, sp.tez(0), sp.contract(sp.TAddress, params.target).open_some())
-
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def setManager(self, params):
         sp.verify(sp.sender == self.data.administrator)
-        self.addAddressIfNecessary(params)
         self.data.saleManager = params
 
-    @sp.entry_point
-    def getManager(self, params):
-        sp.transfer(self.data.saleManager, sp.tez(0), sp.contract(sp.TAddress, params.target).open_some())
-
     @sp.entry_point
     def sale(self, params):
         sp.verify(self.data.saleStatus)
-        sp.if self.data.balances.contains(sp.sender):
-            sp.verify(~ self.data.balances[sp.sender].lock)
+        sp.verify(~ self.isLocked(sp.sender))
         natMutez = sp.fst(sp.ediv(sp.amount, sp.mutez(1)).open_some())
-        intMutez = sp.to_int(natMutez)
-        self.mintSale(sp.sender, intMutez * self.data.ratio)
+        self.mintSale(sp.sender, natMutez * self.RATIO)
 
     @sp.entry_point
     def offchainSale(self, params):
         sp.verify(sp.sender == self.data.saleManager)
-        sp.if self.data.balances.contains(params.address):
-            sp.verify(~ self.data.balances[params.address].lock)
+        sp.verify(~ self.isLocked(params.address))
         self.mintSale(params.address, params.amount)
 
+    # Sales of a payment window in one call: the sale limit is checked and the
+    # counters are updated once for the whole batch. A locked buyer makes the
+    # batch fail, or with skipLocked is skipped and reported to the callback.
+    @sp.entry_point
+    def offchainSaleBatch(self, params):
+        sp.set_type(params, SALE_BATCH)
+        sp.verify(sp.sender == self.data.saleManager)
+        total = sp.local("total", sp.nat(0))
+        skipped = sp.local("skipped", sp.list(t=sp.TAddress))
+        sp.for sale in params.sales:
+            sp.if self.isLocked(sale.address):
+                sp.verify(params.skipLocked)
+                skipped.value.push(sale.address)
+            sp.else:
+                self.creditBalance(sale.address, sale.amount)
+                total.value += sale.amount
+        sp.verify(self.data.soldToken + sp.to_int(total.value) <= self.data.saleLimit)
+        self.data.circulatingSupply += sp.to_int(total.value)
+        self.data.soldToken += sp.to_int(total.value)
+        sp.if params.callback.is_some():
+            sp.transfer(skipped.value.rev(), sp.mutez(0), params.callback.open_some())
+
     def mintSale(self, address, nbMutoken):
-        sp.verify(self.data.soldToken + nbMutoken <= self.data.saleLimit)
-        self.addAddressIfNecessary(address)
-        self.data.balances[address].balance += nbMutoken
-        self.data.circulatingSupply += nbMutoken
-        self.data.soldToken += nbMutoken
+        sp.verify(self.data.soldToken + sp.to_int(nbMutoken) <= self.data.saleLimit)
+        self.creditBalance(address, nbMutoken)
+        self.data.circulatingSupply += sp.to_int(nbMutoken)
+        self.data.soldToken += sp.to_int(nbMutoken)
     
     def checkLimit(self, amount):
-        sp.verify(amount + self.data.saleLimit - self.data.soldToken + self.data.circulatingSupply <= self.data.supplyLimit)
+        sp.verify(amount + self.data.saleLimit - self.data.soldToken + self.data.circulatingSupply + self.data.reservedSupply <= self.data.supplyLimit)
     
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def mint(self, params):
         sp.verify(sp.sender == self.data.administrator)
-        self.checkLimit(params.amount)
-        self.addAddressIfNecessary(params.toAddr)
-        self.data.balances[params.toAddr].balance += params.amount
-        self.data.circulatingSupply += params.amount
+        self.checkLimit(sp.to_int(params.amount))
+        self.creditBalance(params.toAddr, params.amount)
+        self.data.circulatingSupply += sp.to_int(params.amount)
+
+    @sp.entry_point(lazify=True)
+    def mintBatch(self, params):
+        sp.verify(sp.sender == self.data.administrator)
+        amounts = sp.local("amounts", sp.map(tkey=sp.TAddress, tvalue=sp.TNat))
+        total = sp.local("total", sp.nat(0))
+        sp.for item in params:
+            sp.verify(item.amount > 0)
+            amounts.value[item.toAddr] = amounts.value.get(item.toAddr, 0) + item.amount
+            total.value += item.amount
+        self.checkLimit(sp.to_int(total.value))
+        sp.for item in amounts.value.items():
+            self.creditBalance(item.key, item.value)
+        self.data.circulatingSupply += sp.to_int(total.value)
    
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def increaseSaleLimit(self, params):
         sp.verify(sp.sender == self.data.administrator)
         self.checkLimit(params.amount)
         self.data.saleLimit += params.amount
         
-    @sp.entry_point
+    @sp.entry_point(lazify=True)
     def cvrDrop(self, params):
         sp.verify(sp.sender == self.data.administrator)
-        self.checkLimit(params.amount * sp.to_int(sp.len(params.addresses)))
+        self.checkLimit(sp.to_int(params.amount * sp.len(params.addresses)))
         sp.for address in params.addresses:
-            self.addAddressIfNecessary(address)
-            self.data.balances[address].balance += params.amount
-            self.data.circulatingSupply += params.amount
-            
+            self.creditBalance(address, params.amount)
+        self.data.circulatingSupply += sp.to_int(params.amount * sp.len(params.addresses))
+
+    @sp.entry_point(lazify=True)
+    def cvrDropRoot(self, params):
+        sp.verify(sp.sender == self.data.administrator)
+        sp.verify(params.total > 0)
+        self.checkLimit(params.total)
+        self.data.airdrops[self.data.airdropCount] = sp.record(root=params.root, remaining=params.total)
+        self.data.reservedSupply += params.total
+        self.data.airdropCount += 1
+
     @sp.entry_point
+    def claimDrop(self, params):
+        drop = sp.compute(self.data.airdrops[params.dropId])
+        word = sp.local("word", sp.pair(params.dropId, params.index // 256))
+        bit = sp.local("bit", sp.nat(1) << (params.index % 256))
+        bitmap = sp.local("bitmap", self.data.airdropClaims.get(word.value, sp.nat(0)))
+        sp.verify((bitmap.value & bit.value) == 0)
+        node = sp.local("node", sp.blake2b(sp.pack((params.index, (params.address, params.amount)))))
+        position = sp.local("position", params.index)
+        sp.for sibling in params.proof:
+            sp.if position.value % 2 == 0:
+                node.value = sp.blake2b(node.value + sibling)
+            sp.else:
+                node.value = sp.blake2b(sibling + node.value)
+            position.value //= 2
+        sp.verify(node.value == drop.root)
+        sp.verify((params.amount > 0) & (drop.remaining >= sp.to_int(params.amount)))
+        self.data.airdropClaims[word.value] = bitmap.value | bit.value
+        self.data.airdrops[params.dropId] = sp.record(root=drop.root, remaining=drop.remaining - sp.to_int(params.amount))
+        self.data.reservedSupply -= sp.to_int(params.amount)
+        self.creditBalance(params.address, params.amount)
+        self.data.circulatingSupply += sp.to_int(params.amount)
+
+    @sp.entry_point(lazify=True)
+    def closeDrop(self, params):
+        sp.verify(sp.sender == self.data.administrator)
+        self.data.reservedSupply -= self.data.airdrops[params].remaining
+        del self.data.airdrops[params]
+            
+    @sp.entry_point(lazify=True)
     def dispatchRoyalties(self, params):
         sp.verify(sp.sender == self.data.administrator)
         rounded = sp.as_nat(10**10)
-        muCVRtez = sp.as_nat(self.data.circulatingSupply)*rounded // params.amount + 1
+        supply = sp.local("supply", sp.as_nat(self.data.circulatingSupply))
+        sp.if params.snapshotId.is_some():
+            supply.value = self.data.snapshots[params.snapshotId.open_some()]
+        muCVRtez = supply.value*rounded // params.amount + 1
+        sent = sp.local("sent", sp.nat(0))
         sp.for address in params.addresses:
-            sp.if (self.data.balances.contains(address) & (sp.as_nat(self.data.balances[address].balance)*rounded > muCVRtez)):
-                sendMuTez = sp.as_nat(self.data.balances[address].balance)*rounded // muCVRtez
+            account = sp.compute(self.getAccount(address))
+            balance = sp.local("balance", account.balance)
+            sp.if params.snapshotId.is_some():
+                balance.value = self.snapshotBalance(address, account, params.snapshotId.open_some())
+            sp.if balance.value*rounded > muCVRtez:
+                sendMuTez = balance.value*rounded // muCVRtez
+                sent.value += sendMuTez
                 sp.send(address, sp.mutez(sendMuTez))
+        # the deposited royalties stay in the contract until they are claimed
+        sp.verify(sp.balance >= sp.mutez(sent.value + self.data.royaltyReserve), "ROYALTY_RESERVE")
+
+    # Balances are not copied when a snapshot is taken: the first balance change
+    # of an address after a snapshot saves the balance it had when the snapshot
+    # was taken, with the id of its previous checkpoint.
+    @sp.entry_point(lazify=True)
+    def snapshot(self, params):
+        sp.verify(sp.sender == self.data.administrator)
+        self.data.snapshotId += 1
+        self.data.snapshots[self.data.snapshotId] = sp.as_nat(self.data.circulatingSupply)
+
+    # The balance at a snapshot is the one saved by the first checkpoint of the
+    # address written after it, or its current balance if there is none.
+    # account is the account of owner, already read by the caller.
+    def snapshotBalance(self, owner, account, snapshotId):
+        account = sp.compute(account)
+        balance = sp.local("snapshotBalance", account.balance)
+        cursor = sp.local("cursor", account.checkpoint)
+        sp.while cursor.value >= snapshotId:
+            checkpoint = sp.compute(self.data.checkpoints[sp.pair(owner, cursor.value)])
+            balance.value = checkpoint.balance
+            cursor.value = checkpoint.previous
+        return balance.value
+
+    @sp.entry_point(lazify=True)
+    def depositRoyalties(self, params):
+        sp.verify(sp.sender == self.data.administrator)
+        sp.verify(self.data.circulatingSupply > 0)
+        natMutez = sp.fst(sp.ediv(sp.amount, sp.mutez(1)).open_some())
+        self.data.royaltyPerToken += natMutez * self.ROYALTY_SCALE // sp.as_nat(self.data.circulatingSupply)
+        self.data.royaltyReserve += natMutez
 
     @sp.entry_point
+    def claimRoyalties(self, params):
+        sp.for address in params:
+            found = sp.compute(self.data.accounts.get_opt(address))
+            sp.if found.is_some():
+                account = sp.compute(found.open_some())
+                owed = sp.compute(self.owedRoyalties(account, account.balance))
+                sp.if owed > 0:
+                    sp.send(address, sp.mutez(owed))
+                    self.data.royaltyReserve = sp.as_nat(self.data.royaltyReserve - owed)
+                sp.if (account.balance > 0) | (account.checkpoint > 0):
+                    self.data.accounts[address] = sp.record(balance=account.balance, position=account.position, owed=0,
+                                                            paid=self.data.royaltyPerToken, checkpoint=account.checkpoint)
+                sp.else:
+                    del self.data.accounts[address]
+
+    def owedRoyalties(self, account, balance):
+        return account.owed + balance * sp.as_nat(self.data.royaltyPerToken - account.paid) // self.ROYALTY_SCALE
+
+    # account is the account of address before the operation changes it, and
+    # newBalance the balance after it. The balance is checkpointed before its
+    # first change after a snapshot, and the account is deleted once it is
+    # empty, owed nothing and has no checkpoint: the checkpoints of a former
+    # holder keep its account.
+    def settleAccount(self, address, account, newBalance, position):
+        checkpoint = sp.local("checkpoint", account.checkpoint)
+        sp.if checkpoint.value < self.data.snapshotId:
+            self.data.checkpoints[sp.pair(address, self.data.snapshotId)] = sp.record(balance=account.balance, previous=checkpoint.value)
+            checkpoint.value = self.data.snapshotId
+        owed = sp.compute(self.owedRoyalties(account, account.balance))
+        sp.if (newBalance == 0) & (owed == 0) & (checkpoint.value == 0):
+            del self.data.accounts[address]
+        sp.else:
+            self.data.accounts[address] = sp.record(balance=newBalance, position=position, owed=owed,
+                                                    paid=self.data.royaltyPerToken, checkpoint=checkpoint.value)
+
+    @sp.entry_point(lazify=True)
     def claimSale(self, params):
         sp.verify(sp.sender == self.data.administrator)
-        sp.verify(sp.balance > sp.mutez(params.amount))
+        sp.verify(sp.balance > sp.mutez(params.amount + self.data.royaltyReserve))
         muSharetez = params.amount // 100
         self.processSplit(muSharetez)
    
@@ -149,48 +524,121 @@ class CVR(sp.Contract):
         sp.send(self.data.octopus,  sp.mutez(muSharetez*75))
         sp.send(self.data.covir, sp.mutez(muSharetez*25))
 
-    @sp.entry_point
-    def getBalance(self, params):
-        sp.if self.data.balances.contains(params.owner):
-            sp.transfer(sp.as_nat(self.data.balances[params.owner].balance), sp.tez(0),
-                        sp.contract(sp.TNat, params.target).open_some())
-        sp.else:
-            sp.transfer(sp.as_nat(0), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    @sp.onchain_view()
+    def getBalance(self, owner):
+        sp.result(self.getAccount(owner).balance)
 
-    @sp.entry_point
-    def getCirculatingSupply(self, params):
-        sp.transfer(sp.as_nat(self.data.circulatingSupply), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    # Holders page by page, with their balances: the holders numbered from
+    # offset to offset + limit - 1. Numbers change when holders leave, so an
+    # off-chain reader should read all pages at the same level.
+    @sp.onchain_view()
+    def holders(self, params):
+        sp.set_type(params, sp.TRecord(offset=sp.TNat, limit=sp.TNat).layout(("offset", "limit")))
+        page = sp.local("page", sp.list(t=HOLDER))
+        position = sp.local("position", sp.min(self.data.holderCount, params.offset + params.limit))
+        sp.while position.value > params.offset:
+            position.value = sp.as_nat(position.value - 1)
+            address = sp.compute(self.data.holders[position.value])
+            page.value.push(sp.record(address=address, balance=self.data.accounts[address].balance))
+        sp.result(page.value)
 
-    @sp.entry_point
-    def getSoldToken(self, params):
-        sp.transfer(sp.as_nat(self.data.soldToken), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    @sp.onchain_view()
+    def getHolderCount(self):
+        sp.result(self.data.holderCount)
 
-    @sp.entry_point
-    def getSaleLimit(self, params):
-        sp.transfer(sp.as_nat(self.data.saleLimit), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    @sp.onchain_view()
+    def balanceAt(self, params):
+        sp.set_type(params, sp.TRecord(owner=sp.TAddress, snapshotId=sp.TNat).layout(("owner", "snapshotId")))
+        sp.verify(self.data.snapshots.contains(params.snapshotId), "unknown snapshot")
+        sp.result(self.snapshotBalance(params.owner, self.getAccount(params.owner), params.snapshotId))
 
-    @sp.entry_point
-    def getSupplyLimit(self, params):
-        sp.transfer(sp.as_nat(self.data.supplyLimit), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    @sp.onchain_view()
+    def supplyAt(self, snapshotId):
+        sp.result(self.data.snapshots[snapshotId])
+
+    @sp.onchain_view()
+    def getSnapshotId(self):
+        sp.result(self.data.snapshotId)
+
+    @sp.onchain_view()
+    def getPermitCounter(self, owner):
+        sp.result(self.data.permits.get(owner, sp.record(counter=0, expiries={})).counter)
+
+    @sp.onchain_view()
+    def getCirculatingSupply(self):
+        sp.result(sp.as_nat(self.data.circulatingSupply))
+
+    @sp.onchain_view()
+    def getSoldToken(self):
+        sp.result(sp.as_nat(self.data.soldToken))
+
+    @sp.onchain_view()
+    def getSaleLimit(self):
+        sp.result(sp.as_nat(self.data.saleLimit))
+
+    @sp.onchain_view()
+    def getSupplyLimit(self):
+        sp.result(sp.as_nat(self.data.supplyLimit))
+
+    @sp.onchain_view()
+    def getFactor(self):
+        sp.result(sp.nat(self.FACTOR))
+
+    @sp.onchain_view()
+    def getTransferStatus(self):
+        sp.result(self.data.transferStatus)
+
+    @sp.onchain_view()
+    def getSaleStatus(self):
+        sp.result(self.data.saleStatus)
+
+    @sp.onchain_view()
+    def getAdministrator(self):
+        sp.result(self.data.administrator)
+
+    @sp.onchain_view()
+    def getManager(self):
+        sp.result(self.data.saleManager)
+
+    @sp.onchain_view()
+    def getStats(self):
+        sp.result(sp.record(
+            circulatingSupply=sp.as_nat(self.data.circulatingSupply),
+            soldToken=sp.as_nat(self.data.soldToken),
+            saleLimit=sp.as_nat(self.data.saleLimit),
+            supplyLimit=sp.as_nat(self.data.supplyLimit),
+            reservedSupply=sp.as_nat(self.data.reservedSupply),
+            transferStatus=self.data.transferStatus,
+            saleStatus=self.data.saleStatus))
+
+
+class BalanceOfConsumer(sp.Contract):
+    """Keeps the last balance_of responses, to test the FA2 callback."""
+
+    def __init__(self):
+        self.init(responses=sp.list(t=BALANCE_OF_RESPONSE))
 
     @sp.entry_point
-    def getFactor(self, params):
-        sp.transfer(sp.as_nat(self.data.factor), sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
-        
-    @sp.entry_point
-    def getTransferStatus(self, params):
-        sp.if self.data.transferStatus:
-            sp.transfer(1, sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
-        sp.else:
-            sp.transfer(0, sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
-            
+    def receiveBalances(self, params):
+        sp.set_type(params, sp.TList(BALANCE_OF_RESPONSE))
+        self.data.responses = params
+
+    def callback(self):
+        return sp.contract(sp.TList(BALANCE_OF_RESPONSE), self.address, entry_point="receiveBalances").open_some()
+
+class SkippedSalesConsumer(sp.Contract):
+    """Keeps the buyers skipped by the last offchainSaleBatch, to test its callback."""
+
+    def __init__(self):
+        self.init(addresses=sp.list(t=sp.TAddress))
+
     @sp.entry_point
-    def getSaleStatus(self, params):
-        sp.if self.data.saleStatus:
-            sp.transfer(1, sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
-        sp.else:
-            sp.transfer(0, sp.tez(0), sp.contract(sp.TNat, params.target).open_some())
+    def receiveSkipped(self, params):
+        sp.set_type(params, sp.TList(sp.TAddress))
+        self.data.addresses = params
 
+    def callback(self):
+        return sp.contract(sp.TList(sp.TAddress), self.address, entry_point="receiveSkipped").open_some()
 
 if "templates" not in __name__:
     @sp.add_test(name="CVR")
@@ -231,31 +679,34 @@ if "templates" not in __name__:
         scenario.h2("Test init smart contract")
         
         scenario.h3("Get Factor")
-        scenario += c1.getFactor(target=alice).run(sender=alice)
+        scenario.verify(c1.getFactor() == factor)
         
         scenario.h3("Get supply limit")
-        scenario += c1.getSupplyLimit(target=alice).run(sender=alice)
+        scenario.verify(c1.getSupplyLimit() == 400000000 * factor)
         
         scenario.h3("Get sale limit")
-        scenario += c1.getSaleLimit(target=alice).run(sender=alice)
+        scenario.verify(c1.getSaleLimit() == 200000000 * factor)
         
         scenario.h3("Get circulating supply")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.verify(c1.getCirculatingSupply() == 0)
         
         scenario.h3("Alice gets balance of Alice")
-        scenario += c1.getBalance(owner=alice, target=alice).run(sender=alice)
+        scenario.verify(c1.getBalance(alice) == 0)
         
         scenario.h3("Bob gets balance of Alice")
-        scenario += c1.getBalance(owner=alice, target=bob).run(sender=bob)
+        scenario.show(c1.getBalance(alice))
         
         scenario.h3("Get transfer status")
-        scenario += c1.getTransferStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getTransferStatus())
         
         scenario.h3("Get sale status")
-        scenario += c1.getSaleStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleStatus())
         
         scenario.h3("Get number of sold tokens")
-        scenario += c1.getSoldToken(target=alice).run(sender=alice)
+        scenario.show(c1.getSoldToken())
+        
+        scenario.h3("Get supply, sale and status statistics in one call")
+        scenario.verify(c1.getStats() == sp.record(circulatingSupply=0, soldToken=0, saleLimit=200000000 * factor, supplyLimit=400000000 * factor, reservedSupply=0, transferStatus=False, saleStatus=False))
         
         
         ########################
@@ -264,13 +715,13 @@ if "templates" not in __name__:
         scenario += c1.setAdministrator(jack).run(sender=jack, valid=False)
         
         scenario.h3("Get current administrator address")
-        scenario += c1.getAdministrator(target=alice).run(sender=alice)
+        scenario.show(c1.getAdministrator())
         
         scenario.h3("Admin1 tries to set admin2 as administrator")
         scenario += c1.setAdministrator(admin2).run(sender=admin1, valid=False)
         
         scenario.h3("Get current administrator address")
-        scenario += c1.getAdministrator(target=alice).run(sender=alice)
+        scenario.show(c1.getAdministrator())
         
         # test not available on smartpy
         # scenario.h3("Owner tries to set a wrong formated address as administrator")
@@ -280,7 +731,7 @@ if "templates" not in __name__:
         scenario += c1.setAdministrator(admin2).run(sender=owner)
         
         scenario.h3("Get current administrator address")
-        scenario += c1.getAdministrator(target=alice).run(sender=alice)
+        scenario.show(c1.getAdministrator())
         
         
         #############################
@@ -289,7 +740,7 @@ if "templates" not in __name__:
         scenario += c1.cvrDrop(addresses=[jack], amount=100 * factor).run(sender=jack, valid=False)
         
         scenario.h3("Get circulating supply to verify that previous airdrop did not succeed")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Admin1 tries to aidrop tokens to Alice")
         scenario += c1.cvrDrop(addresses=[alice], amount=10 * factor).run(sender=admin1, valid=False)
@@ -298,7 +749,7 @@ if "templates" not in __name__:
         scenario += c1.cvrDrop(addresses=[alice], amount=10 * factor).run(sender=admin2)
         
         scenario.h3("Admin2 locks Alice's address")
-        scenario += c1.lockAddress(address=alice).run(sender=admin2)
+        scenario += c1.lockAddress(address=alice, until=sp.none).run(sender=admin2)
         
         scenario.h3("Admin2 aidrop tokens to a list wallets, including one lock address: Alice")
         scenario += c1.cvrDrop(addresses=[alice, bob, jack], amount=10 * factor).run(sender=admin2)
@@ -306,23 +757,53 @@ if "templates" not in __name__:
         scenario.h3("Admin2 aidrop too many tokens (over supply limit)")
         scenario += c1.cvrDrop(addresses=[alice, bob, jack], amount=200000000 * factor).run(sender=admin2, valid=False)
         
+        scenario.h3("Jack tries to commit an airdrop Merkle root")
+        scenario += c1.cvrDropRoot(root=sp.bytes("0xbf90d0c75ad0f1c96ac6a4202878384a2c688d4f5d01eea7c33cc651a804cf21"), total=13 * factor).run(sender=jack, valid=False)
+        
+        scenario.h3("Admin2 tries to commit an airdrop Merkle root over supply limit")
+        scenario += c1.cvrDropRoot(root=sp.bytes("0xbf90d0c75ad0f1c96ac6a4202878384a2c688d4f5d01eea7c33cc651a804cf21"), total=400000000 * factor).run(sender=admin2, valid=False)
+        
+        scenario.h3("Admin2 commits the Merkle root of an airdrop of 5 tokens to Alice and Bob and 3 tokens to Jack")
+        scenario += c1.cvrDropRoot(root=sp.bytes("0xbf90d0c75ad0f1c96ac6a4202878384a2c688d4f5d01eea7c33cc651a804cf21"), total=13 * factor).run(sender=admin2)
+        
+        scenario.h3("Bob claims the airdrop of Alice for her")
+        scenario += c1.claimDrop(dropId=0, index=0, address=alice, amount=5 * factor, proof=[sp.bytes("0x33abd503f9e699fef109f6c958c2c8df2a57e37d3ff55551566620fafc9065fe"), sp.bytes("0x9398f0e5bd7c7060b31538affe54b30fd010f0ae7fd61e57bd90b0f8cb4ad95a")]).run(sender=bob)
+        
+        scenario.h3("Alice tries to claim her airdrop twice")
+        scenario += c1.claimDrop(dropId=0, index=0, address=alice, amount=5 * factor, proof=[sp.bytes("0x33abd503f9e699fef109f6c958c2c8df2a57e37d3ff55551566620fafc9065fe"), sp.bytes("0x9398f0e5bd7c7060b31538affe54b30fd010f0ae7fd61e57bd90b0f8cb4ad95a")]).run(sender=alice, valid=False)
+        
+        scenario.h3("Jack tries to claim more than his airdrop")
+        scenario += c1.claimDrop(dropId=0, index=2, address=jack, amount=30 * factor, proof=[sp.bytes("0x6f2cbb1d5cb33d71ce43a49f03899101e9c20b0e029f871bd4c5dc76bf335055"), sp.bytes("0x4168e0e3e90b91a4039c5ac6ed07701292bb624703458bc8e527c7b0824033a7")]).run(sender=jack, valid=False)
+        
+        scenario.h3("Jack claims his airdrop")
+        scenario += c1.claimDrop(dropId=0, index=2, address=jack, amount=3 * factor, proof=[sp.bytes("0x6f2cbb1d5cb33d71ce43a49f03899101e9c20b0e029f871bd4c5dc76bf335055"), sp.bytes("0x4168e0e3e90b91a4039c5ac6ed07701292bb624703458bc8e527c7b0824033a7")]).run(sender=jack)
+        
+        scenario.h3("Jack tries to close the airdrop")
+        scenario += c1.closeDrop(0).run(sender=jack, valid=False)
+        
+        scenario.h3("Admin2 closes the airdrop, the tokens not claimed by Bob are not reserved anymore")
+        scenario += c1.closeDrop(0).run(sender=admin2)
+        
+        scenario.h3("Bob tries to claim his airdrop after it has been closed")
+        scenario += c1.claimDrop(dropId=0, index=1, address=bob, amount=5 * factor, proof=[sp.bytes("0x76e8aa03e5f1364aac5df834df2941bf051bff5b973d96b24952049d3ffd4d71"), sp.bytes("0x9398f0e5bd7c7060b31538affe54b30fd010f0ae7fd61e57bd90b0f8cb4ad95a")]).run(sender=bob, valid=False)
+        
         scenario.h3("Admin2 unlocks Alice's address")
         scenario += c1.unlockAddress(address=alice).run(sender=admin2)
         
         scenario.h3("Alice gets balance of Alice")
-        scenario += c1.getBalance(owner=alice, target=alice).run(sender=alice)
+        scenario.show(c1.getBalance(alice))
         
         scenario.h3("Bob gets balance of Bob")
-        scenario += c1.getBalance(owner=bob, target=bob).run(sender=bob)
+        scenario.show(c1.getBalance(bob))
         
         scenario.h3("Jack gets balance of Jack")
-        scenario += c1.getBalance(owner=jack, target=jack).run(sender=jack)
+        scenario.show(c1.getBalance(jack))
         
         scenario.h3("Get number of sold tokens")
-        scenario += c1.getSoldToken(target=alice).run(sender=alice)
+        scenario.show(c1.getSoldToken())
         
         scenario.h3("Get circulating supply")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         
         #############################
@@ -334,13 +815,13 @@ if "templates" not in __name__:
         scenario += c1.increaseSaleLimit(amount=1000000).run(sender=jack, valid=False)
         
         scenario.h3("Alice gets sale limit to verify that is has not changed")
-        scenario += c1.getSaleLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleLimit())
         
         scenario.h3("Admin2 increases the sale limit by 2M")
         scenario += c1.increaseSaleLimit(amount=2000000 * factor).run(sender=admin2)
         
         scenario.h3("Alice gets sale limit to verify that is has been updated to 202M")
-        scenario += c1.getSaleLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleLimit())
         
         scenario.h3("Jack tries to set sale status to True")
         scenario += c1.resumeSale().run(sender=jack, valid=False)
@@ -352,7 +833,7 @@ if "templates" not in __name__:
         scenario += c1.resumeSale().run(sender=admin2)
         
         scenario.h3("Alice gets sale status to verify it is True")
-        scenario += c1.getSaleStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleStatus())
         
         scenario.h3("Alice buys 100 tokens with 100 tez")
         scenario += c1.sale().run(sender=alice, amount=sp.tez(100))
@@ -361,7 +842,7 @@ if "templates" not in __name__:
         scenario += c1.sale().run(sender=alice, amount=sp.mutez(11230000))
         
         scenario.h3("Admin2 locks Bob's address")
-        scenario += c1.lockAddress(address=bob).run(sender=admin2)
+        scenario += c1.lockAddress(address=bob, until=sp.none).run(sender=admin2)
         
         scenario.h3("Bob tries to buy 100 tokens but Bob is locked")
         scenario += c1.sale().run(sender=bob, amount=sp.tez(100), valid=False)
@@ -370,22 +851,22 @@ if "templates" not in __name__:
         scenario += c1.unlockAddress(address=bob).run(sender=admin2)
         
         scenario.h3("Get number of sold tokens")
-        scenario += c1.getSoldToken(target=alice).run(sender=alice)
+        scenario.show(c1.getSoldToken())
         
         scenario.h3("Alice gets balance of Alice to verify she received tokens")
-        scenario += c1.getBalance(owner=alice, target=alice).run(sender=alice)
+        scenario.show(c1.getBalance(alice))
         
         scenario.h3("Bob gets balance of Bob to verify he did not receive tokens")
-        scenario += c1.getBalance(owner=bob, target=bob).run(sender=bob)
+        scenario.show(c1.getBalance(bob))
         
         scenario.h3("Verify circulating supply")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Jack tries to set sale status to False")
         scenario += c1.pauseSale().run(sender=jack, valid=False)
         
         scenario.h3("Alice gets sale status to verify it is still True")
-        scenario += c1.getSaleStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleStatus())
         
         scenario.h3("Admin2 sets sale status to False")
         scenario += c1.pauseSale().run(sender=admin2)
@@ -406,7 +887,7 @@ if "templates" not in __name__:
         scenario += c1.setManager(manager2).run(sender=admin2)
         
         scenario.h3("Get current manager address")
-        scenario += c1.getManager(target=alice).run(sender=alice)
+        scenario.show(c1.getManager())
         
         scenario.h3("Jack tries to send sale tokens to jack")
         scenario += c1.offchainSale(address=jack, amount=1000000).run(sender=jack, valid=False)
@@ -424,7 +905,7 @@ if "templates" not in __name__:
         scenario += c1.offchainSale(address=bob, amount=123456000).run(sender=manager2)
         
         scenario.h3("Get number of sold tokens")
-        scenario += c1.getSoldToken(target=alice).run(sender=alice)
+        scenario.show(c1.getSoldToken())
         
         scenario.h3("Jack launch 10 XTZ claim from sale")
         scenario += c1.claimSale(amount=10000000).run(sender=jack, valid=False)
@@ -448,7 +929,7 @@ if "templates" not in __name__:
         scenario += c1.increaseSaleLimit(amount=200000000 * factor).run(sender=admin2, valid=False)
         
         scenario.h3("Alice gets sale limit to verify that it has not changed")
-        scenario += c1.getSaleLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSaleLimit())
         
         
         #############################
@@ -457,43 +938,43 @@ if "templates" not in __name__:
         scenario += c1.resumeTransfer().run(sender=jack, valid=False)
         
         scenario.h3("Jack tries to transfer 1 token to Bob")
-        scenario += c1.transfer(fromAddr=jack, toAddr=bob, amount=1 * factor).run(sender=jack, valid=False)
+        scenario += c1.transfer([sp.record(from_=jack, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor)])]).run(sender=jack, valid=False)
         
         scenario.h3("Admin2 tries to transfer 1 token to Bob, but balance = 0")
-        scenario += c1.transfer(fromAddr=admin2, toAddr=bob, amount=1 * factor).run(sender=admin2, valid=False)
+        scenario += c1.transfer([sp.record(from_=admin2, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor)])]).run(sender=admin2, valid=False)
         
         scenario.h3("Admin2 unlock transfer function, set transfer status to True")
         scenario += c1.resumeTransfer().run(sender=admin2)
         
         scenario.h3("Alice gets the current transfer status to verify it is True")
-        scenario += c1.getTransferStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getTransferStatus())
         
         scenario.h3("Jack tries to transfer 10 token from Alice to Jack")
-        scenario += c1.transfer(fromAddr=alice, toAddr=jack, amount=10 * factor).run(sender=jack, valid=False)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=jack, token_id=0, amount=10 * factor)])]).run(sender=jack, valid=False)
         
         scenario.h3("Alice transfers 10 token from Alice to Bob")
-        scenario += c1.transfer(fromAddr=alice, toAddr=bob, amount=10 * factor).run(sender=alice)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])]).run(sender=alice)
         
         scenario.h3("Bob transfers 3.456 token from Bob to Alice")
-        scenario += c1.transfer(fromAddr=bob, toAddr=alice, amount=3456000).run(sender=bob)
+        scenario += c1.transfer([sp.record(from_=bob, txs=[sp.record(to_=alice, token_id=0, amount=3456000)])]).run(sender=bob)
         
         scenario.h3("Jack tries to lock Bob address")
-        scenario += c1.lockAddress(address=bob).run(sender=jack, valid=False)
+        scenario += c1.lockAddress(address=bob, until=sp.none).run(sender=jack, valid=False)
         
         scenario.h3("Admin2 locks Jack address")
-        scenario += c1.lockAddress(address=jack).run(sender=admin2)
+        scenario += c1.lockAddress(address=jack, until=sp.none).run(sender=admin2)
         
         scenario.h3("Jack tries to transfer 10 tokens from Jack to Bob but jack is locked")
-        scenario += c1.transfer(fromAddr=jack, toAddr=bob, amount=10 * factor).run(sender=jack, valid=False)
+        scenario += c1.transfer([sp.record(from_=jack, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])]).run(sender=jack, valid=False)
         
         scenario.h3("Admin2 locks Bob address")
-        scenario += c1.lockAddress(address=bob).run(sender=admin2)
+        scenario += c1.lockAddress(address=bob, until=sp.none).run(sender=admin2)
         
         scenario.h3("Bob tries to transfer 10 tokens from Bob to Alice but Bob is locked")
-        scenario += c1.transfer(fromAddr=bob, toAddr=alice, amount=10 * factor).run(sender=bob, valid=False)
+        scenario += c1.transfer([sp.record(from_=bob, txs=[sp.record(to_=alice, token_id=0, amount=10 * factor)])]).run(sender=bob, valid=False)
         
         scenario.h3("Alice transfers 10 tokens from Alice to Bob. It works even if Bob is locked")
-        scenario += c1.transfer(fromAddr=alice, toAddr=bob, amount=10 * factor).run(sender=alice)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])]).run(sender=alice)
         
         scenario.h3("Jack tries to unlock Jack address")
         scenario += c1.unlockAddress(address=jack).run(sender=jack, valid=False)
@@ -502,14 +983,32 @@ if "templates" not in __name__:
         scenario += c1.unlockAddress(address=bob).run(sender=admin2)
         
         scenario.h3("Alice transfers 10 tokens from Alice to Bob")
-        scenario += c1.transfer(fromAddr=alice, toAddr=bob, amount=10 * factor).run(sender=alice)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])]).run(sender=alice)
         
         scenario.h3("Alice transfers 10 tokens from Alice to Alice")
-        scenario += c1.transfer(fromAddr=alice, toAddr=alice, amount=10 * factor).run(sender=alice)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=alice, token_id=0, amount=10 * factor)])]).run(sender=alice)
+        
+        scenario.h3("Alice sends a batch of transfers to Bob and Jack")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor), sp.record(to_=jack, token_id=0, amount=2 * factor)])]).run(sender=alice)
+        
+        scenario.h3("Jack tries to send a batch of transfers from Alice")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=jack, token_id=0, amount=1 * factor)])]).run(sender=jack, valid=False)
+        
+        scenario.h3("Alice tries to send a batch of transfers exceeding her balance")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor), sp.record(to_=jack, token_id=0, amount=2000 * factor)])]).run(sender=alice, valid=False)
+        
+        scenario.h3("Alice sends a batch including a null amount, which FA2 requires to accept")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=0)])]).run(sender=alice)
+        
+        scenario.h3("Alice tries to transfer a token id that does not exist")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=1, amount=1 * factor)])]).run(sender=alice, valid=False)
+        
+        scenario.h3("Alice tries to add Bob as operator, operators are not supported")
+        scenario += c1.update_operators([sp.variant("add_operator", sp.record(owner=alice, operator=bob, token_id=0))]).run(sender=alice, valid=False)
         
         # test not available on smartpy
         # scenario.h3("Alice transfers 10 tokens from Alice to bad format address")
-        # scenario += c1.transfer(fromAddr=alice, toAddr="tz1LcuQHNVjk1QYZGNrf", amount=1 * factor).run(sender=alice, valid=False)
+        # scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_="tz1LcuQHNVjk1QYZGNrf", token_id=0, amount=1 * factor)])]).run(sender=alice, valid=False)
         
         scenario.h3("Jack tries to lock transfer function")
         scenario += c1.pauseTransfer().run(sender=jack, valid=False)
@@ -518,10 +1017,28 @@ if "templates" not in __name__:
         scenario += c1.pauseTransfer().run(sender=admin2)
         
         scenario.h3("Alice gets the current transfer status to verify it is False")
-        scenario += c1.getTransferStatus(target=alice).run(sender=alice)
+        scenario.show(c1.getTransferStatus())
         
         scenario.h3("Alice transfers 10 token from Alice to Bob")
-        scenario += c1.transfer(fromAddr=alice, toAddr=bob, amount=10 * factor).run(sender=alice, valid=False)
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])]).run(sender=alice, valid=False)
+        
+        scenario.h3("Alice tries to send a batch of transfers while transfer status is False")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor)])]).run(sender=alice, valid=False)
+        
+        scenario.h3("Admin2 sends a batch of transfers from Alice and Bob while transfer status is False")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor), sp.record(to_=jack, token_id=0, amount=1 * factor)]), sp.record(from_=bob, txs=[sp.record(to_=alice, token_id=0, amount=2 * factor)])]).run(sender=admin2)
+        
+        scenario.h3("Admin2 tries to send a batch of transfers including one from locked Jack")
+        scenario += c1.transfer([sp.record(from_=alice, txs=[sp.record(to_=bob, token_id=0, amount=1 * factor)]), sp.record(from_=jack, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=admin2, valid=False)
+        
+        scenario.h3("Bob reads the balances of Alice and Johndoe3 in one balance_of call")
+        consumer = BalanceOfConsumer()
+        scenario += consumer
+        scenario += c1.balance_of(requests=[sp.record(owner=alice, token_id=0), sp.record(owner=johndoe3, token_id=0)], callback=consumer.callback()).run(sender=bob)
+        scenario.verify_equal(consumer.data.responses, [sp.record(request=sp.record(owner=alice, token_id=0), balance=1106686000), sp.record(request=sp.record(owner=johndoe3, token_id=0), balance=0)])
+        
+        scenario.h3("Bob tries to read the balance of a token id that does not exist")
+        scenario += c1.balance_of(requests=[sp.record(owner=alice, token_id=1)], callback=consumer.callback()).run(sender=bob, valid=False)
         
         
         #############################
@@ -533,10 +1050,10 @@ if "templates" not in __name__:
         scenario += c1.burn(fromAddr=bob, amount=10 * factor).run(sender=jack, valid=False)
         
         scenario.h3("Get circulating supply to verify nothing has been burned")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Get supply limit to verify nothing has been burned")
-        scenario += c1.getSupplyLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSupplyLimit())
         
         scenario.h3("Alice burns 10 tokens owned by Alice")
         scenario += c1.burn(fromAddr=alice, amount=10 * factor).run(sender=alice)
@@ -545,19 +1062,19 @@ if "templates" not in __name__:
         scenario += c1.burn(fromAddr=bob, amount=2345600).run(sender=bob)
         
         scenario.h3("Alice gets balance of Alice to verify burned tokens")
-        scenario += c1.getBalance(owner=alice, target=alice).run(sender=alice)
+        scenario.show(c1.getBalance(alice))
         
         scenario.h3("Bob gets balance of Bob to verify burned tokens")
-        scenario += c1.getBalance(owner=bob, target=bob).run(sender=bob)
+        scenario.show(c1.getBalance(bob))
         
         scenario.h3("Get number of sold tokens to verify burn has no impact on sold tokens")
-        scenario += c1.getSoldToken(target=alice).run(sender=alice)
+        scenario.show(c1.getSoldToken())
         
         scenario.h3("Get circulating supply to verify it has been updated")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Get supply limit to verify it has been updated")
-        scenario += c1.getSupplyLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSupplyLimit())
         
         
         #############################
@@ -566,7 +1083,7 @@ if "templates" not in __name__:
         scenario += c1.mint(toAddr=jack, amount=1000 * factor).run(sender=jack, valid=False)
         
         scenario.h3("Get circulating supply to verify tokens have not been minted")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Admin2 mint 1000 tokens to Bob")
         scenario += c1.mint(toAddr=bob, amount=1000 * factor).run(sender=admin2)
@@ -577,57 +1094,96 @@ if "templates" not in __name__:
         scenario.h3("Admin2 mint 200 tokens to Jack (address is locked)")
         scenario += c1.mint(toAddr=jack, amount=200 * factor).run(sender=admin2)
         
+        scenario.h3("Jack tries to mint a batch of tokens to Jack and Bob")
+        scenario += c1.mintBatch([sp.record(toAddr=jack, amount=10 * factor), sp.record(toAddr=bob, amount=10 * factor)]).run(sender=jack, valid=False)
+        
+        scenario.h3("Admin2 mints a batch of 10 tokens to Bob, 20 tokens to Alice and 5 more tokens to Bob")
+        scenario += c1.mintBatch([sp.record(toAddr=bob, amount=10 * factor), sp.record(toAddr=alice, amount=20 * factor), sp.record(toAddr=bob, amount=5 * factor)]).run(sender=admin2)
+        
+        scenario.h3("Admin2 tries to mint a batch including a null amount")
+        scenario += c1.mintBatch([sp.record(toAddr=bob, amount=10 * factor), sp.record(toAddr=alice, amount=0)]).run(sender=admin2, valid=False)
+        
+        scenario.h3("Admin2 tries to mint a batch exceeding the supply limit")
+        scenario += c1.mintBatch([sp.record(toAddr=bob, amount=100000000 * factor), sp.record(toAddr=alice, amount=100000000 * factor)]).run(sender=admin2, valid=False)
+        
         scenario.h3("Get balance of Bob to verify tokens have been minted")
-        scenario += c1.getBalance(owner=bob, target=bob).run(sender=bob)
+        scenario.show(c1.getBalance(bob))
         
         scenario.h3("Get balance of Alice to verify tokens have been minted")
-        scenario += c1.getBalance(owner=alice, target=alice).run(sender=alice)
+        scenario.show(c1.getBalance(alice))
         
         scenario.h3("Get balance of Jack to verify tokens have not been minted")
-        scenario += c1.getBalance(owner=jack, target=jack).run(sender=jack)
+        scenario.show(c1.getBalance(jack))
         
         scenario.h3("Get circulating supply to verify it has been updated")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         scenario.h3("Get supply limit to verify it has been updated")
-        scenario += c1.getSupplyLimit(target=alice).run(sender=alice)
+        scenario.show(c1.getSupplyLimit())
         
         scenario.h3("Admin2 mint 199M tokens to Alice")
         scenario += c1.mint(toAddr=alice, amount=200000000 * factor).run(sender=admin2, valid=False)
         
         scenario.h3("Get circulating supply to verify it has not been updated")
-        scenario += c1.getCirculatingSupply(target=alice).run(sender=alice)
+        scenario.show(c1.getCirculatingSupply())
         
         
         #############################
         scenario.h2("Test dispatch royalties feature")
         scenario.h3("Jack tries to send royalties to CVR holders")
-        scenario += c1.dispatchRoyalties(addresses=[jack], amount= 100000000).run(sender=jack, amount=sp.tez(100), valid=False)
+        scenario += c1.dispatchRoyalties(addresses=[jack], amount=100000000, snapshotId=sp.none).run(sender=jack, amount=sp.tez(100), valid=False)
         
         # test not available on smartpy
         # scenario.h3("Admin2 tries to send royalties to CVR holders but do not have enough XTZ")
         # scenario += c1.dispatchRoyalties(addresses=[alice, bob]).run(sender=admin2, amount=sp.tez(100), valid=False)
         
         scenario.h3("Admin2 sends 100 XTZ royalties to alice, bob and jack")
-        scenario += c1.dispatchRoyalties(addresses=[alice, bob, jack], amount= 100000000).run(sender=admin2, amount=sp.tez(100))
+        scenario += c1.dispatchRoyalties(addresses=[alice, bob, jack], amount=100000000, snapshotId=sp.none).run(sender=admin2, amount=sp.tez(100))
         
         scenario.h3("Admin2 sends 12345.6789 XTZ royalties to Alice and Bob")
-        scenario += c1.dispatchRoyalties(addresses=[alice, bob], amount=12345678900).run(sender=admin2, amount=sp.mutez(12345678900))
+        scenario += c1.dispatchRoyalties(addresses=[alice, bob], amount=12345678900, snapshotId=sp.none).run(sender=admin2, amount=sp.mutez(12345678900))
         
         scenario.h3("Admin2 sends the rest of the 12345.6789 XTZ royalties to Jack")
-        scenario += c1.dispatchRoyalties(addresses=[jack], amount=12345678900).run(sender=admin2)
+        scenario += c1.dispatchRoyalties(addresses=[jack], amount=12345678900, snapshotId=sp.none).run(sender=admin2)
+        
+        scenario.h3("Jack tries to deposit royalties")
+        scenario += c1.depositRoyalties().run(sender=jack, amount=sp.tez(100), valid=False)
+        
+        scenario.h3("Admin2 deposits 100 XTZ royalties to be claimed by CVR holders")
+        scenario += c1.depositRoyalties().run(sender=admin2, amount=sp.tez(100))
+        
+        scenario.h3("Admin2 tries to claim 100 XTZ from sale, but part of the balance is reserved for royalties")
+        scenario += c1.claimSale(amount=100000000).run(sender=admin2, valid=False)
+        
+        scenario.h3("Admin2 tries to send royalties to alice, bob and jack out of the deposited royalties")
+        scenario += c1.dispatchRoyalties(addresses=[alice, bob, jack], amount=100000000, snapshotId=sp.none).run(sender=admin2, valid=False)
+        
+        scenario.h3("Admin2 sends 100 XTZ royalties to alice, bob and jack, the deposited royalties are left")
+        scenario += c1.dispatchRoyalties(addresses=[alice, bob, jack], amount=100000000, snapshotId=sp.none).run(sender=admin2, amount=sp.tez(100))
+        
+        scenario.h3("Admin2 mint 100 tokens to Bob, Bob's share of the previous deposit does not change")
+        scenario += c1.mint(toAddr=bob, amount=100 * factor).run(sender=admin2)
+        
+        scenario.h3("Jack claims the royalties of Alice, Bob and Jack")
+        scenario += c1.claimRoyalties([alice, bob, jack]).run(sender=jack)
+        
+        scenario.h3("Alice claims her royalties again, nothing is left to claim")
+        scenario += c1.claimRoyalties([alice]).run(sender=alice)
         
         
         #############################
         scenario.h2("Test features with non existing address in Big Map balances")
-        scenario.h3("Admin2 locks johndoe1's address")
-        scenario += c1.lockAddress(address=johndoe1).run(sender=admin2, valid=False)
+        scenario.h3("Admin2 locks johndoe1's address before it holds any token")
+        scenario += c1.lockAddress(address=johndoe1, until=sp.none).run(sender=admin2)
+        
+        scenario.h3("Admin2 unlocks johndoe1's address")
+        scenario += c1.unlockAddress(address=johndoe1).run(sender=admin2)
         
         scenario.h3("Admin2 unlocks johndoe2's address")
         scenario += c1.unlockAddress(address=johndoe2).run(sender=admin2, valid=False)
         
         scenario.h3("Get balance of Johndoe3")
-        scenario += c1.getBalance(owner=johndoe3, target=johndoe3).run(sender=johndoe3)
+        scenario.show(c1.getBalance(johndoe3))
         
         scenario.h3("Johndoe4 burns 10 tokens owned by Johndoe4")
         scenario += c1.burn(fromAddr=johndoe4, amount=10 * factor).run(sender=johndoe4, valid=False)
@@ -645,13 +1201,340 @@ if "templates" not in __name__:
         scenario += c1.cvrDrop(addresses=[johndoe7], amount=200 * factor).run(sender=admin2)
         
         scenario.h3("Admin2 sends 100 XTZ royalties to Johndoe8")
-        scenario += c1.dispatchRoyalties(addresses=[johndoe8], amount= 100000000).run(sender=admin2, amount=sp.tez(100))
+        scenario += c1.dispatchRoyalties(addresses=[johndoe8], amount=100000000, snapshotId=sp.none).run(sender=admin2, amount=sp.tez(100))
         
         scenario.h3("Admin2 unlock transfer function, set transfer status to True")
         scenario += c1.resumeTransfer().run(sender=admin2)
         
         scenario.h3("Johndoe9 transfers 10 token from Johndoe9 to Johndoe10")
-        scenario += c1.transfer(fromAddr=johndoe9, toAddr=johndoe10, amount=10 * factor).run(sender=johndoe9, valid=False)
+        scenario += c1.transfer([sp.record(from_=johndoe9, txs=[sp.record(to_=johndoe10, token_id=0, amount=10 * factor)])]).run(sender=johndoe9, valid=False)
         
         scenario.h3("Manager2 sales 1000 CVR to Johndoe11")
         scenario += c1.offchainSale(address=johndoe11, amount=1000000000).run(sender=manager2)
+        
+        
+        #############################
+        scenario.h2("Test permit feature")
+        signer = sp.test_account("Signer")
+        chainId = sp.chain_id_cst("0x9caecab9")
+        
+        def permit(account, counter, batch):
+            hash = sp.blake2b(sp.pack(sp.set_type_expr(batch, TRANSFER)))
+            message = sp.pack(sp.pair(sp.pair(chainId, c1.address), sp.pair(counter, hash)))
+            return sp.record(key=account.public_key, signature=sp.make_signature(account.secret_key, message, message_format="Raw"), hash=hash)
+        
+        toBob = sp.record(from_=signer.address, txs=[sp.record(to_=bob, token_id=0, amount=10 * factor)])
+        toJack = sp.record(from_=signer.address, txs=[sp.record(to_=jack, token_id=0, amount=20 * factor)])
+        
+        scenario.h3("Admin2 mint 100 tokens to Signer")
+        scenario += c1.mint(toAddr=signer.address, amount=100 * factor).run(sender=admin2)
+        
+        scenario.h3("Bob submits the permit of Signer for a transfer of 10 tokens to Bob")
+        scenario += c1.permit([permit(signer, 0, toBob)]).run(sender=bob, now=sp.timestamp(1000), chain_id=chainId)
+        
+        scenario.h3("Get the permit counter of Signer")
+        scenario.verify(c1.getPermitCounter(signer.address) == 1)
+        
+        scenario.h3("Jack tries to submit the same permit again, its counter has been used")
+        scenario += c1.permit([permit(signer, 0, toBob)]).run(sender=jack, now=sp.timestamp(1000), chain_id=chainId, valid=False)
+        
+        scenario.h3("Bob tries to transfer 20 tokens from Signer to Jack without a permit")
+        scenario += c1.transfer([toJack]).run(sender=bob, now=sp.timestamp(2000), valid=False)
+        
+        scenario.h3("Bob relays the transfer of Signer with one of his own")
+        scenario += c1.transfer([toBob, sp.record(from_=bob, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=bob, now=sp.timestamp(2000))
+        
+        scenario.h3("Bob tries to relay the transfer of Signer twice")
+        scenario += c1.transfer([toBob]).run(sender=bob, now=sp.timestamp(2000), valid=False)
+        
+        scenario.h3("Jack submits the permit of Signer for a transfer of 20 tokens to Jack")
+        scenario += c1.permit([permit(signer, 1, toJack)]).run(sender=jack, now=sp.timestamp(3000), chain_id=chainId)
+        
+        scenario.h3("Jack tries to relay the transfer after the permit has expired")
+        scenario += c1.transfer([toJack]).run(sender=jack, now=sp.timestamp(3000 + 24 * 3600), valid=False)
+        
+        scenario.h3("Bob submits two permits of Signer in one call, the expired one is replaced")
+        scenario += c1.permit([permit(signer, 2, toBob), permit(signer, 3, toJack)]).run(sender=bob, now=sp.timestamp(100000), chain_id=chainId)
+        
+        scenario.h3("Jack relays both transfers of Signer in one call")
+        scenario += c1.transfer([toBob, toJack]).run(sender=jack, now=sp.timestamp(100100))
+        
+        scenario.h3("Get balance of Signer to verify the relayed transfers")
+        scenario.verify(c1.getBalance(signer.address) == 60 * factor)
+        
+        
+        #############################
+        scenario.h2("Test batch of off-chain sales")
+        skippedSales = SkippedSalesConsumer()
+        scenario += skippedSales
+        
+        scenario.h3("Jack tries to send a batch of sales")
+        scenario += c1.offchainSaleBatch(sales=[sp.record(address=jack, amount=1 * factor)], skipLocked=True, callback=sp.none).run(sender=jack, valid=False)
+        
+        scenario.h3("Manager2 tries to send a batch of sales including locked Jack")
+        scenario += c1.offchainSaleBatch(sales=[sp.record(address=signer.address, amount=1 * factor), sp.record(address=jack, amount=2 * factor)], skipLocked=False, callback=sp.none).run(sender=manager2, valid=False)
+        
+        scenario.h3("Manager2 sends a batch of sales to Signer twice and Johndoe11, skipping locked Jack")
+        scenario += c1.offchainSaleBatch(sales=[sp.record(address=signer.address, amount=1 * factor), sp.record(address=jack, amount=2 * factor), sp.record(address=johndoe11, amount=3 * factor), sp.record(address=signer.address, amount=4 * factor)], skipLocked=True, callback=sp.some(skippedSales.callback())).run(sender=manager2)
+        
+        scenario.h3("Verify that Jack has been reported as skipped")
+        scenario.verify_equal(skippedSales.data.addresses, [jack])
+        
+        scenario.h3("Get balance of Signer to verify both sales")
+        scenario.verify(c1.getBalance(signer.address) == 65 * factor)
+        
+        scenario.h3("Manager2 tries to send a batch of sales exceeding the sale limit")
+        scenario += c1.offchainSaleBatch(sales=[sp.record(address=signer.address, amount=1 * factor), sp.record(address=johndoe11, amount=300000000 * factor)], skipLocked=True, callback=sp.none).run(sender=manager2, valid=False)
+        
+        
+        #############################
+        scenario.h2("Test snapshots")
+        scenario.h3("Jack tries to take a snapshot")
+        scenario += c1.snapshot().run(sender=jack, valid=False)
+        
+        scenario.h3("Admin2 takes a snapshot of the balances")
+        scenario += c1.snapshot().run(sender=admin2)
+        
+        scenario.h3("Get the id of the last snapshot")
+        scenario.verify(c1.getSnapshotId() == 1)
+        
+        scenario.h3("Signer transfers 5 tokens to Johndoe10 after the snapshot")
+        scenario += c1.transfer([sp.record(from_=signer.address, txs=[sp.record(to_=johndoe10, token_id=0, amount=5 * factor)])]).run(sender=signer.address)
+        
+        scenario.h3("Admin2 takes a second snapshot")
+        scenario += c1.snapshot().run(sender=admin2)
+        
+        scenario.h3("Signer transfers 5 more tokens to Johndoe10")
+        scenario += c1.transfer([sp.record(from_=signer.address, txs=[sp.record(to_=johndoe10, token_id=0, amount=5 * factor)])]).run(sender=signer.address)
+        
+        scenario.h3("Verify the balances at each snapshot while transfers go on")
+        scenario.verify(c1.balanceAt(sp.record(owner=signer.address, snapshotId=1)) == 65 * factor)
+        scenario.verify(c1.balanceAt(sp.record(owner=signer.address, snapshotId=2)) == 60 * factor)
+        scenario.verify(c1.getBalance(signer.address) == 55 * factor)
+        scenario.verify(c1.balanceAt(sp.record(owner=johndoe10, snapshotId=1)) == 0)
+        scenario.verify(c1.balanceAt(sp.record(owner=johndoe10, snapshotId=2)) == 5 * factor)
+        scenario.verify(c1.balanceAt(sp.record(owner=alice, snapshotId=1)) == c1.getBalance(alice))
+        
+        scenario.h3("Verify that transfers do not change the supply of the snapshots")
+        scenario.verify(c1.supplyAt(1) == c1.supplyAt(2))
+        
+        scenario.h3("Admin2 sends 100 XTZ royalties to Signer and Johndoe10 according to the first snapshot")
+        scenario += c1.dispatchRoyalties(addresses=[signer.address, johndoe10], amount=100000000, snapshotId=sp.some(1)).run(sender=admin2, amount=sp.tez(100))
+        
+        scenario.h3("Admin2 tries to send royalties according to a snapshot that has not been taken")
+        scenario += c1.dispatchRoyalties(addresses=[signer.address], amount=100000000, snapshotId=sp.some(3)).run(sender=admin2, amount=sp.tez(100), valid=False)
+        
+        
+        #############################
+        scenario.h2("Test bulk and timed locks")
+        scenario.h3("Jack tries to lock Signer and Johndoe10")
+        scenario += c1.lockAddresses(addresses=[signer.address, johndoe10], until=sp.none).run(sender=jack, valid=False)
+        
+        cohort1 = sp.test_account("Cohort1").address
+        cohort2 = sp.test_account("Cohort2").address
+        scenario.h3("Admin2 locks a vesting cohort until time 300000, before its tokens are minted")
+        scenario += c1.lockAddresses(addresses=[cohort1, cohort2], until=sp.some(sp.timestamp(300000))).run(sender=admin2, now=sp.timestamp(100000))
+        
+        scenario.h3("Admin2 mints the tokens of the cohort")
+        scenario += c1.mint(toAddr=cohort1, amount=10 * factor).run(sender=admin2)
+        
+        scenario.h3("Cohort1 tries to transfer 1 token before the end of its lock")
+        scenario += c1.transfer([sp.record(from_=cohort1, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=cohort1, now=sp.timestamp(299999), valid=False)
+        
+        scenario.h3("Cohort1 transfers 1 token once its lock has ended")
+        scenario += c1.transfer([sp.record(from_=cohort1, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=cohort1, now=sp.timestamp(300000))
+        
+        scenario.h3("Admin2 locks Signer and Johndoe10 until time 200000")
+        scenario += c1.lockAddresses(addresses=[signer.address, johndoe10], until=sp.some(sp.timestamp(200000))).run(sender=admin2, now=sp.timestamp(150000))
+        
+        scenario.h3("Johndoe10 tries to transfer 1 token before the end of the lock")
+        scenario += c1.transfer([sp.record(from_=johndoe10, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=johndoe10, now=sp.timestamp(199999), valid=False)
+        
+        scenario.h3("Manager2 tries to sell 1 token to locked Signer")
+        scenario += c1.offchainSale(address=signer.address, amount=1 * factor).run(sender=manager2, now=sp.timestamp(199999), valid=False)
+        
+        scenario.h3("Johndoe10 transfers 1 token once the lock has ended, without any unlock")
+        scenario += c1.transfer([sp.record(from_=johndoe10, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=johndoe10, now=sp.timestamp(200000))
+        
+        scenario.h3("Manager2 sells 1 token to Signer once the lock has ended")
+        scenario += c1.offchainSale(address=signer.address, amount=1 * factor).run(sender=manager2)
+        
+        scenario.h3("Admin2 locks Signer and Johndoe10 for good")
+        scenario += c1.lockAddresses(addresses=[signer.address, johndoe10], until=sp.none).run(sender=admin2)
+        
+        scenario.h3("Signer tries to transfer 1 token a year later")
+        scenario += c1.transfer([sp.record(from_=signer.address, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=signer.address, now=sp.timestamp(200000 + 365 * 24 * 3600), valid=False)
+        
+        scenario.h3("Jack tries to unlock Signer and Johndoe10")
+        scenario += c1.unlockAddresses([signer.address, johndoe10]).run(sender=jack, valid=False)
+        
+        scenario.h3("Admin2 unlocks Signer and Johndoe10")
+        scenario += c1.unlockAddresses([signer.address, johndoe10]).run(sender=admin2)
+        
+        scenario.h3("Signer transfers 1 token to Alice")
+        scenario += c1.transfer([sp.record(from_=signer.address, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=signer.address)
+        
+        scenario.h3("Admin2 locks Johndoe10 until a time already passed, which does not block it")
+        scenario += c1.lockAddress(address=johndoe10, until=sp.some(sp.timestamp(1000))).run(sender=admin2)
+        scenario += c1.transfer([sp.record(from_=johndoe10, txs=[sp.record(to_=alice, token_id=0, amount=1 * factor)])]).run(sender=johndoe10)
+        
+        scenario.h3("Verify the balances after the locks")
+        scenario.verify(c1.getBalance(johndoe10) == 8 * factor)
+        scenario.verify(c1.getBalance(signer.address) == 55 * factor)
+        
+        
+        #############################
+        scenario.h2("Test the holder registry")
+        c2 = CVR(owner, admin1, manager1, octopus, covir)
+        scenario += c2
+        
+        scenario.h3("Admin1 mints tokens to Alice, Bob and Jack, numbered in that order")
+        scenario += c2.mint(toAddr=alice, amount=10 * factor).run(sender=admin1)
+        scenario += c2.mint(toAddr=bob, amount=20 * factor).run(sender=admin1)
+        scenario += c2.mint(toAddr=jack, amount=30 * factor).run(sender=admin1)
+        scenario += c2.mint(toAddr=alice, amount=5 * factor).run(sender=admin1)
+        scenario.verify(c2.getHolderCount() == 3)
+        scenario.verify_equal(c2.holders(sp.record(offset=0, limit=2)), [sp.record(address=alice, balance=15 * factor), sp.record(address=bob, balance=20 * factor)])
+        scenario.verify_equal(c2.holders(sp.record(offset=2, limit=2)), [sp.record(address=jack, balance=30 * factor)])
+        scenario.verify_equal(c2.holders(sp.record(offset=3, limit=2)), [])
+        
+        scenario.h3("Admin1 takes a snapshot")
+        scenario += c2.snapshot().run(sender=admin1)
+        
+        scenario.h3("Alice transfers all her tokens to Jack, who takes her number")
+        scenario += c2.resumeTransfer().run(sender=admin1)
+        scenario += c2.transfer([sp.record(from_=alice, txs=[sp.record(to_=jack, token_id=0, amount=15 * factor)])]).run(sender=alice)
+        scenario.verify(c2.getHolderCount() == 2)
+        scenario.verify_equal(c2.holders(sp.record(offset=0, limit=10)), [sp.record(address=jack, balance=45 * factor), sp.record(address=bob, balance=20 * factor)])
+        
+        scenario.h3("Verify the balance of emptied Alice at the snapshot")
+        scenario.verify(c2.balanceAt(sp.record(owner=alice, snapshotId=1)) == 15 * factor)
+        
+        scenario.h3("Bob, the last holder, burns all his tokens")
+        scenario += c2.burn(fromAddr=bob, amount=20 * factor).run(sender=bob)
+        scenario.verify(c2.getHolderCount() == 1)
+        scenario.verify_equal(c2.holders(sp.record(offset=0, limit=10)), [sp.record(address=jack, balance=45 * factor)])
+        
+        scenario.h3("Jack transfers all his tokens to himself and some back to Alice")
+        scenario += c2.transfer([sp.record(from_=jack, txs=[sp.record(to_=jack, token_id=0, amount=45 * factor)]),
+                                 sp.record(from_=jack, txs=[sp.record(to_=alice, token_id=0, amount=0), sp.record(to_=alice, token_id=0, amount=5 * factor)])]).run(sender=jack)
+        scenario.verify_equal(c2.holders(sp.record(offset=0, limit=10)), [sp.record(address=jack, balance=40 * factor), sp.record(address=alice, balance=5 * factor)])
+        scenario.verify(c2.balanceAt(sp.record(owner=alice, snapshotId=1)) == 15 * factor)
+        scenario.verify(c2.balanceAt(sp.record(owner=bob, snapshotId=1)) == 20 * factor)
+        scenario.verify(c2.balanceAt(sp.record(owner=jack, snapshotId=1)) == 30 * factor)
+    
+    
+    # Load scenarios: thousands of generated holders go through sales, airdrops,
+    # transfers, burns and royalties, and the supply counters are checked after
+    # each phase. The list entry points get lists as long as the number of
+    # holders, so raising the size shows how the contract scales; the largest
+    # lists accepted within the gas and size limits are measured by bench.py.
+    LOAD_SIZES = [(100, True), (1000, False), (10000, False)]
+    
+    def syntheticAddress(i):
+        import hashlib
+        alphabet = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+        data = b"\x06\xa1\x9f" + hashlib.blake2b(b"cvr-load-%d" % i, digest_size=20).digest()
+        data += hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+        n = int.from_bytes(data, "big")
+        text = ""
+        while n:
+            n, r = divmod(n, 58)
+            text = alphabet[r] + text
+        return sp.address(text)
+    
+    def loadTest(size):
+        def test():
+            import random
+            rng = random.Random(size)
+            scenario = sp.test_scenario()
+            scenario.h1("CVR Contract load: %d holders" % size)
+            
+            owner = sp.address("tz1gVUyZjBWYckSfJN5VscLjVtDaiLmtoPnY")
+            admin = sp.address("tz1fiqSBD4eXoquuFSfNqmfvnbJvUYSHd65c")
+            manager = sp.address("tz1L5f3ZodeseeyuARJvya3WeHcorEdMhs3P")
+            octopus = sp.address("tz1aNuXU5LAkrcBr4zDa7ARoUsTYBbbmW53Q")
+            covir = sp.address("tz1VCb95XH3jgyiQCrYF65DBAyujWbVSU2k8")
+            holders = [syntheticAddress(i) for i in range(size)]
+            factor = 1000000
+            
+            c1 = CVR(owner, admin, manager, octopus, covir)
+            scenario += c1
+            
+            # expected state, updated along the scenario
+            balances = {holder: 0 for holder in holders}
+            totals = {"circulatingSupply": 0, "soldToken": 0, "supplyLimit": 400000000 * factor}
+            
+            def verifyTotals():
+                scenario.verify(c1.getCirculatingSupply() == totals["circulatingSupply"])
+                scenario.verify(c1.getSoldToken() == totals["soldToken"])
+                scenario.verify(c1.getSupplyLimit() == totals["supplyLimit"])
+                scenario.verify(c1.getHolderCount() == len([holder for holder in holders if balances[holder] > 0]))
+                for holder in holders[::max(1, size // 20)]:
+                    scenario.verify(c1.getBalance(holder) == balances[holder])
+            
+            def sold(address, amount):
+                balances[address] += amount
+                totals["circulatingSupply"] += amount
+                totals["soldToken"] += amount
+            
+            scenario.h2("Sales")
+            scenario += c1.resumeSale().run(sender=admin)
+            for holder in holders[0::4]:
+                mutez = rng.randrange(1, 100) * factor
+                scenario += c1.sale().run(sender=holder, amount=sp.mutez(mutez))
+                sold(holder, mutez)
+            for holder in holders[1::4]:
+                amount = rng.randrange(1, 100) * factor
+                scenario += c1.offchainSale(address=holder, amount=amount).run(sender=manager)
+                sold(holder, amount)
+            sales = [(holder, rng.randrange(1, 100) * factor) for holder in holders[2::4]]
+            scenario += c1.offchainSaleBatch(sales=[sp.record(address=holder, amount=amount) for holder, amount in sales], skipLocked=False, callback=sp.none).run(sender=manager)
+            for holder, amount in sales:
+                sold(holder, amount)
+            verifyTotals()
+            
+            scenario.h2("Airdrop")
+            airdropped = holders[3::4] + holders[0::8]
+            scenario += c1.cvrDrop(addresses=airdropped, amount=10 * factor).run(sender=admin)
+            for holder in airdropped:
+                balances[holder] += 10 * factor
+                totals["circulatingSupply"] += 10 * factor
+            verifyTotals()
+            
+            scenario.h2("Transfers")
+            scenario += c1.resumeTransfer().run(sender=admin)
+            for _ in range(size):
+                fromAddr = holders[rng.randrange(size)]
+                toAddr = holders[rng.randrange(size)]
+                amount = rng.randrange(balances[fromAddr] + 1)
+                scenario += c1.transfer([sp.record(from_=fromAddr, txs=[sp.record(to_=toAddr, token_id=0, amount=amount)])]).run(sender=fromAddr)
+                balances[fromAddr] -= amount
+                balances[toAddr] += amount
+            richest = max(holders, key=lambda holder: balances[holder])
+            scenario += c1.transfer([sp.record(from_=richest, txs=[sp.record(to_=holder, token_id=0, amount=1) for holder in holders])]).run(sender=richest, valid=balances[richest] >= size)
+            if balances[richest] >= size:
+                for holder in holders:
+                    balances[holder] += 1
+                balances[richest] -= size
+            verifyTotals()
+            
+            scenario.h2("Burns")
+            for holder in holders[::10]:
+                amount = balances[holder] // 2
+                scenario += c1.burn(fromAddr=holder, amount=amount).run(sender=holder, valid=balances[holder] > 0)
+                if balances[holder] > 0:
+                    balances[holder] -= amount
+                    totals["circulatingSupply"] -= amount
+                    totals["supplyLimit"] -= amount
+            verifyTotals()
+            
+            scenario.h2("Royalties")
+            scenario += c1.dispatchRoyalties(addresses=holders, amount=size * 1000, snapshotId=sp.none).run(sender=admin, amount=sp.mutez(size * 1000))
+            scenario += c1.depositRoyalties().run(sender=admin, amount=sp.mutez(size * 1000))
+            scenario += c1.claimRoyalties(holders[::2]).run(sender=owner)
+            verifyTotals()
+        return test
+    
+    for size, isDefault in LOAD_SIZES:
+        sp.add_test(name="CVR load %d" % size, is_default=isDefault)(loadTest(size))
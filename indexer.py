@@ -0,0 +1,441 @@
+"""Holder index of the CVR contract, kept up to date from big_map diffs.
+
+Blocks are read from a node RPC or from local JSON files (the output of
+``GET /chains/main/blocks/<level>``), and the ``lazy_storage_diff`` (or legacy
+``big_map_diff``) of every operation applied to the contract is replayed on a
+snapshot of ``(address, balance, lock)``. The snapshot is an open addressing
+hash table of fixed size records in a memory-mapped file, so a lookup or an
+update touches a single record. When it is half full, the table is rehashed
+into a file twice as large, which then replaces it. The contract totals are
+read from the storage returned by the last operation.
+
+After each block the snapshot is flushed and ``checkpoint.json`` is rewritten,
+and a restart resumes from the next level. Diffs carry the new values, not
+deltas, so a block interrupted before its checkpoint can be replayed over the
+records it already changed; the sum of the balances, which is kept up to date
+by deltas, is therefore computed again from the table when it is opened.
+
+Usage::
+
+    python indexer.py KT1... snapshotdir --rpc http://localhost:8732 [--to LEVEL]
+    python indexer.py KT1... snapshotdir --files blocks/*.json
+    python indexer.py KT1... snapshotdir --top 100 | --above 1000000 [--now TIME] | --reconcile
+    python indexer.py KT1... snapshotdir --dump holders.packed
+    python indexer.py KT1... newdir --load holders.packed --from LEVEL --rpc ...
+
+Each record keeps the lock of its address and the time the lock ends at, if
+any; the holders listed by ``--top`` and ``--above`` are shown locked while
+their lock has not ended at ``--now`` (the current time by default).
+
+A dump is the packed ``map address (pair (int %balance) (pair (bool %lock)
+(option %until timestamp)))`` of the holders, read back with the binary
+decoder of ``micheline.py``; a loaded snapshot must then follow the blocks from
+the level it was dumped at.
+
+``numpy``, when installed, is used to answer the queries on the whole table.
+"""
+
+import argparse
+import datetime
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+import urllib.request
+
+from micheline import (decode, decode_address, encode_address, field_paths, forge_int, iter_balances, parse,
+                       script_section)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# address, balance, end of the lock, lock (UNLOCKED, LOCKED for good or LOCKED_UNTIL) and whether the slot is used
+RECORD = struct.Struct("<22sqqBB")
+ADDRESS_SIZE = 22
+INITIAL_CAPACITY = 1 << 16
+UNLOCKED, LOCKED, LOCKED_UNTIL = 0, 1, 2
+TOTALS = ("circulatingSupply", "soldToken", "saleLimit", "supplyLimit", "reservedSupply")
+DUMP_TYPE = {"prim": "map", "args": [{"prim": "address"}, {"prim": "pair", "args": [
+    {"prim": "int", "annots": ["%balance"]}, {"prim": "pair", "args": [
+        {"prim": "bool", "annots": ["%lock"]}, {"prim": "option", "args": [{"prim": "timestamp"}], "annots": ["%until"]}]}]}]}
+
+
+def timestamp(text):
+    """Seconds since the epoch of a number of seconds or an ISO 8601 time (UTC if no offset)."""
+    if isinstance(text, int) or text.lstrip("-").isdigit():
+        return int(text)
+    value = datetime.datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return int(value.timestamp())
+
+
+def lock_value(flag, until, now=None):
+    """The lock of a record: ``False``, ``True`` for good, or the time it ends, ``False`` once ended at ``now``."""
+    if flag == LOCKED:
+        return True
+    if flag == LOCKED_UNTIL and (now is None or now < until):
+        return until
+    return False
+
+
+class Snapshot:
+    """Memory-mapped table of ``address -> (balance, lock)``.
+
+    The lock is ``False``, ``True`` for a lock for good, or the time the lock
+    ends at, in seconds. Addresses that no longer hold tokens keep their
+    record with a zero balance; they are skipped by the queries. A
+    ``readonly`` snapshot must exist and can only be queried.
+    """
+
+    def __init__(self, path, capacity=INITIAL_CAPACITY, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly and not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.truncate(capacity * RECORD.size)
+        self._open()
+
+    def _open(self):
+        self.file = open(self.path, "rb" if self.readonly else "r+b")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ if self.readonly else mmap.ACCESS_WRITE)
+        self.capacity = len(self.map) // RECORD.size
+        self.used = sum(1 for record in RECORD.iter_unpack(self.map) if record[4])
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def flush(self):
+        self.map.flush()
+
+    def _slot(self, key, table=None):
+        table = self.map if table is None else table
+        mask = len(table) // RECORD.size - 1
+        slot = int.from_bytes(key[4:12], "little") & mask
+        while True:
+            record = RECORD.unpack_from(table, slot * RECORD.size)
+            if not record[4] or record[0] == key:
+                return slot, record
+            slot = (slot + 1) & mask
+
+    @staticmethod
+    def _key(address):
+        return address if isinstance(address, bytes) else encode_address(address)
+
+    def get(self, address, now=None):
+        """``(balance, lock)`` of ``address`` (base58 or binary), ``(0, False)`` if unknown.
+
+        With ``now``, a lock ended at that time is ``False``.
+        """
+        _, record = self._slot(self._key(address))
+        return (record[1], lock_value(record[3], record[2], now)) if record[4] else (0, False)
+
+    def set(self, address, balance, lock):
+        key = self._key(address)
+        slot, record = self._slot(key)
+        if not record[4]:
+            if 2 * (self.used + 1) > self.capacity:
+                self._grow()
+                slot, record = self._slot(key)
+            self.used += 1
+        if lock is False:
+            flag, until = UNLOCKED, 0
+        elif lock is True:
+            flag, until = LOCKED, 0
+        else:
+            flag, until = LOCKED_UNTIL, lock
+        RECORD.pack_into(self.map, slot * RECORD.size, key, balance, until, flag, 1)
+
+    def _grow(self):
+        # the larger table is complete on disk before it replaces the current one
+        path = self.path + ".tmp"
+        with open(path, "w+b") as f:
+            f.truncate(2 * self.capacity * RECORD.size)
+            with mmap.mmap(f.fileno(), 0) as table:
+                for record in RECORD.iter_unpack(self.map):
+                    if record[4]:
+                        slot, _ = self._slot(record[0], table)
+                        RECORD.pack_into(table, slot * RECORD.size, *record)
+                table.flush()
+            os.fsync(f.fileno())
+        self.close()
+        os.replace(path, self.path)
+        self._open()
+
+    def _array(self):
+        dtype = numpy.dtype([("address", "S22"), ("balance", "<i8"), ("until", "<i8"), ("lock", "u1"), ("used", "u1")])
+        return numpy.frombuffer(self.map, dtype=dtype)
+
+    def _holders(self, records, now):
+        return [(decode_address(r["address"].ljust(ADDRESS_SIZE, b"\0")), int(r["balance"]),
+                 lock_value(int(r["lock"]), int(r["until"]), now)) for r in records]
+
+    def holders(self, minimum=1, now=None):
+        """``(address, balance, lock)`` of every holder with at least ``minimum`` tokens, locks as in ``get``."""
+        if numpy is not None:
+            table = self._array()
+            return self._holders(table[table["balance"] >= minimum], now)
+        return [(decode_address(key), balance, lock_value(lock, until, now))
+                for key, balance, until, lock, used in RECORD.iter_unpack(self.map) if used and balance >= minimum]
+
+    def top(self, count, now=None):
+        """The ``count`` largest holders, largest first."""
+        if numpy is not None:
+            table = self._array()
+            count = min(count, len(table))
+            if not count:
+                return []
+            indexes = numpy.argpartition(table["balance"], -count)[-count:]
+            selected = table[indexes[numpy.argsort(-table["balance"][indexes], kind="stable")]]
+            return self._holders(selected[selected["balance"] > 0], now)
+        return sorted(self.holders(now=now), key=lambda holder: -holder[1])[:count]
+
+    def total(self):
+        """Sum of the balances."""
+        if numpy is not None:
+            return int(self._array()["balance"].sum())
+        return sum(record[1] for record in RECORD.iter_unpack(self.map))
+
+    def dump(self, f):
+        """Write the holders to ``f`` as a packed ``DUMP_TYPE`` map."""
+        records = sorted(record[:4] for record in RECORD.iter_unpack(self.map) if record[4] and record[1] > 0)
+        body = b"".join(b"\x07\x04\x0a\x00\x00\x00\x16" + key + b"\x07\x07\x00" + forge_int(balance)
+                        + b"\x07\x07" + (b"\x03\x03\x03\x06" if flag == UNLOCKED else b"\x03\x0a\x03\x06" if flag == LOCKED
+                                           else b"\x03\x0a\x05\x09\x00" + forge_int(until))
+                        for key, balance, until, flag in records)
+        f.write(b"\x05\x02" + len(body).to_bytes(4, "big") + body)
+
+    def load(self, data):
+        """Add the holders of a packed ``DUMP_TYPE`` map; ``(holders, total balance)``."""
+        count = total = 0
+        for address, balance, lock in iter_balances(DUMP_TYPE, data):
+            self.set(address, balance, lock)
+            count += 1
+            total += balance
+        return count, total
+
+
+class Indexer:
+    """Index of ``contract`` kept in ``directory``; ``readonly`` opens an existing one for queries only."""
+
+    def __init__(self, contract, directory, script_path=None, readonly=False):
+        self.contract = contract
+        self.directory = directory
+        self.checkpoint_path = os.path.join(directory, "checkpoint.json")
+        if readonly and not os.path.exists(self.checkpoint_path):
+            raise FileNotFoundError("no snapshot in %s" % directory)
+        if not readonly:
+            os.makedirs(directory, exist_ok=True)
+        self.snapshot = Snapshot(os.path.join(directory, "holders.bin"), readonly=readonly)
+        self.state = {"level": None, "hash": None, "balances": None, "locks": None, "totals": {}, "holdersTotal": 0,
+                      "storageType": None}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.state.update(json.load(f))
+        # the snapshot may hold part of a block applied after the checkpoint
+        self.state["holdersTotal"] = self.snapshot.total()
+        if script_path is not None:
+            with open(script_path) as f:
+                self.set_script(parse(f.read()))
+        self._types()
+
+    def set_script(self, script):
+        """Take the storage type from the script of the contract, parsed or as in an RPC ``code``."""
+        self.state["storageType"] = script_section(script, "storage")
+        self._types()
+
+    def _types(self):
+        self.storage_type = self.state["storageType"]
+        if self.storage_type is not None:
+            paths = field_paths(self.storage_type)
+            self.balance_field = "accounts" if "accounts" in paths else "balances"
+            self.balance_type = paths[self.balance_field][1]["args"][1]
+            self.lock_type = paths["locks"][1]["args"][1] if "locks" in paths else None
+
+    @property
+    def level(self):
+        return self.state["level"]
+
+    def results(self, block):
+        """``(content, result)`` of every operation of ``block``, internal ones included."""
+        for operations in block["operations"]:
+            for operation in operations:
+                for content in operation.get("contents", []):
+                    metadata = content.get("metadata", {})
+                    if "operation_result" in metadata:
+                        yield content, metadata["operation_result"]
+                    for internal in metadata.get("internal_operation_results", []):
+                        yield internal, internal["result"]
+
+    def apply_block(self, block):
+        level = block["header"]["level"]
+        if self.level is not None:
+            if level <= self.level:
+                return False
+            if (level == self.level + 1 and self.state["hash"] is not None
+                    and block["header"]["predecessor"] != self.state["hash"]):
+                raise ValueError("block %d does not follow %s (reorganisation)" % (level, self.state["hash"]))
+        for content, result in self.results(block):
+            if result.get("status") != "applied":
+                continue
+            if content.get("kind") == "origination" and self.contract in result.get("originated_contracts", []):
+                self.set_script(content["script"]["code"])
+                self.apply_storage(content["script"]["storage"])
+            elif content.get("destination") == self.contract:
+                self.apply_storage(result["storage"])
+            else:
+                continue
+            self.apply_diffs(result)
+        self.snapshot.flush()
+        self.state.update(level=level, hash=block["hash"])
+        path = self.checkpoint_path + ".tmp"
+        with open(path, "w") as f:
+            json.dump(self.state, f)
+        os.replace(path, self.checkpoint_path)
+        return True
+
+    def apply_storage(self, node):
+        if self.storage_type is None:
+            raise ValueError("unknown storage type of %s: give its --script, an --rpc or the block of its origination"
+                             % self.contract)
+        storage = decode(self.storage_type, node)
+        for name, field in (("balances", self.balance_field), ("locks", "locks")):
+            if isinstance(storage.get(field), int):
+                self.state[name] = storage[field]
+        self.state["totals"] = {name: storage[name] for name in TOTALS if name in storage}
+
+    def apply_diffs(self, result):
+        handlers = {self.state["balances"]: self.apply_balance, self.state["locks"]: self.apply_lock}
+        for diff in result.get("lazy_storage_diff", []):
+            handler = handlers.get(int(diff["id"])) if diff["kind"] == "big_map" else None
+            if handler is not None:
+                for update in diff["diff"].get("updates", []):
+                    handler(update["key"], update.get("value"))
+        for diff in result.get("big_map_diff", []):
+            handler = handlers.get(int(diff["big_map"])) if diff["action"] == "update" else None
+            if handler is not None:
+                handler(diff["key"], diff.get("value"))
+
+    def apply_balance(self, key, value):
+        address = self._address(key)
+        old, lock = self.snapshot.get(address)
+        balance = 0 if value is None else decode(self.balance_type, value)
+        if isinstance(balance, dict):
+            # an account, or the balance and lock record of the layout before
+            # the separate locks big_map
+            balance, lock = balance["balance"], balance.get("lock", lock)
+        elif value is None and self.state["locks"] is None:
+            lock = False
+        self.snapshot.set(address, balance, lock)
+        self.state["holdersTotal"] += balance - old
+
+    def apply_lock(self, key, value):
+        address = self._address(key)
+        balance, _ = self.snapshot.get(address)
+        lock = False
+        if value is not None:
+            # an option timestamp: None for a lock for good
+            until = decode(self.lock_type, value)
+            lock = True if until is None else timestamp(until)
+        self.snapshot.set(address, balance, lock)
+
+    @staticmethod
+    def _address(key):
+        return bytes.fromhex(key["bytes"]) if "bytes" in key else key["string"]
+
+    def reconcile(self):
+        """``(sum of the balances, circulatingSupply)``; they must be equal."""
+        return self.state["holdersTotal"], self.state["totals"].get("circulatingSupply")
+
+    def close(self):
+        self.snapshot.close()
+
+
+def rpc_get(url, path):
+    with urllib.request.urlopen(url.rstrip("/") + path) as response:
+        return json.load(response)
+
+
+def rpc_blocks(url, start, end=None):
+    if end is None:
+        end = rpc_get(url, "/chains/main/blocks/head/header")["level"]
+    for level in range(start, end + 1):
+        yield rpc_get(url, "/chains/main/blocks/%d" % level)
+
+
+def file_blocks(paths):
+    blocks = []
+    for path in paths:
+        with open(path) as f:
+            blocks.append(json.load(f))
+    return sorted(blocks, key=lambda block: block["header"]["level"])
+
+
+def lock_text(lock):
+    if lock is False:
+        return ""
+    if lock is True:
+        return " locked"
+    return " locked until %s" % datetime.datetime.fromtimestamp(lock, datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("contract")
+    parser.add_argument("directory")
+    parser.add_argument("--script", help="script of the contract (read from --rpc or its origination by default)")
+    parser.add_argument("--rpc")
+    parser.add_argument("--from", dest="start", type=int, default=0, help="first level when there is no checkpoint")
+    parser.add_argument("--to", dest="end", type=int)
+    parser.add_argument("--files", nargs="*", default=[])
+    parser.add_argument("--top", type=int)
+    parser.add_argument("--above", type=int)
+    parser.add_argument("--now", type=timestamp, help="time the locks are compared with (now by default)")
+    parser.add_argument("--reconcile", action="store_true")
+    parser.add_argument("--dump", help="write the holders to this file")
+    parser.add_argument("--load", help="start the snapshot from a dump (at the level before --from)")
+    args = parser.parse_args(argv)
+
+    indexer = Indexer(args.contract, args.directory, args.script)
+    if args.load:
+        if indexer.level is not None:
+            parser.error("--load needs a new snapshot directory")
+        with open(args.load, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            _, indexer.state["holdersTotal"] = indexer.snapshot.load(data)
+        indexer.state["level"] = args.start - 1
+    if args.rpc and indexer.storage_type is None:
+        indexer.set_script(rpc_get(args.rpc, "/chains/main/blocks/head/context/contracts/%s/script" % args.contract)["code"])
+    if args.rpc:
+        start = args.start if indexer.level is None else indexer.level + 1
+        blocks = rpc_blocks(args.rpc, start, args.end)
+    else:
+        blocks = file_blocks(args.files)
+    for block in blocks:
+        indexer.apply_block(block)
+    now = int(time.time()) if args.now is None else args.now
+    if args.top is not None:
+        for address, balance, lock in indexer.snapshot.top(args.top, now):
+            print("%s %d%s" % (address, balance, lock_text(lock)))
+    if args.above is not None:
+        for address, balance, lock in indexer.snapshot.holders(args.above + 1, now):
+            print("%s %d%s" % (address, balance, lock_text(lock)))
+    if args.dump:
+        with open(args.dump, "wb") as f:
+            indexer.snapshot.dump(f)
+    status = 0
+    if args.reconcile:
+        holders, supply = indexer.reconcile()
+        print("level %s: holders %d, circulatingSupply %s" % (indexer.level, holders, supply))
+        status = 0 if holders == supply else 1
+    indexer.close()
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
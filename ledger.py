@@ -0,0 +1,905 @@
+"""Pure-Python reference model of the CVR contract.
+
+``Ledger`` implements every entry point and view of ``cvr.CVR`` with the same
+checks, integer rounding and state changes, without SmartPy, so what-if and
+load simulations can run hundreds of thousands of operations per second. A
+failed call raises ``Failure`` and leaves the ledger unchanged, like a failed
+operation.
+
+Running this module replays the test scenarios of ``cvr.py`` against the model
+and fails if a step's outcome differs from the ``valid`` flag expected by the
+scenario or if a ``scenario.verify`` does not hold. The model is checked
+against these expectations only, not against the compiled contract: a run of
+the same scenarios by SmartPy is needed for that::
+
+    python ledger.py            # replay of the cvr.py scenarios
+    python ledger.py --bench    # transfers per second, through call() and transfers()
+"""
+
+import os
+import sys
+import textwrap
+import time
+
+from airdrop import leaf_hash, node_hash
+from micheline import (IMPLICIT_PREFIXES, b58check_encode, blake2b, check_signature, encode, encode_address, key_address,
+                       pack, parse, public_key, secret_key, sign)
+
+
+FACTOR = 10**6
+RATIO = 1
+ROYALTY_SCALE = 10**18
+ROYALTY_ROUNDING = 10**10
+TOKEN_ID = 0
+PERMIT_EXPIRY = 24 * 3600
+MAX_PERMITS = 32
+# what a permit signs, and the transfer group whose hash it carries
+PERMIT_MESSAGE_TYPE = parse("pair (pair chain_id address) (pair nat bytes)")
+# parameters of the entry points called by the off-chain tools, as cvr.py types
+# them
+ENTRYPOINT_TYPES = {name: parse(text) for name, text in (
+    ("transfer", "list (pair (address %from_) (list %txs (pair (address %to_) (pair (nat %token_id) (nat %amount)))))"),
+    ("offchainSale", "pair (address %address) (nat %amount)"),
+    ("offchainSaleBatch", "pair (list %sales (pair (address %address) (nat %amount)))"
+                          " (pair (bool %skipLocked) (option %callback (contract (list address))))"),
+    ("mintBatch", "list (pair (nat %amount) (address %toAddr))"),
+    ("cvrDrop", "pair (list %addresses address) (nat %amount)"),
+    ("lockAddress", "pair (address %address) (option %until timestamp)"),
+    ("lockAddresses", "pair (list %addresses address) (option %until timestamp)"),
+    ("unlockAddresses", "list address"),
+    ("dispatchRoyalties", "pair (list %addresses address) (pair (nat %amount) (option %snapshotId nat))"),
+    ("claimSale", "nat"),
+)}
+TRANSFER_TYPE = ENTRYPOINT_TYPES["transfer"]["args"][0]
+# the address of the contract in SmartPy test scenarios, and the main chain id
+CONTRACT_ADDRESS = "KT1TezoooozzSmartPyzzSTATiCzzzwwBFA1"
+CHAIN_ID = "NetXdQprcVkpaWU"
+
+
+class Failure(Exception):
+    pass
+
+
+class Account:
+    __slots__ = ("balance", "owed", "paid", "checkpoint", "position")
+
+    def __init__(self, balance, owed, paid, checkpoint=0, position=0):
+        self.balance = balance
+        self.owed = owed
+        self.paid = paid
+        self.checkpoint = checkpoint
+        self.position = position
+
+
+class Record(dict):
+    """Minimal ``sp.record``: a dict with attribute access."""
+
+    __getattr__ = dict.__getitem__
+
+
+class Ledger:
+    def __init__(self, owner, admin, manager, octo, covir):
+        # the contract's accounts, kept here when they are emptied: the contract
+        # deletes an account whose balance, owed royalties and checkpoint are 0
+        self.accounts = {}
+        # the holders registry: addresses with a non-zero balance by number (the
+        # number of each is the position of its account)
+        self.holderList = []
+        # address -> end of the lock, None for a lock for good
+        self.locks = {}
+        self.royaltyPerToken = 0
+        self.administrator = admin
+        self.transferStatus = False
+        self.saleStatus = False
+        self.circulatingSupply = 0
+        self.soldToken = 0
+        self.saleLimit = 200000000 * FACTOR
+        self.supplyLimit = 400000000 * FACTOR
+        self.reservedSupply = 0
+        self.saleManager = manager
+        self.owner = owner
+        self.octopus = octo
+        self.covir = covir
+        self.royaltyReserve = 0
+        self.airdropCount = 0
+        self.airdrops = {}
+        self.airdropClaims = {}
+        # circulating supply at each snapshot, and (balance, previous checkpoint)
+        # of each (address, snapshot id) checkpoint
+        self.snapshotId = 0
+        self.snapshots = {}
+        self.checkpoints = {}
+        # counter and {hash: expiry} of the permits of each address
+        self.permits = {}
+        # context of the calls: contract address, chain id and time in seconds
+        self.address = CONTRACT_ADDRESS
+        self.chainId = CHAIN_ID
+        self.now = 0
+        # XTZ held by the contract, in mutez, and the XTZ it sent
+        self.xtzBalance = 0
+        self.sent = []
+
+    def call(self, entry_point, params, sender, amount=0):
+        """Run an entry point the way an operation would; ``amount`` is in mutez."""
+        method = ENTRY_POINTS.get(entry_point)
+        if method is None:
+            raise AttributeError("no entry point %s" % entry_point)
+        if not amount:
+            return method(self, sender, 0, params)
+        self.xtzBalance += amount
+        try:
+            method(self, sender, amount, params)
+        except Failure:
+            self.xtzBalance -= amount
+            raise
+
+    @staticmethod
+    def _verify(condition, message):
+        if not condition:
+            raise Failure(message)
+
+    def _account(self, address):
+        account = self.accounts.get(address)
+        if account is None:
+            account = self.accounts[address] = Account(0, 0, self.royaltyPerToken)
+        return account
+
+    def _settle(self, address, account):
+        if account.checkpoint < self.snapshotId:
+            self.checkpoints[address, self.snapshotId] = (account.balance, account.checkpoint)
+            account.checkpoint = self.snapshotId
+        rpt = self.royaltyPerToken
+        if account.paid != rpt:
+            account.owed += account.balance * (rpt - account.paid) // ROYALTY_SCALE
+            account.paid = rpt
+
+    def _credit(self, address, amount):
+        account = self._account(address)
+        if amount > 0:
+            self._settle(address, account)
+            if account.balance == 0:
+                self._addHolder(address)
+            account.balance += amount
+
+    def _addHolder(self, address):
+        self.accounts[address].position = len(self.holderList)
+        self.holderList.append(address)
+
+    def _removeHolder(self, address):
+        position = self.accounts[address].position
+        last = self.holderList.pop()
+        if last != address:
+            self.holderList[position] = last
+            self.accounts[last].position = position
+
+    def _send(self, payments):
+        total = sum(mutez for _, mutez in payments)
+        self._verify(total <= self.xtzBalance, "contract balance too low")
+        self.xtzBalance -= total
+        self.sent.extend(payments)
+
+    def _checkLimit(self, amount):
+        self._verify(amount + self.saleLimit - self.soldToken + self.circulatingSupply + self.reservedSupply <= self.supplyLimit,
+                     "supply limit")
+
+    def _isAdmin(self, sender):
+        self._verify(sender == self.administrator, "not administrator")
+
+    # Entry points
+
+    def transfer(self, sender, amount, params):
+        if len(params) == 1:
+            batch = params[0]
+            txs = batch["txs"]
+            if len(txs) == 1:
+                tx = txs[0]
+                if tx["token_id"] == TOKEN_ID and self._transfer(sender, batch["from_"], tx["to_"], tx["amount"]):
+                    return
+        debits = {}
+        moved = set()
+        permits = {}
+        for batch in params:
+            fromAddr = batch["from_"]
+            if sender != self.administrator and fromAddr != sender:
+                self._consumePermit(permits, fromAddr, batch)
+            self._verify(sender == self.administrator or self.transferStatus, "FA2_TX_DENIED")
+            self._verify(not self._locked(fromAddr), "FA2_TX_DENIED")
+            total = 0
+            for tx in batch["txs"]:
+                self._verify(tx["token_id"] == TOKEN_ID, "FA2_TOKEN_UNDEFINED")
+                total += tx["amount"]
+            src = self.accounts.get(fromAddr)
+            balance = (src.balance if src is not None else 0) - debits.get(fromAddr, 0)
+            self._verify(balance >= total, "FA2_INSUFFICIENT_BALANCE")
+            debits[fromAddr] = debits.get(fromAddr, 0) + total
+            if total > 0:
+                moved.add(fromAddr)
+            for tx in batch["txs"]:
+                if tx["amount"] > 0:
+                    debits[tx["to_"]] = debits.get(tx["to_"], 0) - tx["amount"]
+                    moved.add(tx["to_"])
+        for address in moved:
+            self._settle(address, self._account(address))
+        # holders are numbered in the order of the contract's debits and
+        # credits, which the net debits do not keep
+        balances = {}
+        for batch in params:
+            fromAddr = batch["from_"]
+            balance = balances.get(fromAddr, self.getBalance(fromAddr))
+            total = sum(tx["amount"] for tx in batch["txs"])
+            if total > 0 and balance == total:
+                self._removeHolder(fromAddr)
+            balances[fromAddr] = balance - total
+            for tx in batch["txs"]:
+                if tx["amount"] > 0:
+                    balance = balances.get(tx["to_"], self.getBalance(tx["to_"]))
+                    if balance == 0:
+                        self._addHolder(tx["to_"])
+                    balances[tx["to_"]] = balance + tx["amount"]
+        for address, debit in debits.items():
+            if debit:
+                self.accounts[address].balance -= debit
+        self.permits.update(permits)
+
+    def _transfer(self, sender, fromAddr, toAddr, amount):
+        """A single transfer of a positive amount by its owner or the administrator.
+
+        Returns ``False``, without any change, for the transfers that need the
+        general path of ``transfer`` (permits, and the failures it reports).
+        """
+        if sender != self.administrator:
+            if fromAddr != sender:
+                return False
+            if not self.transferStatus:
+                raise Failure("FA2_TX_DENIED")
+        locks = self.locks
+        if locks and fromAddr in locks:
+            until = locks[fromAddr]
+            if until is None or self.now < until:
+                raise Failure("FA2_TX_DENIED")
+        accounts = self.accounts
+        src = accounts.get(fromAddr)
+        if src is None or src.balance < amount or amount <= 0:
+            return False
+        rpt = self.royaltyPerToken
+        snapshotId = self.snapshotId
+        if src.paid != rpt or src.checkpoint != snapshotId:
+            self._settle(fromAddr, src)
+        dst = accounts.get(toAddr)
+        if dst is None:
+            dst = accounts[toAddr] = Account(0, 0, rpt, snapshotId)
+            if snapshotId:
+                self.checkpoints[toAddr, snapshotId] = (0, 0)
+        elif dst.paid != rpt or dst.checkpoint != snapshotId:
+            self._settle(toAddr, dst)
+        src.balance -= amount
+        if src.balance == 0:
+            self._removeHolder(fromAddr)
+        if dst.balance == 0:
+            self._addHolder(toAddr)
+        dst.balance += amount
+        return True
+
+    def transfers(self, sender, operations):
+        """Apply ``(fromAddr, toAddr, amount)`` transfers; failed ones are returned, not raised."""
+        failed = []
+        transfer = self._transfer
+        for fromAddr, toAddr, amount in operations:
+            try:
+                if not transfer(sender, fromAddr, toAddr, amount):
+                    self.transfer(sender, 0, [{"from_": fromAddr, "txs": [{"to_": toAddr, "token_id": TOKEN_ID, "amount": amount}]}])
+            except Failure:
+                failed.append((fromAddr, toAddr, amount))
+        return failed
+
+    def balance_of(self, sender, amount, params):
+        """FA2 ``balance_of``; the callback is any callable taking the list of responses."""
+        responses = []
+        for request in params["requests"]:
+            self._verify(request["token_id"] == TOKEN_ID, "FA2_TOKEN_UNDEFINED")
+            responses.append(Record(request=request, balance=self.getBalance(request["owner"])))
+        params["callback"](responses)
+
+    def update_operators(self, sender, amount, params):
+        raise Failure("FA2_OPERATORS_UNSUPPORTED")
+
+    def permit(self, sender, amount, params):
+        permits = {}
+        for item in params:
+            owner = key_address(item["key"])
+            counter, expiries = permits.get(owner) or self.permits.get(owner, (0, {}))
+            message = pack(encode(PERMIT_MESSAGE_TYPE, ((self.chainId, self.address), (counter, item["hash"])), optimized=True))
+            self._verify(check_signature(item["key"], item["signature"], message), "MISSIGNED")
+            expiries = {digest: expiry for digest, expiry in expiries.items() if expiry > self.now}
+            self._verify(item["hash"] not in expiries, "DUP_PERMIT")
+            expiries[item["hash"]] = self.now + PERMIT_EXPIRY
+            self._verify(len(expiries) <= MAX_PERMITS, "TOO_MANY_PERMITS")
+            permits[owner] = (counter + 1, expiries)
+        self.permits.update(permits)
+
+    def _consumePermit(self, permits, owner, batch):
+        """Remove the permit of a transfer group from ``permits``, the permits changed by the call."""
+        counter, expiries = permits.get(owner) or self.permits.get(owner, (0, {}))
+        digest = blake2b(pack(encode(TRANSFER_TYPE, batch, optimized=True)))
+        self._verify(digest in expiries, "FA2_NOT_OWNER")
+        self._verify(expiries[digest] > self.now, "PERMIT_EXPIRED")
+        permits[owner] = (counter, {h: expiry for h, expiry in expiries.items() if h != digest})
+
+    def burn(self, sender, amount, params):
+        self._verify(params["fromAddr"] == sender, "not owner")
+        account = self.accounts.get(params["fromAddr"])
+        self._verify(account is not None and account.balance > 0, "unknown address")
+        self._verify(account.balance >= params["amount"], "balance too low")
+        if params["amount"] > 0:
+            self._settle(params["fromAddr"], account)
+            account.balance -= params["amount"]
+            if account.balance == 0:
+                self._removeHolder(params["fromAddr"])
+        self.circulatingSupply -= params["amount"]
+        self.supplyLimit -= params["amount"]
+
+    def _locked(self, address):
+        if address not in self.locks:
+            return False
+        until = self.locks[address]
+        return until is None or self.now < until
+
+    def lockAddress(self, sender, amount, params):
+        self.lockAddresses(sender, amount, {"addresses": [params["address"]], "until": params["until"]})
+
+    def unlockAddress(self, sender, amount, params):
+        self.unlockAddresses(sender, amount, [params["address"]])
+
+    def lockAddresses(self, sender, amount, params):
+        self._isAdmin(sender)
+        for address in params["addresses"]:
+            self.locks[address] = params["until"]
+
+    def unlockAddresses(self, sender, amount, params):
+        self._isAdmin(sender)
+        locks = dict(self.locks)
+        for address in params:
+            self._verify(self.getBalance(address) > 0 or address in locks, "unknown address")
+            locks.pop(address, None)
+        self.locks = locks
+
+    def pauseTransfer(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.transferStatus = False
+
+    def resumeTransfer(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.transferStatus = True
+
+    def pauseSale(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.saleStatus = False
+
+    def resumeSale(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.saleStatus = True
+
+    def setAdministrator(self, sender, amount, params):
+        self._verify(sender == self.owner, "not owner")
+        self.administrator = params
+
+    def setManager(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.saleManager = params
+
+    def sale(self, sender, amount, params):
+        self._verify(self.saleStatus, "sale paused")
+        self._verify(not self._locked(sender), "address locked")
+        self._mintSale(sender, amount * RATIO)
+
+    def offchainSale(self, sender, amount, params):
+        self._verify(sender == self.saleManager, "not sale manager")
+        self._verify(not self._locked(params["address"]), "address locked")
+        self._mintSale(params["address"], params["amount"])
+
+    def offchainSaleBatch(self, sender, amount, params):
+        """The callback, when not None, is any callable taking the list of skipped buyers."""
+        self._verify(sender == self.saleManager, "not sale manager")
+        sales = []
+        skipped = []
+        for sale in params["sales"]:
+            if self._locked(sale["address"]):
+                self._verify(params["skipLocked"], "address locked")
+                skipped.append(sale["address"])
+            else:
+                sales.append(sale)
+        total = sum(sale["amount"] for sale in sales)
+        self._verify(self.soldToken + total <= self.saleLimit, "sale limit")
+        for sale in sales:
+            self._credit(sale["address"], sale["amount"])
+        self.circulatingSupply += total
+        self.soldToken += total
+        if params["callback"] is not None:
+            params["callback"](skipped)
+
+    def _mintSale(self, address, nbMutoken):
+        self._verify(self.soldToken + nbMutoken <= self.saleLimit, "sale limit")
+        self._credit(address, nbMutoken)
+        self.circulatingSupply += nbMutoken
+        self.soldToken += nbMutoken
+
+    def mint(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._checkLimit(params["amount"])
+        self._credit(params["toAddr"], params["amount"])
+        self.circulatingSupply += params["amount"]
+
+    def mintBatch(self, sender, amount, params):
+        self._isAdmin(sender)
+        amounts = {}
+        for item in params:
+            self._verify(item["amount"] > 0, "invalid amount")
+            amounts[item["toAddr"]] = amounts.get(item["toAddr"], 0) + item["amount"]
+        total = sum(amounts.values())
+        self._checkLimit(total)
+        # in the order of the contract's map, by binary address
+        for address in sorted(amounts, key=encode_address):
+            self._credit(address, amounts[address])
+        self.circulatingSupply += total
+
+    def increaseSaleLimit(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._checkLimit(params["amount"])
+        self.saleLimit += params["amount"]
+
+    def cvrDrop(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._checkLimit(params["amount"] * len(params["addresses"]))
+        for address in params["addresses"]:
+            self._credit(address, params["amount"])
+        self.circulatingSupply += params["amount"] * len(params["addresses"])
+
+    def cvrDropRoot(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._verify(params["total"] > 0, "invalid total")
+        self._checkLimit(params["total"])
+        self.airdrops[self.airdropCount] = [params["root"], params["total"]]
+        self.reservedSupply += params["total"]
+        self.airdropCount += 1
+
+    def claimDrop(self, sender, amount, params):
+        drop = self.airdrops.get(params["dropId"])
+        self._verify(drop is not None, "unknown airdrop")
+        word = (params["dropId"], params["index"] // 256)
+        bit = 1 << (params["index"] % 256)
+        bitmap = self.airdropClaims.get(word, 0)
+        self._verify(bitmap & bit == 0, "already claimed")
+        node = leaf_hash(params["index"], params["address"], params["amount"])
+        position = params["index"]
+        for sibling in params["proof"]:
+            node = node_hash(node, sibling) if position % 2 == 0 else node_hash(sibling, node)
+            position //= 2
+        self._verify(node == drop[0], "invalid proof")
+        self._verify(params["amount"] > 0 and drop[1] >= params["amount"], "invalid amount")
+        self.airdropClaims[word] = bitmap | bit
+        drop[1] -= params["amount"]
+        self.reservedSupply -= params["amount"]
+        self._credit(params["address"], params["amount"])
+        self.circulatingSupply += params["amount"]
+
+    def closeDrop(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._verify(params in self.airdrops, "unknown airdrop")
+        self.reservedSupply -= self.airdrops.pop(params)[1]
+
+    def dispatchRoyalties(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._verify(params["amount"] > 0, "division by zero")
+        snapshotId = params["snapshotId"]
+        if snapshotId is None:
+            supply = self.circulatingSupply
+        else:
+            self._verify(snapshotId in self.snapshots, "unknown snapshot")
+            supply = self.snapshots[snapshotId]
+        muCVRtez = supply * ROYALTY_ROUNDING // params["amount"] + 1
+        payments = []
+        for address in params["addresses"]:
+            balance = self.getBalance(address) if snapshotId is None else self._snapshotBalance(address, snapshotId)
+            if balance * ROYALTY_ROUNDING > muCVRtez:
+                payments.append((address, balance * ROYALTY_ROUNDING // muCVRtez))
+        total = sum(mutez for _, mutez in payments)
+        self._verify(self.xtzBalance >= total + self.royaltyReserve, "royalty reserve")
+        self._send(payments)
+
+    def snapshot(self, sender, amount, params):
+        self._isAdmin(sender)
+        self.snapshotId += 1
+        self.snapshots[self.snapshotId] = self.circulatingSupply
+
+    def _snapshotBalance(self, owner, snapshotId):
+        account = self.accounts.get(owner)
+        if account is None:
+            return 0
+        balance, cursor = account.balance, account.checkpoint
+        while cursor >= snapshotId:
+            balance, cursor = self.checkpoints[owner, cursor]
+        return balance
+
+    def depositRoyalties(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._verify(self.circulatingSupply > 0, "no supply")
+        self.royaltyPerToken += amount * ROYALTY_SCALE // self.circulatingSupply
+        self.royaltyReserve += amount
+
+    def claimRoyalties(self, sender, amount, params):
+        payments = []
+        owed = {}
+        for address in params:
+            account = self.accounts.get(address)
+            if account is not None:
+                due = owed.get(address)
+                if due is None:
+                    due = account.owed + account.balance * (self.royaltyPerToken - account.paid) // ROYALTY_SCALE
+                if due > 0:
+                    payments.append((address, due))
+                owed[address] = 0
+        total = sum(mutez for _, mutez in payments)
+        self._verify(total <= self.royaltyReserve, "royalty reserve too low")
+        self._send(payments)
+        self.royaltyReserve -= total
+        for address in owed:
+            account = self.accounts[address]
+            account.owed = 0
+            account.paid = self.royaltyPerToken
+
+    def claimSale(self, sender, amount, params):
+        self._isAdmin(sender)
+        self._verify(self.xtzBalance > params["amount"] + self.royaltyReserve, "contract balance too low")
+        muSharetez = params["amount"] // 100
+        self._send([(self.octopus, muSharetez * 75), (self.covir, muSharetez * 25)])
+
+    # Views
+
+    def getBalance(self, owner):
+        account = self.accounts.get(owner)
+        return account.balance if account is not None else 0
+
+    def holders(self, params):
+        page = self.holderList[params["offset"]:params["offset"] + params["limit"]]
+        return [Record(address=address, balance=self.accounts[address].balance) for address in page]
+
+    def getHolderCount(self):
+        return len(self.holderList)
+
+    def balanceAt(self, params):
+        self._verify(params["snapshotId"] in self.snapshots, "unknown snapshot")
+        return self._snapshotBalance(params["owner"], params["snapshotId"])
+
+    def supplyAt(self, snapshotId):
+        self._verify(snapshotId in self.snapshots, "unknown snapshot")
+        return self.snapshots[snapshotId]
+
+    def getSnapshotId(self):
+        return self.snapshotId
+
+    def getPermitCounter(self, owner):
+        return self.permits.get(owner, (0, {}))[0]
+
+    def getCirculatingSupply(self):
+        return self.circulatingSupply
+
+    def getSoldToken(self):
+        return self.soldToken
+
+    def getSaleLimit(self):
+        return self.saleLimit
+
+    def getSupplyLimit(self):
+        return self.supplyLimit
+
+    def getFactor(self):
+        return FACTOR
+
+    def getTransferStatus(self):
+        return self.transferStatus
+
+    def getSaleStatus(self):
+        return self.saleStatus
+
+    def getAdministrator(self):
+        return self.administrator
+
+    def getManager(self):
+        return self.saleManager
+
+    def getStats(self):
+        return Record(circulatingSupply=self.circulatingSupply, soldToken=self.soldToken, saleLimit=self.saleLimit,
+                      supplyLimit=self.supplyLimit, reservedSupply=self.reservedSupply,
+                      transferStatus=self.transferStatus, saleStatus=self.saleStatus)
+
+
+VIEWS = {"getBalance", "holders", "getHolderCount", "balanceAt", "supplyAt", "getSnapshotId", "getPermitCounter", "getCirculatingSupply", "getSoldToken", "getSaleLimit", "getSupplyLimit", "getFactor",
+         "getTransferStatus", "getSaleStatus", "getAdministrator", "getManager", "getStats"}
+# what Ledger.call runs: the public methods but the views and the helpers
+ENTRY_POINTS = {name: method for name, method in vars(Ledger).items()
+                if not name.startswith("_") and callable(method) and name not in VIEWS and name not in ("call", "transfers")}
+
+
+# Differential run of the cvr.py test scenario
+
+class ScenarioMismatch(Exception):
+    pass
+
+
+class Contract:
+    """Stands for the ``CVR`` instance of a scenario: entry points return calls, views return values."""
+
+    def __init__(self, *args):
+        self.ledger = Ledger(*args)
+        self.address = self.ledger.address
+
+    def __getattr__(self, name):
+        if name in VIEWS:
+            return getattr(self.ledger, name)
+
+        def entry_point(*args, **kwargs):
+            return Call(self.ledger, name, args[0] if args else Record(kwargs))
+        return entry_point
+
+
+class BalanceOfConsumer:
+    """Stands for the ``BalanceOfConsumer`` test contract."""
+
+    def __init__(self):
+        self.data = Record(responses=[])
+
+    def callback(self):
+        return self.receiveBalances
+
+    def receiveBalances(self, responses):
+        self.data["responses"] = responses
+
+
+class SkippedSalesConsumer:
+    """Stands for the ``SkippedSalesConsumer`` test contract."""
+
+    def __init__(self):
+        self.data = Record(addresses=[])
+
+    def callback(self):
+        return self.receiveSkipped
+
+    def receiveSkipped(self, addresses):
+        self.data["addresses"] = addresses
+
+
+class Call:
+    def __init__(self, ledger, entry_point, params):
+        self.ledger = ledger
+        self.entry_point = entry_point
+        self.params = params
+
+    def run(self, sender, amount=0, valid=True, now=None, chain_id=None):
+        self.sender = sender
+        self.amount = amount
+        self.valid = valid
+        self.now = now
+        self.chain_id = chain_id
+        return self
+
+
+class Scenario:
+    def __init__(self):
+        self.heading = ""
+        self.steps = 0
+        self.mismatches = []
+
+    def __iadd__(self, item):
+        if isinstance(item, Call):
+            self.steps += 1
+            if item.now is not None:
+                item.ledger.now = item.now
+            if item.chain_id is not None:
+                item.ledger.chainId = item.chain_id
+            try:
+                item.ledger.call(item.entry_point, item.params, item.sender, item.amount)
+                succeeded = True
+            except Failure:
+                succeeded = False
+            if succeeded != item.valid:
+                self.mismatches.append("%s: %s %s" % (self.heading, item.entry_point, "succeeded" if succeeded else "failed"))
+        return self
+
+    def h1(self, text):
+        self.heading = text
+
+    h2 = h3 = h4 = p = h1
+
+    def show(self, value):
+        pass
+
+    def verify(self, condition):
+        self.steps += 1
+        if not condition:
+            self.mismatches.append("%s: verify failed" % self.heading)
+
+    def verify_equal(self, left, right):
+        self.verify(left == right)
+
+
+class SmartPyShim:
+    """The subset of ``smartpy`` used by test scenarios, on top of the model."""
+
+    def __init__(self):
+        self.tests = []
+
+    def add_test(self, name, **kwargs):
+        def register(f):
+            self.tests.append((name, f))
+            return f
+        return register
+
+    def test_scenario(self):
+        scenario = Scenario()
+        self.scenarios.append(scenario)
+        return scenario
+
+    @staticmethod
+    def address(text):
+        return text
+
+    @staticmethod
+    def tez(value):
+        return value * 10**6
+
+    @staticmethod
+    def mutez(value):
+        return value
+
+    @staticmethod
+    def nat(value):
+        return value
+
+    int = nat
+
+    @staticmethod
+    def bytes(text):
+        return bytes.fromhex(text[2:])
+
+    @staticmethod
+    def record(**kwargs):
+        return Record(kwargs)
+
+    @staticmethod
+    def variant(name, value):
+        return Record({name: value})
+
+    timestamp = nat
+
+    none = None
+
+    @staticmethod
+    def some(value):
+        return value
+
+    @staticmethod
+    def chain_id_cst(text):
+        return bytes.fromhex(text[2:])
+
+    @staticmethod
+    def pair(left, right):
+        return (left, right)
+
+    @staticmethod
+    def set_type_expr(value, type_):
+        return Typed(value, type_)
+
+    @staticmethod
+    def pack(value):
+        return pack(_infer(value))
+
+    @staticmethod
+    def blake2b(data):
+        return blake2b(data)
+
+    @staticmethod
+    def test_account(seed):
+        secret = secret_key(blake2b(seed.encode()))
+        key = public_key(secret)
+        return Record(address=key_address(key), public_key=key, secret_key=secret)
+
+    @staticmethod
+    def make_signature(secret, message, message_format="Raw"):
+        return sign(secret, message)
+
+
+class Typed:
+    """A value with the Michelson type given by ``sp.set_type_expr``."""
+
+    def __init__(self, value, type_):
+        self.value = value
+        self.type = type_
+
+
+def _infer(value):
+    """Optimized Micheline node of a scenario value, for ``sp.pack``.
+
+    Values other than ``Typed`` ones can be pairs, ints, bytes and addresses.
+    """
+    if isinstance(value, Typed):
+        return encode(value.type, value.value, optimized=True)
+    if isinstance(value, tuple):
+        return {"prim": "Pair", "args": [_infer(item) for item in value]}
+    if isinstance(value, int):
+        return {"int": str(value)}
+    if isinstance(value, bytes):
+        return {"bytes": value.hex()}
+    return {"bytes": encode_address(value).hex()}
+
+
+def scenario_source(path):
+    """The test part of ``path``, which is plain Python unlike the contract part."""
+    with open(path) as f:
+        source = f.read()
+    start = source.index('if "templates" not in __name__:')
+    return textwrap.dedent(source[start:].split("\n", 1)[1])
+
+
+def replay(path=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cvr.py"), names=None):
+    """Replay the tests of ``path`` on the model and return ``{test name: (steps, mismatches)}``."""
+    sp = SmartPyShim()
+    exec(compile(scenario_source(path), path, "exec"), {"sp": sp, "CVR": Contract, "BalanceOfConsumer": BalanceOfConsumer,
+                                                              "SkippedSalesConsumer": SkippedSalesConsumer,
+                                                              "TRANSFER": TRANSFER_TYPE, "__name__": "__main__"})
+    results = {}
+    for name, test in sp.tests:
+        if names is None or name in names:
+            sp.scenarios = []
+            test()
+            results[name] = (sum(s.steps for s in sp.scenarios), [m for s in sp.scenarios for m in s.mismatches])
+    return results
+
+
+def bench(operations=1000000, accounts=10000, chunk=100000):
+    """Time single transfers through ``call``, as the tests and tools make them, then through ``transfers``.
+
+    The parameters of ``call`` are built ``chunk`` at a time, outside the timing.
+    """
+    import random
+    rng = random.Random(0)
+    addresses = [b58check_encode(IMPLICIT_PREFIXES["tz1"][0], blake2b(b"ledger-bench-%d" % i)[:20]) for i in range(accounts)]
+    transfers = [(a, addresses[rng.randrange(accounts)], rng.randrange(1, 10**6))
+                 for a in (addresses[rng.randrange(accounts)] for _ in range(operations))]
+    results = []
+    for name in ("call", "transfers"):
+        ledger = Ledger("owner", "admin", "manager", "octopus", "covir")
+        ledger.call("mintBatch", [Record(toAddr=a, amount=10**9) for a in addresses], "admin")
+        elapsed = 0
+        failed = 0
+        if name == "call":
+            call = ledger.call
+            for start in range(0, operations, chunk):
+                params = [[{"from_": fromAddr, "txs": [{"to_": toAddr, "token_id": TOKEN_ID, "amount": amount}]}]
+                          for fromAddr, toAddr, amount in transfers[start:start + chunk]]
+                begin = time.perf_counter()
+                for param in params:
+                    try:
+                        call("transfer", param, "admin")
+                    except Failure:
+                        failed += 1
+                elapsed += time.perf_counter() - begin
+        else:
+            begin = time.perf_counter()
+            failed = len(ledger.transfers("admin", transfers))
+            elapsed = time.perf_counter() - begin
+        print("%d transfers through %s() in %.3fs: %.0f ops/s (%d failed)" % (operations, name, elapsed, operations / elapsed, failed))
+        results.append(operations / elapsed)
+    return results
+
+
+if __name__ == "__main__":
+    if "--bench" in sys.argv:
+        bench()
+        sys.exit(0)
+    failed = False
+    for name, (steps, mismatches) in replay().items():
+        print("%s: %d steps, %d mismatches" % (name, steps, len(mismatches)))
+        for mismatch in mismatches:
+            print("  " + mismatch)
+        failed = failed or bool(mismatches)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,872 @@
+"""Micheline encoding helpers shared by the off-chain CVR tools.
+
+Values use the JSON Micheline representation returned by the Tezos RPC:
+``{"int": "1"}``, ``{"string": "..."}``, ``{"bytes": "<hex>"}``,
+``{"prim": "Pair", "args": [...], "annots": [...]}`` and lists for sequences.
+"""
+
+import hashlib
+
+
+BASE58_ALPHABET = "123456789ABCDEFGHJKLMNPQRSTUVWXYZabcdefghijkmnopqrstuvwxyz"
+BASE58_INDEX = {c: i for i, c in enumerate(BASE58_ALPHABET)}
+
+# base58check prefixes of the 20-byte public key hashes, and their tag in the
+# binary address encoding
+IMPLICIT_PREFIXES = {
+    "tz1": (b"\x06\xa1\x9f", 0),
+    "tz2": (b"\x06\xa1\xa1", 1),
+    "tz3": (b"\x06\xa1\xa4", 2),
+    "tz4": (b"\x06\xa1\xa6", 3),
+}
+IMPLICIT_TAGS = {tag: (name, prefix) for name, (prefix, tag) in IMPLICIT_PREFIXES.items()}
+ORIGINATED_PREFIX = b"\x02\x5a\x79"
+
+# Michelson primitives, in the order of their binary code
+PRIMITIVES = [
+    "parameter", "storage", "code", "False", "Elt", "Left", "None", "Pair",
+    "Right", "Some", "True", "Unit", "PACK", "UNPACK", "BLAKE2B", "SHA256",
+    "SHA512", "ABS", "ADD", "AMOUNT", "AND", "BALANCE", "CAR", "CDR",
+    "CHECK_SIGNATURE", "COMPARE", "CONCAT", "CONS", "CREATE_ACCOUNT",
+    "CREATE_CONTRACT", "IMPLICIT_ACCOUNT", "DIP", "DROP", "DUP", "EDIV",
+    "EMPTY_MAP", "EMPTY_SET", "EQ", "EXEC", "FAILWITH", "GE", "GET", "GT",
+    "HASH_KEY", "IF", "IF_CONS", "IF_LEFT", "IF_NONE", "INT", "LAMBDA", "LE",
+    "LEFT", "LOOP", "LSL", "LSR", "LT", "MAP", "MEM", "MUL", "NEG", "NEQ",
+    "NIL", "NONE", "NOT", "NOW", "OR", "PAIR", "PUSH", "RIGHT", "SIZE", "SOME",
+    "SOURCE", "SENDER", "SELF", "STEPS_TO_QUOTA", "SUB", "SWAP",
+    "TRANSFER_TOKENS", "SET_DELEGATE", "UNIT", "UPDATE", "XOR", "ITER",
+    "LOOP_LEFT", "ADDRESS", "CONTRACT", "ISNAT", "CAST", "RENAME", "bool",
+    "contract", "int", "key", "key_hash", "lambda", "list", "map", "big_map",
+    "nat", "option", "or", "pair", "set", "signature", "string", "bytes",
+    "mutez", "timestamp", "unit", "operation", "address", "SLICE", "DIG", "DUG",
+    "EMPTY_BIG_MAP", "APPLY", "chain_id", "CHAIN_ID", "LEVEL", "SELF_ADDRESS",
+    "never", "NEVER", "UNPAIR", "VOTING_POWER", "TOTAL_VOTING_POWER", "KECCAK",
+    "SHA3", "PAIRING_CHECK", "bls12_381_g1", "bls12_381_g2", "bls12_381_fr",
+    "sapling_state", "sapling_transaction_deprecated", "SAPLING_EMPTY_STATE",
+    "SAPLING_VERIFY_UPDATE", "ticket", "TICKET_DEPRECATED", "READ_TICKET",
+    "SPLIT_TICKET", "JOIN_TICKETS", "GET_AND_UPDATE", "chest", "chest_key",
+    "OPEN_CHEST", "VIEW", "view", "constant", "SUB_MUTEZ",
+    "tx_rollup_l2_address", "MIN_BLOCK_TIME", "sapling_transaction", "EMIT",
+    "Lambda_rec", "LAMBDA_REC", "TICKET", "BYTES", "NAT",
+]
+PRIMITIVE_CODES = {name: code for code, name in enumerate(PRIMITIVES)}
+
+
+def b58encode(data):
+    n = int.from_bytes(data, "big")
+    out = []
+    while n:
+        n, r = divmod(n, 58)
+        out.append(BASE58_ALPHABET[r])
+    pad = len(data) - len(data.lstrip(b"\0"))
+    return "1" * pad + "".join(reversed(out))
+
+
+def b58decode(text):
+    n = 0
+    for c in text:
+        n = n * 58 + BASE58_INDEX[c]
+    pad = len(text) - len(text.lstrip("1"))
+    body = n.to_bytes((n.bit_length() + 7) // 8, "big") if n else b""
+    return b"\0" * pad + body
+
+
+def b58check_encode(prefix, payload):
+    data = prefix + payload
+    checksum = hashlib.sha256(hashlib.sha256(data).digest()).digest()[:4]
+    return b58encode(data + checksum)
+
+
+def b58check_decode(text, prefix):
+    data = b58decode(text)
+    payload, checksum = data[:-4], data[-4:]
+    if hashlib.sha256(hashlib.sha256(payload).digest()).digest()[:4] != checksum:
+        raise ValueError("invalid checksum: %s" % text)
+    if not payload.startswith(prefix):
+        raise ValueError("invalid prefix: %s" % text)
+    return payload[len(prefix):]
+
+
+def encode_address(address):
+    """Return the 22-byte binary form of a ``tz``/``KT1`` address."""
+    if address.startswith("KT1"):
+        return b"\x01" + b58check_decode(address, ORIGINATED_PREFIX) + b"\x00"
+    prefix, tag = IMPLICIT_PREFIXES[address[:3]]
+    return bytes((0, tag)) + b58check_decode(address, prefix)
+
+
+def decode_address(data):
+    """Return the base58 form of a 22-byte binary address."""
+    data = bytes(data)
+    if data[0] == 1:
+        return b58check_encode(ORIGINATED_PREFIX, data[1:21])
+    return b58check_encode(IMPLICIT_TAGS[data[1]][1], data[2:22])
+
+
+def forge_int(value):
+    """Zarith encoding of an ``int``/``nat`` literal."""
+    sign = 0x40 if value < 0 else 0
+    value = abs(value)
+    out = bytearray([sign | (value & 0x3F)])
+    value >>= 6
+    while value:
+        out[-1] |= 0x80
+        out.append(value & 0x7F)
+        value >>= 7
+    return bytes(out)
+
+
+def forge_bytes(data):
+    return b"\x0a" + len(data).to_bytes(4, "big") + data
+
+
+def forge_string(text):
+    data = text.encode()
+    return b"\x01" + len(data).to_bytes(4, "big") + data
+
+
+def forge(node):
+    """Binary encoding of a JSON Micheline node."""
+    if isinstance(node, list):
+        body = b"".join(forge(item) for item in node)
+        return b"\x02" + len(body).to_bytes(4, "big") + body
+    if "int" in node:
+        return b"\x00" + forge_int(int(node["int"]))
+    if "string" in node:
+        return forge_string(node["string"])
+    if "bytes" in node:
+        return forge_bytes(bytes.fromhex(node["bytes"]))
+    args = node.get("args", [])
+    annots = node.get("annots", [])
+    code = bytes((PRIMITIVE_CODES[node["prim"]],))
+    body = b"".join(forge(arg) for arg in args)
+    if len(args) < 3:
+        tag = bytes((3 + 2 * len(args) + (1 if annots else 0),))
+        if annots:
+            text = " ".join(annots).encode()
+            return tag + code + body + len(text).to_bytes(4, "big") + text
+        return tag + code + body
+    text = " ".join(annots).encode()
+    return (b"\x09" + code + len(body).to_bytes(4, "big") + body
+            + len(text).to_bytes(4, "big") + text)
+
+
+COMPARISONS = ("EQ", "NEQ", "LT", "GT", "LE", "GE")
+
+
+def expand(node):
+    """``node`` with the macros of compiled contracts expanded as ``octez-client`` does.
+
+    Covers ``C[AD]+R``, ``IF_SOME``, ``IF_RIGHT``, ``FAIL``, ``CMPop``, ``IFop``
+    and ``IF_CMPop``; other primitives are left unchanged.
+    """
+    if isinstance(node, list):
+        return [expand(item) for item in node]
+    if "prim" not in node:
+        return node
+    prim = node["prim"]
+    args = [expand(arg) for arg in node.get("args", [])]
+    if prim not in PRIMITIVE_CODES:
+        # the expanded instructions keep the source line of the macro
+        at = {"line": node["line"]} if "line" in node else {}
+        if len(prim) > 3 and prim[0] == "C" and prim[-1] == "R" and set(prim[1:-1]) <= {"A", "D"}:
+            return [dict(at, prim="CAR" if c == "A" else "CDR") for c in prim[1:-1]]
+        if prim == "IF_SOME":
+            return dict(at, prim="IF_NONE", args=[args[1], args[0]])
+        if prim == "IF_RIGHT":
+            return dict(at, prim="IF_LEFT", args=[args[1], args[0]])
+        if prim == "FAIL":
+            return [dict(at, prim="UNIT"), dict(at, prim="FAILWITH")]
+        if prim[:3] == "CMP" and prim[3:] in COMPARISONS:
+            return [dict(at, prim="COMPARE"), dict(at, prim=prim[3:])]
+        if prim[:2] == "IF" and prim[2:] in COMPARISONS:
+            return [dict(at, prim=prim[2:]), dict(at, prim="IF", args=args)]
+        if prim[:6] == "IF_CMP" and prim[6:] in COMPARISONS:
+            return [dict(at, prim="COMPARE"), dict(at, prim=prim[6:]), dict(at, prim="IF", args=args)]
+    expanded = dict(node)
+    if args:
+        expanded["args"] = args
+    return expanded
+
+
+def pack(node):
+    """Same bytes as Michelson ``PACK`` for an already typed node.
+
+    Typed values such as addresses must be given in their optimized binary
+    form, e.g. ``{"bytes": encode_address(a).hex()}``.
+    """
+    return b"\x05" + forge(node)
+
+
+def blake2b(data):
+    return hashlib.blake2b(data, digest_size=32).digest()
+
+
+# Ed25519 keys and signatures of tz1 accounts (RFC 8032). Tezos signs the
+# blake2b hash of a message, as CHECK_SIGNATURE does. Slow, and not hardened
+# against timing attacks: meant for tests and simulations, not for signing
+# with real keys.
+
+SECRET_KEY_PREFIX = b"\x0d\x0f\x3a\x07"
+PUBLIC_KEY_PREFIX = b"\x0d\x0f\x25\xd9"
+SIGNATURE_PREFIX = b"\x09\xf5\xcd\x86\x12"
+# signatures of any curve, as returned by remote signers
+SIGNATURE_PREFIXES = {
+    "edsig": SIGNATURE_PREFIX,
+    "spsig1": b"\x0d\x73\x65\x13\x3f",
+    "p2sig": b"\x36\xf0\x2c\x34",
+    "sig": b"\x04\x82\x2b",
+}
+CHAIN_ID_PREFIX = b"\x57\x52\x00"
+
+_P = 2**255 - 19
+_L = 2**252 + 27742317777372353535851937790883648493
+_D = -121665 * pow(121666, _P - 2, _P) % _P
+_SQRT_M1 = pow(2, (_P - 1) // 4, _P)
+
+
+def _point_add(a, b):
+    # extended coordinates (X, Y, Z, T) with x = X/Z, y = Y/Z, x*y = T/Z
+    e = (a[1] - a[0]) * (b[1] - b[0]) % _P
+    f = (a[1] + a[0]) * (b[1] + b[0]) % _P
+    g = 2 * a[3] * b[3] * _D % _P
+    h = 2 * a[2] * b[2] % _P
+    e, f, g, h = f - e, h - g, h + g, f + e
+    return (e * f % _P, g * h % _P, f * g % _P, e * h % _P)
+
+
+def _point_mul(scalar, point):
+    result = (0, 1, 1, 0)
+    while scalar:
+        if scalar & 1:
+            result = _point_add(result, point)
+        point = _point_add(point, point)
+        scalar >>= 1
+    return result
+
+
+def _point_equal(a, b):
+    return (a[0] * b[2] - b[0] * a[2]) % _P == 0 and (a[1] * b[2] - b[1] * a[2]) % _P == 0
+
+
+def _point_encode(point):
+    inverse = pow(point[2], _P - 2, _P)
+    x, y = point[0] * inverse % _P, point[1] * inverse % _P
+    return (y | (x & 1) << 255).to_bytes(32, "little")
+
+
+def _point_decode(data):
+    y = int.from_bytes(data, "little")
+    sign, y = y >> 255, y & ((1 << 255) - 1)
+    if y >= _P:
+        raise ValueError("invalid point")
+    x2 = (y * y - 1) * pow(_D * y * y + 1, _P - 2, _P) % _P
+    x = pow(x2, (_P + 3) // 8, _P)
+    if (x * x - x2) % _P:
+        x = x * _SQRT_M1 % _P
+    if (x * x - x2) % _P or (x == 0 and sign):
+        raise ValueError("invalid point")
+    if x & 1 != sign:
+        x = _P - x
+    return (x, y, 1, x * y % _P)
+
+
+_BASE = _point_decode((4 * pow(5, _P - 2, _P) % _P).to_bytes(32, "little"))
+
+
+def _expand_seed(seed):
+    digest = hashlib.sha512(seed).digest()
+    scalar = int.from_bytes(digest[:32], "little") & ((1 << 254) - 8) | (1 << 254)
+    return scalar, digest[32:]
+
+
+def _sha512_scalar(*parts):
+    return int.from_bytes(hashlib.sha512(b"".join(parts)).digest(), "little") % _L
+
+
+def secret_key(seed):
+    """``edsk`` secret key of a 32-byte seed."""
+    return b58check_encode(SECRET_KEY_PREFIX, seed)
+
+
+def public_key(secret):
+    """``edpk`` public key of an ``edsk`` secret key."""
+    scalar, _ = _expand_seed(b58check_decode(secret, SECRET_KEY_PREFIX))
+    return b58check_encode(PUBLIC_KEY_PREFIX, _point_encode(_point_mul(scalar, _BASE)))
+
+
+def key_address(key):
+    """``tz1`` address of an ``edpk`` public key, as ``HASH_KEY`` and ``IMPLICIT_ACCOUNT`` give."""
+    digest = hashlib.blake2b(b58check_decode(key, PUBLIC_KEY_PREFIX), digest_size=20).digest()
+    return b58check_encode(IMPLICIT_PREFIXES["tz1"][0], digest)
+
+
+def sign(secret, message):
+    """``edsig`` signature of ``message`` bytes."""
+    scalar, prefix = _expand_seed(b58check_decode(secret, SECRET_KEY_PREFIX))
+    digest = blake2b(message)
+    encoded_key = _point_encode(_point_mul(scalar, _BASE))
+    r = _sha512_scalar(prefix, digest)
+    encoded_r = _point_encode(_point_mul(r, _BASE))
+    s = (r + _sha512_scalar(encoded_r, encoded_key, digest) * scalar) % _L
+    return b58check_encode(SIGNATURE_PREFIX, encoded_r + s.to_bytes(32, "little"))
+
+
+def check_signature(key, signature, message):
+    """Same result as Michelson ``CHECK_SIGNATURE`` for an ``edpk`` key."""
+    encoded_key = b58check_decode(key, PUBLIC_KEY_PREFIX)
+    data = b58check_decode(signature, SIGNATURE_PREFIX)
+    s = int.from_bytes(data[32:], "little")
+    try:
+        point, r = _point_decode(encoded_key), _point_decode(data[:32])
+    except ValueError:
+        return False
+    if s >= _L:
+        return False
+    k = _sha512_scalar(data[:32], encoded_key, blake2b(message))
+    return _point_equal(_point_mul(s, _BASE), _point_add(r, _point_mul(k, point)))
+
+
+def decode_signature(signature):
+    """Raw 64 bytes of a base58 signature."""
+    for name in ("spsig1", "edsig", "p2sig", "sig"):
+        if signature.startswith(name):
+            return b58check_decode(signature, SIGNATURE_PREFIXES[name])
+    raise ValueError("unknown signature prefix: %s" % signature)
+
+
+# optimized binary form of the typed values that have one
+OPTIMIZED = {
+    "address": encode_address,
+    "contract": encode_address,
+    "key": lambda key: b"\x00" + b58check_decode(key, PUBLIC_KEY_PREFIX),
+    "key_hash": lambda key_hash: encode_address(key_hash)[1:],
+    "signature": decode_signature,
+    "chain_id": lambda chain_id: b58check_decode(chain_id, CHAIN_ID_PREFIX),
+}
+
+
+# Michelson concrete syntax
+
+def _tokens(text):
+    i, n, line = 0, len(text), 1
+    while i < n:
+        c = text[i]
+        if c == "\n":
+            line += 1
+            i += 1
+        elif c.isspace():
+            i += 1
+        elif c == "#":
+            while i < n and text[i] != "\n":
+                i += 1
+        elif text.startswith("/*", i):
+            end = text.index("*/", i) + 2
+            line += text.count("\n", i, end)
+            i = end
+        elif c in "{}();":
+            yield c, c, line
+            i += 1
+        elif c == '"':
+            j = i + 1
+            while text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            yield "string", text[i + 1:j].encode().decode("unicode_escape"), line
+            i = j + 1
+        else:
+            j = i
+            while j < n and not text[j].isspace() and text[j] not in '{}();"#':
+                j += 1
+            word = text[i:j]
+            if word.startswith("0x"):
+                yield "bytes", word[2:], line
+            elif word.lstrip("-").isdigit():
+                yield "int", word, line
+            elif word[0] in "@%:":
+                yield "annot", word, line
+            else:
+                yield "prim", word, line
+            i = j
+
+
+class _Parser:
+    def __init__(self, text):
+        self.tokens = list(_tokens(text))
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def seq(self, end):
+        items = []
+        while self.peek() not in (end, None):
+            if self.peek() == ";":
+                self.next()
+                continue
+            items.append(self.application())
+        return items
+
+    def application(self):
+        if self.peek() != "prim":
+            return self.atom()
+        _, name, line = self.next()
+        node = {"prim": name, "line": line}
+        annots, args = [], []
+        while self.peek() not in (";", "}", ")", None):
+            if self.peek() == "annot":
+                annots.append(self.next()[1])
+            else:
+                args.append(self.atom())
+        if args:
+            node["args"] = args
+        if annots:
+            node["annots"] = annots
+        return node
+
+    def atom(self):
+        kind, value, line = self.next()
+        if kind == "(":
+            node = self.application()
+            self.next()
+            return node
+        if kind == "{":
+            items = self.seq("}")
+            self.next()
+            return items
+        if kind == "prim":
+            return {"prim": value, "line": line}
+        return {kind: value}
+
+
+def parse(text):
+    """Parse a Michelson expression or a whole ``.tz`` script (as a sequence).
+
+    Primitive nodes carry the source ``line`` they start on.
+    """
+    parser = _Parser(text)
+    items = parser.seq(None)
+    return items[0] if len(items) == 1 else items
+
+
+def to_michelson(node):
+    """Concrete syntax of a JSON Micheline node, e.g. for ``octez-client --arg``."""
+    if isinstance(node, list):
+        return "{" + "; ".join(to_michelson(item) for item in node) + "}"
+    if "int" in node:
+        return str(node["int"])
+    if "string" in node:
+        return '"%s"' % node["string"].replace("\\", "\\\\").replace('"', '\\"')
+    if "bytes" in node:
+        return "0x" + node["bytes"]
+    words = [node["prim"]] + node.get("annots", []) + [to_michelson(arg) for arg in node.get("args", [])]
+    return "(%s)" % " ".join(words) if len(words) > 1 else words[0]
+
+
+def script_section(script, name):
+    """The ``parameter``/``storage``/``code`` section of a parsed script."""
+    for item in script:
+        if isinstance(item, dict) and item.get("prim") == name:
+            return item["args"][0]
+    raise KeyError(name)
+
+
+def field_name(node):
+    for annot in node.get("annots", []) if isinstance(node, dict) else []:
+        if annot.startswith("%"):
+            return annot[1:]
+    return None
+
+
+def entrypoints(parameter):
+    """``{name: type}`` of the entry points of a parameter type."""
+    result = {}
+    name = field_name(parameter)
+    if name:
+        result[name] = parameter
+    elif parameter.get("prim") == "or":
+        for arg in parameter["args"]:
+            result.update(entrypoints(arg))
+    else:
+        result["default"] = parameter
+    return result
+
+
+def field_paths(node, path=()):
+    """``{field: (path of 0/1 args from the root pair, type)}`` for an annotated pair tree."""
+    name = field_name(node)
+    if name and path:
+        return {name: (path, node)}
+    if isinstance(node, dict) and node.get("prim") == "pair":
+        result = {}
+        for i, arg in enumerate(node["args"]):
+            result.update(field_paths(arg, path + (i,)))
+        return result
+    return {name: (path, node)} if name else {}
+
+
+def _sort_key(type_, key):
+    if type_["prim"] == "address":
+        return encode_address(key)
+    return key
+
+
+def encode(type_, value, optimized=False):
+    """Micheline data node of the Python ``value`` for a Michelson type.
+
+    Records are dicts keyed by field annotation, ``or`` values are one-entry
+    dicts keyed by the branch annotation, maps are dicts, options are
+    ``None`` or the value itself. With ``optimized``, addresses, keys,
+    signatures and chain ids are given in their binary form, as ``PACK`` needs.
+    """
+    prim = type_["prim"]
+    args = type_.get("args", [])
+    if isinstance(value, dict) and len(value) == 1 and prim not in ("pair", "or", "map", "big_map"):
+        # single field records are not wrapped in a pair
+        (value,) = value.values()
+    if prim in ("int", "nat", "mutez"):
+        return {"int": str(value)}
+    if prim == "timestamp":
+        return {"int": str(value)} if isinstance(value, int) else {"string": value}
+    if optimized and prim in OPTIMIZED:
+        return {"bytes": (value if isinstance(value, bytes) else OPTIMIZED[prim](value)).hex()}
+    if prim in ("string", "address", "key", "key_hash", "signature", "contract", "chain_id"):
+        return {"string": value}
+    if prim == "bytes":
+        return {"bytes": value.hex() if isinstance(value, (bytes, bytearray)) else value}
+    if prim == "bool":
+        return {"prim": "True" if value else "False"}
+    if prim == "unit":
+        return {"prim": "Unit"}
+    if prim == "option":
+        return {"prim": "None"} if value is None else {"prim": "Some", "args": [encode(args[0], value, optimized)]}
+    if prim in ("list", "set"):
+        return [encode(args[0], item, optimized) for item in value]
+    if prim in ("map", "big_map"):
+        return [{"prim": "Elt", "args": [encode(args[0], k, optimized), encode(args[1], value[k], optimized)]}
+                for k in sorted(value, key=lambda k: _sort_key(args[0], k))]
+    if prim == "pair":
+        if isinstance(value, (tuple, list)):
+            if len(args) == 2 and len(value) > 2:
+                value = (value[0], tuple(value[1:]))
+            return {"prim": "Pair", "args": [encode(t, v, optimized) for t, v in zip(args, value)]}
+        return {"prim": "Pair", "args": [encode(t, value if field_name(t) is None else value[field_name(t)], optimized)
+                                         for t in args]}
+    if prim == "or":
+        (branch, inner), = value.items()
+        for side, t in zip(("Left", "Right"), args):
+            if field_name(t) == branch:
+                return {"prim": side, "args": [encode(t, inner, optimized)]}
+            if t["prim"] == "or" and branch in entrypoints(t):
+                return {"prim": side, "args": [encode(t, value, optimized)]}
+        raise KeyError(branch)
+    raise ValueError("cannot encode %s" % prim)
+
+
+def decode(type_, node):
+    """Python value of a JSON Micheline data node, the inverse of ``encode``.
+
+    Big maps given by their id (as in operation results) decode to the int id.
+    """
+    prim = type_["prim"]
+    args = type_.get("args", [])
+    if prim in ("int", "nat", "mutez"):
+        return int(node["int"])
+    if prim == "timestamp":
+        return int(node["int"]) if "int" in node else node["string"]
+    if prim in ("address", "contract"):
+        return node["string"] if "string" in node else decode_address(bytes.fromhex(node["bytes"]))
+    if prim in ("string", "key", "key_hash", "signature", "chain_id"):
+        return node.get("string", node.get("bytes"))
+    if prim == "bytes":
+        return bytes.fromhex(node["bytes"])
+    if prim == "bool":
+        return node["prim"] == "True"
+    if prim == "unit":
+        return None
+    if prim == "option":
+        return None if node["prim"] == "None" else decode(args[0], node["args"][0])
+    if prim in ("list", "set"):
+        return [decode(args[0], item) for item in node]
+    if prim in ("map", "big_map"):
+        if isinstance(node, dict):
+            return int(node["int"])
+        return {_hashable(decode(args[0], elt["args"][0])): decode(args[1], elt["args"][1]) for elt in node}
+    if prim == "pair":
+        if len(args) > 2:
+            args = [args[0], {"prim": "pair", "args": args[1:]}]
+        values = node["args"] if isinstance(node, dict) else node
+        if len(values) > 2:
+            values = [values[0], {"prim": "Pair", "args": values[1:]}]
+        fields = field_paths(type_)
+        if fields and all(len(path) for path, _ in fields.values()):
+            result = {}
+            for t, v in zip(args, values):
+                name = field_name(t)
+                decoded = decode(t, v)
+                if name is not None:
+                    result[name] = decoded
+                else:
+                    result.update(decoded)
+            return result
+        return tuple(decode(t, v) for t, v in zip(args, values))
+    if prim == "or":
+        side = 0 if node["prim"] == "Left" else 1
+        value = decode(args[side], node["args"][0])
+        name = field_name(args[side])
+        return {name: value} if name is not None else value
+    raise ValueError("cannot decode %s" % prim)
+
+
+def _hashable(value):
+    return tuple(value.items()) if isinstance(value, dict) else value
+
+
+# Binary Micheline, as forged or packed (after the 0x05 of PACK). Buffers are
+# read through a memoryview, so slicing copies nothing until a value is built.
+
+def _read_zarith(data, offset):
+    byte = data[offset]
+    value = byte & 0x3F
+    negative = byte & 0x40
+    shift = 6
+    offset += 1
+    while byte & 0x80:
+        byte = data[offset]
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        offset += 1
+    return -value if negative else value, offset
+
+
+def _read_length(data, offset):
+    return int.from_bytes(data[offset:offset + 4], "big"), offset + 4
+
+
+def unforge(data, offset=0):
+    """``(JSON Micheline node, end offset)`` of the binary node at ``offset``, the inverse of ``forge``."""
+    data = memoryview(data)
+    tag = data[offset]
+    offset += 1
+    if tag == 0:
+        value, offset = _read_zarith(data, offset)
+        return {"int": str(value)}, offset
+    if tag in (1, 10):
+        length, offset = _read_length(data, offset)
+        body = data[offset:offset + length]
+        return ({"string": str(body, "utf-8")} if tag == 1 else {"bytes": body.hex()}), offset + length
+    if tag == 2:
+        length, offset = _read_length(data, offset)
+        end = offset + length
+        items = []
+        while offset < end:
+            item, offset = unforge(data, offset)
+            items.append(item)
+        return items, offset
+    node = {"prim": PRIMITIVES[data[offset]]}
+    offset += 1
+    if tag == 9:
+        length, offset = _read_length(data, offset)
+        end = offset + length
+        args = []
+        while offset < end:
+            arg, offset = unforge(data, offset)
+            args.append(arg)
+        annotated = True
+    else:
+        args = []
+        for _ in range((tag - 3) // 2):
+            arg, offset = unforge(data, offset)
+            args.append(arg)
+        annotated = tag % 2 == 0
+    if args:
+        node["args"] = args
+    if annotated:
+        length, offset = _read_length(data, offset)
+        if length:
+            node["annots"] = str(data[offset:offset + length], "utf-8").split(" ")
+        offset += length
+    return node, offset
+
+
+def _generic_reader(type_):
+    # forms the typed readers do not expect (combs, legacy encodings)
+    def read(data, offset):
+        node, offset = unforge(data, offset)
+        return decode(type_, node), offset
+    return read
+
+
+def reader(type_, binary_addresses=False):
+    """``read(data, offset) -> (value, end offset)`` for binary data of a Michelson type.
+
+    The reader is built once per type and gives the same values as
+    ``decode``, without building the JSON nodes; with ``binary_addresses``,
+    addresses are left as their 22-byte form (see ``decode_addresses``).
+    """
+    prim = type_["prim"]
+    args = type_.get("args", [])
+    generic = _generic_reader(type_)
+    if prim in ("int", "nat", "mutez"):
+        def read(data, offset):
+            if data[offset] != 0:
+                return generic(data, offset)
+            return _read_zarith(data, offset + 1)
+    elif prim in ("address", "contract"):
+        def read(data, offset):
+            if data[offset] != 10:
+                address, offset = generic(data, offset)
+                return (encode_address(address) if binary_addresses else address), offset
+            key = bytes(data[offset + 5:offset + 27])
+            return key if binary_addresses else decode_address(key), offset + 27
+    elif prim == "bytes":
+        def read(data, offset):
+            length, start = _read_length(data, offset + 1)
+            return bytes(data[start:start + length]), start + length
+    elif prim == "string":
+        def read(data, offset):
+            length, start = _read_length(data, offset + 1)
+            return str(data[start:start + length], "utf-8"), start + length
+    elif prim in ("bool", "unit"):
+        true = PRIMITIVE_CODES["True"]
+
+        def read(data, offset):
+            if data[offset] != 3:
+                return generic(data, offset)
+            return (data[offset + 1] == true if prim == "bool" else None), offset + 2
+    elif prim == "option":
+        inner = reader(args[0], binary_addresses)
+
+        def read(data, offset):
+            if data[offset] == 3:
+                return None, offset + 2
+            return inner(data, offset + 2)
+    elif prim in ("list", "set", "map", "big_map"):
+        item = reader(args[0], binary_addresses)
+        value = reader(args[1], binary_addresses) if prim in ("map", "big_map") else None
+
+        def read(data, offset):
+            if data[offset] != 2:
+                return generic(data, offset)
+            length, offset = _read_length(data, offset + 1)
+            end = offset + length
+            if value is None:
+                items = []
+                while offset < end:
+                    decoded, offset = item(data, offset)
+                    items.append(decoded)
+                return items, offset
+            items = {}
+            while offset < end:
+                # Elt key value
+                key, offset = item(data, offset + 2)
+                items[_hashable(key)], offset = value(data, offset)
+            return items, offset
+    elif prim == "pair" and len(args) == 2:
+        readers = [reader(arg, binary_addresses) for arg in args]
+        names = [field_name(arg) for arg in args]
+        fields = field_paths(type_)
+        record = bool(fields) and all(len(path) for path, _ in fields.values())
+
+        def read(data, offset):
+            if data[offset] != 7:
+                return generic(data, offset)
+            left, offset = readers[0](data, offset + 2)
+            right, offset = readers[1](data, offset)
+            if not record:
+                return (left, right), offset
+            result = {}
+            for name, decoded in zip(names, (left, right)):
+                if name is not None:
+                    result[name] = decoded
+                else:
+                    result.update(decoded)
+            return result, offset
+    elif prim == "or":
+        sides = [reader(arg, binary_addresses) for arg in args]
+        names = [field_name(arg) for arg in args]
+        right = PRIMITIVE_CODES["Right"]
+
+        def read(data, offset):
+            side = 1 if data[offset + 1] == right else 0
+            decoded, offset = sides[side](data, offset + 2)
+            return ({names[side]: decoded} if names[side] is not None else decoded), offset
+    else:
+        read = generic
+    return read
+
+
+def unpack(type_, data):
+    """Value of the bytes of ``PACK`` (or forged bytes) of a Michelson type."""
+    data = memoryview(data)
+    offset = 1 if data[0] == 5 else 0
+    value, offset = reader(type_)(data, offset)
+    if offset != len(data):
+        raise ValueError("%d trailing bytes" % (len(data) - offset))
+    return value
+
+
+_BASE58_PAIRS = [a + b for a in BASE58_ALPHABET for b in BASE58_ALPHABET]
+
+
+def decode_addresses(keys):
+    """``decode_address`` of many 22-byte addresses, base58 digits being computed two at a time."""
+    prefixes = {tag: prefix for tag, (_, prefix) in IMPLICIT_TAGS.items()}
+    sha256 = hashlib.sha256
+    result = []
+    for key in keys:
+        data = ORIGINATED_PREFIX + key[1:21] if key[0] == 1 else prefixes[key[1]] + key[2:22]
+        data += sha256(sha256(data).digest()).digest()[:4]
+        n = int.from_bytes(data, "big")
+        digits = []
+        while n:
+            n, r = divmod(n, len(_BASE58_PAIRS))
+            digits.append(_BASE58_PAIRS[r])
+        # the prefixes make every address start with a nonzero digit
+        result.append("".join(reversed(digits)).lstrip("1"))
+    return result
+
+
+def iter_entries(type_, data, offset=0, binary_addresses=False):
+    """Stream of ``(key, value)`` of a binary map (or packed map) of type ``type_``, without building the map."""
+    data = memoryview(data)
+    if data[offset] == 5:
+        offset += 1
+    if data[offset] != 2:
+        raise ValueError("not a sequence at %d" % offset)
+    read_key = reader(type_["args"][0], binary_addresses)
+    read_value = reader(type_["args"][1], binary_addresses)
+    length, offset = _read_length(data, offset + 1)
+    end = offset + length
+    while offset < end:
+        key, offset = read_key(data, offset + 2)
+        value, offset = read_value(data, offset)
+        yield key, value
+
+
+def iter_balances(type_, data, offset=0, batch=4096):
+    """Stream of ``(address, balance, lock)`` of a binary map of balances.
+
+    The values are either balances or records with a ``balance`` field and
+    optional ``lock`` and ``until`` fields: ``lock`` is ``False`` without
+    them, and the ``until`` of a locked record when it is set. Addresses are
+    decoded in batches of ``batch`` with ``decode_addresses``.
+    """
+    keys, balances, locks = [], [], []
+    for key, value in iter_entries(type_, data, offset, binary_addresses=True):
+        keys.append(key)
+        if isinstance(value, dict):
+            balances.append(value["balance"])
+            lock = value.get("lock", False)
+            locks.append(value["until"] if lock and value.get("until") is not None else lock)
+        else:
+            balances.append(value)
+            locks.append(False)
+        if len(keys) == batch:
+            yield from zip(decode_addresses(keys), balances, locks)
+            keys, balances, locks = [], [], []
+    yield from zip(decode_addresses(keys), balances, locks)
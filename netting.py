@@ -0,0 +1,239 @@
+"""Netting of the administrator transfers of a redistribution.
+
+While ``transferStatus`` is false only the administrator can call
+``transfer``, and the corrections made in these windows (airdrop fixes,
+custody wallets consolidation) are long lists of transfers, many of which
+cancel each other. Only the final balances matter: the transfers are summed
+into the net change of each address, then replaced by transfers with the
+same changes, each address losing tokens sending to the addresses gaining
+tokens. For ``n`` addresses whose balance changes there are at most ``n - 1``
+of them, and no address both sends and receives. The matching is greedy and
+not minimal: the fewest transfers would need the largest partition of the
+changes into groups summing to zero, a subset sum problem.
+
+The net transfers are checked on the current balances and locks with the
+contract's rules (``ledger.py``): a sender must hold the tokens it sends and
+must not be locked, while a locked address can still receive. They are then
+packed into ``transfer`` calls, one group per sender, within the gas and size
+limits of an operation, the gas being that of the ``transfer`` results of
+``bench.py`` (``--bench``, as in ``royalties.py``). Each call is printed as a
+JSON line; the summary is printed on stderr::
+
+    python netting.py plan.csv --indexer snapshotdir > calls.jsonl
+    python netting.py plan.csv --holders holders.csv --bench bench.json > calls.jsonl
+
+where ``plan.csv`` has one ``from,to,amount`` line per planned transfer, in
+any order, and ``holders.csv`` one ``address,balance[,lock]`` line per
+holder, the lock being ``1`` (or ``true``) for a lock for good, or the end of
+the lock as a timestamp (seconds or ISO 8601). Locks, from the CSV file or
+the indexer, are compared with ``--now``, the time the calls are expected to
+be included at (the current time by default).
+"""
+
+import argparse
+import collections
+import csv
+import json
+import sys
+import time
+
+from indexer import Indexer, timestamp
+from ledger import TOKEN_ID, TRANSFER_TYPE, Failure, Ledger
+from micheline import encode, field_paths, forge
+from royalties import limit_arguments, read_limits
+
+
+ADMINISTRATOR = "administrator"
+PARAMETER_TYPE = {"prim": "list", "args": [TRANSFER_TYPE]}
+
+
+def net_changes(transfers):
+    """``address -> change of balance`` of a list of ``(from, to, amount)``, without the zero changes."""
+    changes = collections.defaultdict(int)
+    for fromAddr, toAddr, amount in transfers:
+        if amount < 0:
+            raise ValueError("negative amount from %s to %s" % (fromAddr, toAddr))
+        changes[fromAddr] -= amount
+        changes[toAddr] += amount
+    return {address: change for address, change in changes.items() if change}
+
+
+def settle(changes):
+    """``(from, to, amount)`` transfers making the balance ``changes``, at most ``len(changes) - 1``.
+
+    A sender and a receiver whose changes are equal are paired first, so they
+    need one transfer only; the others are matched largest first, each
+    transfer emptying the change of its sender or of its receiver (the last
+    one empties both). This bounds the count, it does not minimize it.
+    """
+    senders = sorted((-change, address) for address, change in changes.items() if change < 0)
+    receivers = collections.defaultdict(list)
+    for address, change in sorted(changes.items()):
+        if change > 0:
+            receivers[change].append(address)
+    result = []
+    unmatched = []
+    for amount, address in senders:
+        if receivers.get(amount):
+            result.append((address, receivers[amount].pop(), amount))
+        else:
+            unmatched.append([amount, address])
+    rest = sorted(([amount, address] for amount, addresses in receivers.items() for address in addresses), reverse=True)
+    unmatched.sort(reverse=True)
+    i = 0
+    for sender in unmatched:
+        while sender[0]:
+            receiver = rest[i]
+            amount = min(sender[0], receiver[0])
+            result.append((sender[1], receiver[1], amount))
+            sender[0] -= amount
+            receiver[0] -= amount
+            if not receiver[0]:
+                i += 1
+    return result
+
+
+def groups(transfers):
+    """FA2 ``transfer`` groups of ``(from, to, amount)`` transfers, one per sender."""
+    txs = collections.defaultdict(list)
+    for fromAddr, toAddr, amount in transfers:
+        txs[fromAddr].append({"to_": toAddr, "token_id": TOKEN_ID, "amount": amount})
+    return [{"from_": fromAddr, "txs": items} for fromAddr, items in sorted(txs.items())]
+
+
+def check(groups, holders, now=0):
+    """``(sender, error)`` of the groups the contract would reject at ``now``.
+
+    ``holders`` is ``address -> (balance, lock)``, the lock being ``False``,
+    ``True`` for a lock for good, or the timestamp the lock ends at. Each
+    group is sent by the administrator alone on a model of the contract
+    holding the balances and locks of its senders; no sender receives
+    tokens, so the groups do not depend on each other.
+    """
+    ledger = Ledger(None, ADMINISTRATOR, None, None, None)
+    ledger.supplyLimit, ledger.saleLimit = 10**30, 0
+    ledger.now = now
+    senders = [group["from_"] for group in groups]
+    funded = [address for address in senders if holders.get(address, (0, False))[0] > 0]
+    if funded:
+        ledger.call("mintBatch", [{"toAddr": a, "amount": holders[a][0]} for a in funded], ADMINISTRATOR)
+        locks = collections.defaultdict(list)
+        for address in funded:
+            lock = holders[address][1]
+            if lock is not False:
+                locks[None if lock is True else lock].append(address)
+        for until, addresses in locks.items():
+            ledger.call("lockAddresses", {"addresses": addresses, "until": until}, ADMINISTRATOR)
+    errors = []
+    for group in groups:
+        try:
+            ledger.call("transfer", [group], ADMINISTRATOR)
+        except Failure as failure:
+            errors.append((group["from_"], str(failure)))
+    return errors
+
+
+def plan(groups, limits):
+    """Split the ``groups`` into ``transfer`` calls within ``limits``.
+
+    A sender with too many transfers for one call has a group in each of
+    several calls. The debit of a group is counted as one more transfer.
+    """
+    tx_type = field_paths(TRANSFER_TYPE)["txs"][1]["args"][0]
+    base = len(forge(encode(PARAMETER_TYPE, [])))
+    calls = []
+    call, size, count = [], base, 0
+    for group in groups:
+        header = len(forge(encode(TRANSFER_TYPE, {"from_": group["from_"], "txs": []})))
+        current = None
+        for tx in group["txs"]:
+            item = len(forge(encode(tx_type, tx)))
+            added = item + (header if current is None else 0)
+            extra = 2 if current is None else 1
+            full = (count + extra > limits.max_transfers
+                    or size + added > limits.max_bytes
+                    or limits.call_gas + limits.transfer_gas * (count + extra) > limits.max_gas)
+            if full and call:
+                calls.append(call)
+                call, size, count, current = [], base, 0, None
+                added, extra = item + header, 2
+            if current is None:
+                current = {"from_": group["from_"], "txs": []}
+                call.append(current)
+            current["txs"].append(tx)
+            size += added
+            count += extra
+    if call:
+        calls.append(call)
+    return calls
+
+
+def summary(transfers, net, calls, errors):
+    return {
+        "transfers": len(transfers),
+        "volume": sum(amount for _, _, amount in transfers),
+        "netTransfers": len(net),
+        "netVolume": sum(amount for _, _, amount in net),
+        "senders": len({fromAddr for fromAddr, _, _ in net}),
+        "receivers": len({toAddr for _, toAddr, _ in net}),
+        "calls": len(calls),
+        "rejected": [{"address": address, "error": error} for address, error in errors],
+    }
+
+
+def read_transfers(path):
+    with open(path, newline="") as f:
+        return [(row[0].strip(), row[1].strip(), int(row[2])) for row in csv.reader(f) if row]
+
+
+def read_lock(text):
+    text = text.strip()
+    if text.lower() in ("", "0", "false", "no"):
+        return False
+    if text.lower() in ("1", "true", "yes"):
+        return True
+    return timestamp(text)
+
+
+def read_holders(path):
+    with open(path, newline="") as f:
+        return {row[0].strip(): (int(row[1]), read_lock(row[2]) if len(row) > 2 else False)
+                for row in csv.reader(f) if row}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("plan", help="from,to,amount CSV file")
+    parser.add_argument("--holders", help="address,balance[,lock] CSV file")
+    parser.add_argument("--indexer", help="snapshot directory of indexer.py")
+    limit_arguments(parser)
+    parser.add_argument("--now", type=timestamp, help="time the locks are compared with (now by default)")
+    args = parser.parse_args(argv)
+
+    transfers = read_transfers(args.plan)
+    net = settle(net_changes(transfers))
+    senders = groups(net)
+    if args.indexer:
+        try:
+            indexer = Indexer(None, args.indexer, readonly=True)
+        except FileNotFoundError as error:
+            parser.error(str(error))
+        holders = {group["from_"]: indexer.snapshot.get(group["from_"]) for group in senders}
+        indexer.close()
+    elif args.holders:
+        holders = read_holders(args.holders)
+    else:
+        parser.error("--holders or --indexer is required")
+
+    limits = read_limits(parser, args, "transfer")
+    errors = check(senders, holders, int(time.time()) if args.now is None else args.now)
+    calls = [] if errors else plan(senders, limits)
+    for call in calls:
+        sys.stdout.write(json.dumps(call) + "\n")
+    sys.stderr.write(json.dumps(summary(transfers, net, calls, errors), indent=1) + "\n")
+    if errors:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
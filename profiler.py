@@ -0,0 +1,275 @@
+"""Gas profile of the CVR entry points, attributed to the lines of ``cvr.py``.
+
+Each case is run by ``octez-client run script --trace-stack`` in a mockup
+where the contract is originated and seeded as in ``bench.py``, so the big
+maps are real. The gas consumed by every traced instruction is attributed to
+the instruction of the compiled script at its location, then to the SmartPy statements
+around it: SmartPy writes each statement as a comment before its code, with
+the ``Entry point:`` it belongs to. Statements are found back in ``cvr.py`` by
+their text, so the code of inlined helpers (``creditBalance``, ``checkLimit``,
+``mintSale``...) is shown under the helper they come from.
+
+The output is a folded stack file, one ``frame;frame;...;INSTRUCTION milligas``
+line per path, for ``flamegraph.pl`` or speedscope; the totals per entry point
+and per line of ``cvr.py`` are printed::
+
+    python profiler.py --contract compiled/cvr.tz --storage compiled/storage.tz --accounts 1000 --lists 10 \\
+        --entrypoints transfer,dispatchRoyalties -o profile.folded
+    python profiler.py --contract compiled/cvr.tz --trace trace.txt --entrypoint transfer -o transfer.folded
+
+The script must be the one SmartPy compiles from ``cvr.py``, with its
+comments.
+
+``--trace`` folds the output of a ``run script --trace-stack`` made by hand.
+Lambdas stored in the storage have their own locations, so the lazy entry
+points are profiled from a compilation where they are not lazy.
+"""
+
+import argparse
+import collections
+import difflib
+import re
+import sys
+
+from bench import ROLES, Bench, Mockup
+from micheline import encode, expand, parse, to_michelson
+
+
+TRACE_LINE = re.compile(r"- location: (\d+) \((?:just consumed gas: ([\d.]+)|remaining gas: ([\d.]+))")
+ENTRY_POINT = re.compile(r"#\s*Entry point: (\w+)")
+STATEMENT = re.compile(r"^(\s*)#\s*(.*?)\s*#\s*(?:[^#]*)$")
+DEFINITION = re.compile(r"^(\s*)def (\w+)\(")
+MATCH_CUTOFF = 0.6
+
+
+def locations(script):
+    """``(line of the script, primitive or None)`` of each node of the expanded script, by location.
+
+    Locations number the nodes of the script (sequences and literals
+    included) in depth-first order, as in ``octez-client`` traces; nodes
+    without a line take the line of their parent.
+    """
+    result = []
+
+    def walk(node, line):
+        if isinstance(node, dict):
+            line = node.get("line", line)
+        result.append((line, node.get("prim") if isinstance(node, dict) else None))
+        for child in node if isinstance(node, list) else node.get("args", []):
+            walk(child, line)
+
+    walk(expand(script), 1)
+    return result
+
+
+class Source:
+    """Statements of ``cvr.py``, with the ``def`` enclosing each of them."""
+
+    def __init__(self, path):
+        self.statements = []
+        functions = []
+        with open(path) as f:
+            lines = f.read().split("\n")
+        pending = None
+        for number, text in enumerate(lines, 1):
+            code = text.strip()
+            if pending is not None:
+                pending[2] += " " + code
+            elif not code or code.startswith(("#", "@")):
+                continue
+            else:
+                indent = len(text) - len(text.lstrip())
+                while functions and functions[-1][0] >= indent:
+                    functions.pop()
+                definition = DEFINITION.match(text)
+                if definition:
+                    functions.append((indent, definition.group(2)))
+                    continue
+                if not functions:
+                    continue
+                pending = [number, functions[-1][1], code]
+            if _balanced(pending[2]):
+                self.statements.append(tuple(pending))
+                pending = None
+        self.keys = [_normalize(text) for _, _, text in self.statements]
+        self.cache = {}
+
+    def find(self, statement, entrypoint):
+        """``(line, function)`` of the statement of ``cvr.py`` closest to a SmartPy comment."""
+        if statement not in self.cache:
+            key = _normalize(statement)
+            best, best_ratio = None, MATCH_CUTOFF
+            for (line, function, _), candidate in zip(self.statements, self.keys):
+                matcher = difflib.SequenceMatcher(None, key, candidate, autojunk=False)
+                # statements of the entry point itself win ties with inlined helpers
+                bonus = 0.01 if function == entrypoint else 0
+                if matcher.real_quick_ratio() + bonus <= best_ratio or matcher.quick_ratio() + bonus <= best_ratio:
+                    continue
+                ratio = matcher.ratio() + bonus
+                if ratio > best_ratio:
+                    best, best_ratio = (line, function), ratio
+            self.cache[statement] = best
+        return self.cache[statement]
+
+
+def _balanced(text):
+    return text.count("(") <= text.count(")") and text.count("[") <= text.count("]")
+
+
+def _normalize(text):
+    text = re.sub(r"\bsp\.(for|if|while|else)\b", r"\1", text)
+    text = text.replace("'", '"').replace("sp.as_nat", "").replace("...", "")
+    return re.sub(r"\s+", "", text).rstrip(":")
+
+
+def statement_stacks(path):
+    """For each line of the script: ``(entry point, [SmartPy statements around it])``.
+
+    A comment opens a statement at its indentation, closed by the next
+    comment or line indented as much or less.
+    """
+    stacks = [None]
+    entry, statements = [], []
+    with open(path) as f:
+        for text in f:
+            indent = len(text) - len(text.lstrip())
+            if text.strip():
+                while entry and entry[-1][0] > indent:
+                    entry.pop()
+                while statements and statements[-1][0] > indent:
+                    statements.pop()
+            comment = text.strip().startswith("#")
+            entry_point = ENTRY_POINT.search(text) if comment else None
+            if entry_point:
+                while entry and entry[-1][0] >= indent:
+                    entry.pop()
+                entry.append((indent, entry_point.group(1)))
+                statements = [s for s in statements if s[0] < indent]
+            elif comment:
+                match = STATEMENT.match(text.rstrip("\n"))
+                if match:
+                    while statements and statements[-1][0] >= indent:
+                        statements.pop()
+                    statements.append((indent, match.group(2)))
+            stacks.append((entry[-1][1] if entry else "dispatch", [s for _, s in statements]))
+    return stacks
+
+
+def read_trace(output):
+    """``[(location, milligas)]`` of an ``octez-client --trace-stack`` output."""
+    steps = []
+    remaining = None
+    for match in TRACE_LINE.finditer(output):
+        location = int(match.group(1))
+        if match.group(2) is not None:
+            steps.append((location, round(float(match.group(2)) * 1000)))
+        else:
+            left = float(match.group(3))
+            steps.append((location, 0 if remaining is None else round((remaining - left) * 1000)))
+            remaining = left
+    return steps
+
+
+class Profile:
+    def __init__(self, script_path, source_path="cvr.py"):
+        with open(script_path) as f:
+            text = f.read()
+        self.locations = locations(parse(text))
+        self.stacks = statement_stacks(script_path)
+        self.source = Source(source_path)
+        self.folded = collections.Counter()
+        self.by_entrypoint = collections.Counter()
+        self.by_line = collections.Counter()
+
+    def frames(self, location):
+        """Frames of an instruction: entry point, then helpers and statements of ``cvr.py``."""
+        if location >= len(self.locations):
+            return ["unknown location"], None
+        entrypoint, statements = self.stacks[self.locations[location][0]]
+        frames = [entrypoint]
+        function = entrypoint
+        line = None
+        for statement in statements:
+            found = self.source.find(statement, entrypoint)
+            if found is None:
+                frames.append(statement.replace(";", ","))
+                continue
+            line, owner = found
+            if owner != function:
+                frames.append(owner)
+                function = owner
+            frames.append("cvr.py:%d %s" % (line, statement.replace(";", ",")[:80]))
+        return frames, line
+
+    def add(self, steps, label=None):
+        """Fold the ``(location, milligas)`` of a trace."""
+        for location, milligas in steps:
+            frames, line = self.frames(location)
+            if label:
+                # the case (with its list size) replaces the entry point
+                frames[0] = label
+            instruction = self.locations[location][1] if location < len(self.locations) else None
+            self.folded[";".join(frames + [instruction or "?"])] += milligas
+            self.by_entrypoint[frames[0]] += milligas
+            self.by_line[(frames[0], line)] += milligas
+
+    def write(self, f):
+        for stack, milligas in sorted(self.folded.items()):
+            if milligas:
+                f.write("%s %d\n" % (stack, milligas))
+
+    def report(self, f, top=20):
+        for entrypoint, milligas in self.by_entrypoint.most_common():
+            f.write("%-24s %12.3f gas\n" % (entrypoint, milligas / 1000))
+            lines = [(line, m) for (e, line), m in self.by_line.items() if e == entrypoint]
+            for line, m in sorted(lines, key=lambda item: -item[1])[:top]:
+                f.write("    %-18s %12.3f\n" % ("cvr.py:%s" % line if line else "(dispatch)", m / 1000))
+
+
+def run_case(mockup, bench, entrypoint, role, value, amount):
+    """Trace of one call made by ``role`` on the current storage of the contract."""
+    storage = mockup.run("get", "contract", "storage", "for", "cvr").strip()
+    contract = mockup.run("show", "known", "contract", "cvr").strip()
+    source = mockup.addresses[ROLES[role]]
+    return mockup.run("run", "script", bench.script_path, "on", "storage", storage,
+                      "and", "input", to_michelson(encode(bench.entrypoints[entrypoint], value)),
+                      "--entrypoint", entrypoint, "--amount", "%.6f" % (amount / 10**6),
+                      "--source", source, "--payer", source, "--self-address", contract, "--trace-stack")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--contract", required=True, help="script compiled from cvr.py by SmartPy")
+    parser.add_argument("--source", default="cvr.py")
+    parser.add_argument("--storage", help="initial storage as compiled by SmartPy")
+    parser.add_argument("--client", default="octez-client")
+    parser.add_argument("--protocol")
+    parser.add_argument("--accounts", type=int, default=1000)
+    parser.add_argument("--lists", default="10", help="list sizes of the list entry points")
+    parser.add_argument("--entrypoints", default="transfer,dispatchRoyalties")
+    parser.add_argument("--trace", help="fold this trace instead of running the cases")
+    parser.add_argument("--entrypoint", help="label of the --trace")
+    parser.add_argument("--output", "-o", default="profile.folded")
+    args = parser.parse_args(argv)
+
+    profile = Profile(args.contract, args.source)
+    if args.trace:
+        with open(args.trace) as f:
+            profile.add(read_trace(f.read()), args.entrypoint)
+    else:
+        wanted = args.entrypoints.split(",")
+        bench = Bench(Mockup(args.client, args.protocol), args.contract, args.storage)
+        bench.originate()
+        bench.seed(args.accounts)
+        for size in [None] + [int(n) for n in args.lists.split(",") if n]:
+            for entrypoint, role, value, amount in bench.cases(size):
+                if entrypoint in wanted and entrypoint in bench.entrypoints:
+                    label = entrypoint if size is None else "%s[%d]" % (entrypoint, size)
+                    profile.add(read_trace(run_case(bench.mockup, bench, entrypoint, role, value, amount)), label)
+    with open(args.output, "w") as f:
+        profile.write(f)
+    profile.report(sys.stdout)
+
+
+if __name__ == "__main__":
+    main()
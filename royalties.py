@@ -0,0 +1,337 @@
+"""Plan of the ``dispatchRoyalties`` calls of one royalty round.
+
+Every call of a round must carry the same ``amount`` and be made with the same
+``circulatingSupply``, since the share of each holder is
+``balance * 10**10 // (circulatingSupply * 10**10 // amount + 1)``. The planner
+computes these shares exactly as the contract does, drops the holders whose
+share is zero (the contract skips them but they still cost gas), and packs the
+others into calls that stay under the gas, size and transfer limits of an
+operation. Each call is printed as a JSON line with the XTZ to attach; the
+reconciliation (total paid and dust left in the contract) is printed on stderr::
+
+    python royalties.py --amount 1000000 --indexer snapshotdir > calls.jsonl
+    python royalties.py --amount 1000000 --supply 2500000000 --holders holders.csv
+
+The gas of a call and of each transfer are fitted on the results of
+``bench.py`` for the compiled contract, read from its report (``bench.json``
+by default, ``--bench``), and so is the largest list when it was run with
+``--find-limits``. ``--call-gas`` and ``--transfer-gas`` give them instead.
+
+With ``--what-if AMOUNT ...`` nothing is planned: the reconciliation of
+each amount is printed, and again with the supply and balances after the
+``--burn ADDRESS=AMOUNT`` not made yet, every amount being computed on the
+same array of balances.
+
+The shares are computed on ``numpy`` arrays (``requirements.txt``), with the
+same integer results as the contract (see ``payout_table``); lists are used
+where numpy cannot be installed.
+
+With ``--snapshot ID`` the calls pay the balances of a snapshot taken by the
+contract, so transfers need not be paused during the round; the holders and
+``--supply`` must then be those of the snapshot (``balanceAt`` and
+``supplyAt`` views), not the current ones of the indexer.
+"""
+
+import argparse
+import csv
+import json
+import sys
+
+from indexer import Indexer
+from ledger import ENTRYPOINT_TYPES, ROYALTY_ROUNDING
+from micheline import encode, field_paths, forge
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+MAX_OPERATION_GAS = 1040000
+MAX_OPERATION_BYTES = 32768
+OPERATION_OVERHEAD = 256
+SAFETY = 0.9
+INT64_MAX = 2**63 - 1
+CHUNK = 1 << 18
+
+
+def divisor(supply, amount):
+    """``muCVRtez`` of the contract for a round of ``amount`` mutez."""
+    if amount <= 0:
+        raise ValueError("amount must be positive")
+    return supply * ROYALTY_ROUNDING // amount + 1
+
+
+def payouts(balances, supply, amount):
+    """Mutez paid by ``dispatchRoyalties`` for each balance, 0 for the balances it skips.
+
+    ``balances`` is a numpy ``int64`` array when numpy is installed, a list
+    otherwise (see ``payout_table``).
+    """
+    return payout_table(balances, [divisor(supply, amount)])[0]
+
+
+def payout_table(balances, divisors):
+    """Mutez paid to each of ``balances`` (columns) for each ``muCVRtez`` of ``divisors`` (rows).
+
+    With a numpy array of balances, the rounds are broadcast over the
+    balances as one 2-D array. ``balance * 10**10`` does not fit in 64 bits,
+    so the quotient is computed by long division: ``balance = q * mu + r``,
+    then the remainder is multiplied by as large a power of ten as fits and
+    divided again, until the ten digits of the rounding are done. The rounds
+    are grouped by that power of ten, usually the same for all of them.
+    """
+    if numpy is None or not isinstance(balances, numpy.ndarray):
+        return [[balance * ROYALTY_ROUNDING // mu if balance * ROYALTY_ROUNDING > mu else 0 for balance in balances]
+                for mu in divisors]
+    result = numpy.zeros((len(divisors), len(balances)), dtype=numpy.int64)
+    groups = {}
+    for row, mu in enumerate(divisors):
+        steps = len(str(INT64_MAX // mu)) - 1 if mu <= INT64_MAX else 0
+        if steps:
+            groups.setdefault(steps, []).append(row)
+        elif mu // ROYALTY_ROUNDING < INT64_MAX:
+            # mu does not fit in 64 bits with a digit to spare: only the few balances above mu // 10**10 are paid
+            paid = numpy.flatnonzero(balances > mu // ROYALTY_ROUNDING)
+            result[row, paid] = [balance * ROYALTY_ROUNDING // mu for balance in balances[paid].tolist()]
+    digits = len(str(ROYALTY_ROUNDING)) - 1
+    for steps, rows in groups.items():
+        mu = numpy.array([divisors[row] for row in rows], dtype=numpy.int64)[:, None]
+        width = max(CHUNK // len(rows), 1)
+        for start in range(0, len(balances), width):
+            chunk = balances[None, start:start + width]
+            quotient, remainder = numpy.divmod(chunk, mu)
+            quotient *= ROYALTY_ROUNDING
+            left = digits
+            while left:
+                step = min(steps, left)
+                high, remainder = numpy.divmod(remainder * 10**step, mu)
+                quotient += high * 10**(left - step)
+                left -= step
+            # balance * 10**10 > mu, for integers
+            quotient[chunk <= mu // ROYALTY_ROUNDING] = 0
+            result[rows, start:start + width] = quotient
+    return result
+
+
+def balance_array(holders):
+    """Balances of ``(address, balance)`` holders, as an array when numpy is installed."""
+    if numpy is None:
+        return [balance for _, balance in holders]
+    return numpy.fromiter((balance for _, balance in holders), dtype=numpy.int64, count=len(holders))
+
+
+def shares(holders, supply, amount):
+    """``(address, mutez)`` paid by ``dispatchRoyalties`` to each of ``holders``.
+
+    Holders the contract would skip are left out.
+    """
+    paid = payouts(balance_array(holders), supply, amount)
+    if numpy is not None and isinstance(paid, numpy.ndarray):
+        return [(holders[i][0], int(paid[i])) for i in numpy.flatnonzero(paid)]
+    return [(address, mutez) for (address, _), mutez in zip(holders, paid) if mutez]
+
+
+def what_if(holders, supply, amounts, burns=None):
+    """Reconciliation of a round for each of ``amounts``, and again after ``burns``.
+
+    ``burns`` maps addresses to the tokens they will burn before the round.
+    The balances are read once and every scenario is computed on them in one
+    ``payout_table``; only the burning holders are computed again.
+    """
+    burns = burns or {}
+    balances = balance_array(holders)
+    listed = sum(balances if isinstance(balances, list) else balances.tolist())
+    indexes = {address: i for i, (address, _) in enumerate(holders) if address in burns}
+    for address, tokens in burns.items():
+        if address not in indexes or holders[indexes[address]][1] < tokens:
+            raise ValueError("%s cannot burn %d tokens" % (address, tokens))
+    scenarios = [(amount, {}) for amount in amounts] + [(amount, burns) for amount in amounts if burns]
+    supplies = [supply - sum(burned.values()) for _, burned in scenarios]
+    divisors = [divisor(supply_after, amount) for (amount, _), supply_after in zip(scenarios, supplies)]
+    if isinstance(balances, list):
+        table = payout_table(balances, divisors)
+        totals = [sum(paid) for paid in table]
+        counts = [sum(1 for mutez in paid if mutez) for paid in table]
+    else:
+        totals = numpy.zeros(len(divisors), dtype=numpy.int64)
+        counts = numpy.zeros(len(divisors), dtype=numpy.int64)
+        for start in range(0, len(balances), CHUNK):
+            table = payout_table(balances[start:start + CHUNK], divisors)
+            totals += table.sum(axis=1)
+            counts += numpy.count_nonzero(table, axis=1)
+        totals, counts = totals.tolist(), counts.tolist()
+    results = []
+    for (amount, burned), supply_after, mu, total, count in zip(scenarios, supplies, divisors, totals, counts):
+        for address, tokens in burned.items():
+            balance = holders[indexes[address]][1]
+            before, after = payout_table([balance, balance - tokens], [mu])[0]
+            total += after - before
+            count += bool(after) - bool(before)
+        results.append({
+            "amount": amount,
+            "burned": supply - supply_after,
+            "circulatingSupply": supply_after,
+            "muCVRtez": mu,
+            "holders": len(holders),
+            "paidHolders": count,
+            "skippedHolders": len(holders) - count,
+            "paid": total,
+            "dust": amount - total,
+            "unlistedSupply": supply_after - (listed - (supply - supply_after)),
+        })
+    return results
+
+
+class Limits:
+    def __init__(self, call_gas, transfer_gas, max_gas=MAX_OPERATION_GAS,
+                 max_bytes=MAX_OPERATION_BYTES, max_transfers=None, safety=SAFETY):
+        self.call_gas = call_gas
+        self.transfer_gas = transfer_gas
+        self.max_gas = max_gas * safety
+        self.max_bytes = (max_bytes - OPERATION_OVERHEAD) * safety
+        self.max_transfers = sys.maxsize if max_transfers is None else max_transfers
+
+    @classmethod
+    def from_bench(cls, path, entrypoint="dispatchRoyalties", **kwargs):
+        """Limits of ``entrypoint`` measured by ``bench.py``, read from its report at ``path``.
+
+        The gas of a call and of each transfer are fitted on the results for
+        two list sizes, so the call gas includes what the entry point costs
+        around its loop, such as unpacking a lazy entry point from its
+        big_map. The largest list found by ``--find-limits``, if any, is the
+        default ``max_transfers``.
+        """
+        with open(path) as f:
+            report = json.load(f)
+        results = [r for r in report["results"] if r["entrypoint"] == entrypoint and r["listSize"]]
+        if len({r["listSize"] for r in results}) < 2:
+            raise ValueError("%s needs %s results for two list sizes" % (path, entrypoint))
+        small = min(results, key=lambda r: r["listSize"])
+        large = max(results, key=lambda r: (r["listSize"], r["gas"]))
+        transfer_gas = (large["gas"] - small["gas"]) / (large["listSize"] - small["listSize"])
+        call_gas = max(r["gas"] - transfer_gas * r["listSize"] for r in results)
+        found = [sizes[entrypoint] for sizes in report.get("limits", {}).values() if entrypoint in sizes]
+        if found and kwargs.get("max_transfers") is None:
+            kwargs["max_transfers"] = min(found)
+        return cls(call_gas=call_gas, transfer_gas=transfer_gas, **kwargs)
+
+
+def limit_arguments(parser):
+    parser.add_argument("--bench", default="bench.json", help="bench.py report to take the gas costs from")
+    parser.add_argument("--call-gas", type=float, help="gas of a call without transfers, instead of --bench")
+    parser.add_argument("--transfer-gas", type=float, help="gas of each transfer, instead of --bench")
+    parser.add_argument("--max-transfers", type=int, help="transfers per call (the largest list of --bench by default)")
+
+
+def read_limits(parser, args, entrypoint):
+    """Limits of the command line: those of the bench report unless both gas costs are given."""
+    if (args.call_gas is None) != (args.transfer_gas is None):
+        parser.error("--call-gas and --transfer-gas go together")
+    if args.call_gas is not None:
+        return Limits(args.call_gas, args.transfer_gas, max_transfers=args.max_transfers)
+    try:
+        return Limits.from_bench(args.bench, entrypoint, max_transfers=args.max_transfers)
+    except FileNotFoundError:
+        parser.error("no bench report %s: run bench.py on the compiled contract, or give --call-gas and "
+                     "--transfer-gas" % args.bench)
+    except ValueError as error:
+        parser.error(str(error))
+
+
+def plan(payouts, amount, limits, parameter_type, snapshot=None):
+    """Split ``payouts`` into ``dispatchRoyalties`` calls within ``limits``."""
+    calls = []
+    addresses = []
+    total = 0
+    base = len(forge(encode(parameter_type, {"addresses": [], "amount": amount, "snapshotId": snapshot})))
+    size = base
+    address_type = field_paths(parameter_type)["addresses"][1]["args"][0]
+    for address, mutez in payouts:
+        item = len(forge(encode(address_type, address)))
+        full = (len(addresses) >= limits.max_transfers
+                or size + item > limits.max_bytes
+                or limits.call_gas + limits.transfer_gas * (len(addresses) + 1) > limits.max_gas)
+        if full and addresses:
+            calls.append({"addresses": addresses, "amount": amount, "snapshotId": snapshot, "mutez": total})
+            addresses, total, size = [], 0, base
+        addresses.append(address)
+        total += mutez
+        size += item
+    if addresses:
+        calls.append({"addresses": addresses, "amount": amount, "snapshotId": snapshot, "mutez": total})
+    return calls
+
+
+def reconcile(holders, supply, amount, payouts):
+    """Split of ``amount`` into what is paid and the dust left in the contract."""
+    paid = sum(mutez for _, mutez in payouts)
+    listed = sum(balance for _, balance in holders)
+    return {
+        "amount": amount,
+        "circulatingSupply": supply,
+        "muCVRtez": divisor(supply, amount),
+        "holders": len(holders),
+        "paidHolders": len(payouts),
+        "skippedHolders": len(holders) - len(payouts),
+        "paid": paid,
+        "dust": amount - paid,
+        "unlistedSupply": supply - listed,
+    }
+
+
+def read_holders(path):
+    with open(path, newline="") as f:
+        return [(row[0].strip(), int(row[1])) for row in csv.reader(f) if row]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--amount", type=int, help="mutez to share in the round")
+    parser.add_argument("--holders", help="address,balance CSV file")
+    parser.add_argument("--indexer", help="snapshot directory of indexer.py")
+    parser.add_argument("--supply", type=int, help="circulatingSupply (read from the indexer by default)")
+    limit_arguments(parser)
+    parser.add_argument("--snapshot", type=int, help="pay the balances of this snapshot id")
+    parser.add_argument("--what-if", type=int, nargs="+", metavar="AMOUNT", help="only print the reconciliations")
+    parser.add_argument("--burn", action="append", default=[], metavar="ADDRESS=AMOUNT", help="burn before the round")
+    args = parser.parse_args(argv)
+    if args.amount is None and not args.what_if:
+        parser.error("--amount or --what-if is required")
+    if args.snapshot is not None and not (args.holders and args.supply):
+        parser.error("--snapshot needs the --holders and --supply of the snapshot")
+
+    supply = args.supply
+    if args.indexer:
+        try:
+            indexer = Indexer(None, args.indexer, readonly=True)
+        except FileNotFoundError as error:
+            parser.error(str(error))
+        holders = [(address, balance) for address, balance, _ in indexer.snapshot.holders()]
+        if supply is None:
+            supply = indexer.reconcile()[1]
+        indexer.close()
+    elif args.holders:
+        holders = read_holders(args.holders)
+    else:
+        parser.error("--holders or --indexer is required")
+    if supply is None:
+        parser.error("--supply is required")
+
+    if args.what_if:
+        burns = {}
+        for burn in args.burn:
+            address, _, tokens = burn.partition("=")
+            burns[address] = burns.get(address, 0) + int(tokens)
+        sys.stdout.write(json.dumps(what_if(holders, supply, args.what_if, burns), indent=1) + "\n")
+        return
+
+    limits = read_limits(parser, args, "dispatchRoyalties")
+    payouts = shares(holders, supply, args.amount)
+    for call in plan(payouts, args.amount, limits, ENTRYPOINT_TYPES["dispatchRoyalties"], args.snapshot):
+        sys.stdout.write(json.dumps(call) + "\n")
+    sys.stderr.write(json.dumps(reconcile(holders, supply, args.amount, payouts), indent=1) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+from airdrop import MerkleTree, verify
+from micheline import IMPLICIT_PREFIXES, b58check_encode, blake2b
+
+
+LEAVES = [(b58check_encode(IMPLICIT_PREFIXES["tz1"][0], blake2b(b"cvr-airdrop-%d" % i)[:20]), 10**6 * (i + 1))
+          for i in range(20)]
+
+
+def close(*trees):
+    for tree in trees:
+        for level in tree.levels:
+            level.close()
+
+
+def test_proofs(tmp_path):
+    tree = MerkleTree.build(LEAVES, tmp_path)
+    assert len(tree.levels) == 6
+    for index, (address, amount) in enumerate(LEAVES):
+        assert verify(tree.root, index, address, amount, tree.proof(index))
+    assert not verify(tree.root, 0, LEAVES[0][0], LEAVES[0][1] + 1, tree.proof(0))
+    close(tree)
+
+
+def test_rebuild_smaller_tree_in_same_directory(tmp_path):
+    reused, fresh = tmp_path / "reused", tmp_path / "fresh"
+    large = MerkleTree.build(LEAVES, reused)
+    small = MerkleTree.build(LEAVES[:3], reused)
+    expected = MerkleTree.build(LEAVES[:3], fresh)
+    reopened = MerkleTree(reused)
+    assert small.root == expected.root == reopened.root
+    assert len(small.levels) == len(reopened.levels) == 3
+    assert sorted(p.name for p in reused.iterdir()) == sorted(p.name for p in fresh.iterdir())
+    for index, (address, amount) in enumerate(LEAVES[:3]):
+        assert verify(reopened.root, index, address, amount, reopened.proof(index))
+    close(large, small, expected, reopened)
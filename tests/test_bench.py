@@ -0,0 +1,29 @@
+import pytest
+
+from bench import compare, lambda_bytes, main
+from micheline import forge, parse
+
+
+def test_missing_baseline_fails(tmp_path, capsys):
+    with pytest.raises(SystemExit) as error:
+        main(["--contract", str(tmp_path / "cvr.tz"), "--baseline", str(tmp_path / "bench_baseline.json")])
+    assert error.value.code != 0
+    assert "--update-baseline" in capsys.readouterr().err
+
+
+def test_compare():
+    baseline = [{"entrypoint": "transfer", "accounts": 1000, "listSize": 10, "gas": 1000.0, "paidStorage": 100, "parameterBytes": 50}]
+    same = [dict(baseline[0], gas=1010.0)]
+    worse = [dict(baseline[0], gas=1030.0, parameterBytes=51)]
+    new = [dict(baseline[0], listSize=100, gas=9000.0)]
+    assert compare(same, baseline, 0.02) == []
+    assert len(compare(worse, baseline, 0.02)) == 2
+    assert compare(new, baseline, 0.02) == []
+
+
+def test_lambda_bytes():
+    type_ = parse("pair (big_map %lazy nat (lambda (pair bytes nat) nat)) (pair (big_map %counts nat nat) (nat %total))")
+    code = parse("{ CDR ; PUSH nat 1 ; ADD }")
+    storage = parse("Pair { Elt 0 { CDR ; PUSH nat 1 ; ADD } ; Elt 1 { CDR } } (Pair { Elt 0 7 } 3)")
+    assert lambda_bytes(type_, storage) == len(forge(code)) + len(forge(parse("{ CDR }")))
+    assert lambda_bytes(type_, parse("Pair 41 (Pair 42 3)")) == 0
@@ -0,0 +1,70 @@
+import asyncio
+
+from client import CallFailed, Client, LocalSigner, MockNode, Rpc
+from ledger import ENTRYPOINT_TYPES
+from micheline import b58check_encode, blake2b, encode, forge, secret_key
+
+
+SIGNER = LocalSigner(secret_key(blake2b(b"cvr-client-test")))
+BAD = "tz1KqTpEZ7Yob7QbPE4Hy4Wo8fHG8LhKxZSx"
+HOLDERS = [b58check_encode(b"\x06\xa1\x9f", blake2b(b"cvr-client-%d" % i)[:20]) for i in range(300)]
+
+
+async def submit(calls):
+    rejected = forge(encode(ENTRYPOINT_TYPES["lockAddress"], {"address": BAD, "until": None}))
+    node = MockNode([SIGNER.public_key], failing=lambda entrypoint, parameter: parameter == rejected)
+    await node.start()
+    rpc = Rpc(node.url)
+    client = Client(rpc, SIGNER, "KT1TezoooozzSmartPyzzSTATiCzzzwwBFA1", poll=node.block_time / 2)
+    await client.load()
+    futures = []
+    for i in range(calls):
+        futures.append(client.call("offchainSale", {"address": HOLDERS[i % len(HOLDERS)], "amount": 10**6}))
+    for i, holder in enumerate(HOLDERS[:50]):
+        futures.append(client.call("lockAddress", {"address": holder, "until": None if i % 2 else 1800000000 + i}))
+    failing = client.call("lockAddress", {"address": BAD, "until": None})
+    for _ in range(4):
+        futures.append(client.call("cvrDrop", {"addresses": HOLDERS, "amount": 10**6}))
+    futures.append(client.call("claimSale", {"amount": 10**6}))
+    futures.append(client.call("dispatchRoyalties", {"addresses": HOLDERS[:200], "amount": 10**6, "snapshotId": None}, 10**6))
+    await client.flush()
+    rpc.close()
+    await node.stop()
+    return node, client, futures, failing
+
+
+def test_calls_packed_into_groups():
+    node, client, futures, failing = asyncio.run(submit(400))
+    assert all(future.done() and not future.exception() for future in futures)
+    assert isinstance(failing.exception(), CallFailed)
+    levels = [future.result()["level"] for future in futures]
+    assert len(set(levels)) == client.groups
+    assert max(levels) - min(levels) + 1 <= 2 * client.groups
+    assert node.connections <= 4
+
+
+async def closed_connection():
+    node = MockNode([SIGNER.public_key])
+    await node.start()
+    rpc = Rpc(node.url)
+    await rpc.get("/chains/main/chain_id")
+    node.drops, requests = 1, node.requests
+    chain = await rpc.get("/chains/main/chain_id")
+    get_requests = node.requests - requests
+    node.drops, requests = 1, node.requests
+    try:
+        await rpc.post("/injection/operation?chain=main", "00")
+        post_failed = False
+    except (ConnectionError, asyncio.IncompleteReadError):
+        post_failed = True
+    post_requests = node.requests - requests
+    rpc.close()
+    await node.stop()
+    return chain, get_requests, post_failed, post_requests
+
+
+def test_only_get_retried_on_closed_connection():
+    chain, get_requests, post_failed, post_requests = asyncio.run(closed_connection())
+    assert chain == "NetXdQprcVkpaWU"
+    assert get_requests == 2
+    assert post_failed and post_requests == 1
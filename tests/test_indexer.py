@@ -0,0 +1,61 @@
+import glob
+import json
+import os
+import shutil
+
+from indexer import Indexer, Snapshot, file_blocks
+
+
+FIXTURES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fixtures", "indexer")
+
+
+def load_fixtures():
+    with open(os.path.join(FIXTURES, "expected.json")) as f:
+        expected = json.load(f)
+    return expected, file_blocks(sorted(glob.glob(os.path.join(FIXTURES, "block-*.json"))))
+
+
+def test_replay_after_lost_checkpoint(tmp_path):
+    # The blocks mint to more addresses than the table holds, transfer, lock and unlock;
+    # the last one is applied again after its checkpoint is lost.
+    expected, blocks = load_fixtures()
+    directory = str(tmp_path)
+    Snapshot(os.path.join(directory, "holders.bin"), 16).close()
+    indexer = Indexer(expected["contract"], directory)
+    for block in blocks[:-1]:
+        indexer.apply_block(block)
+    saved = indexer.checkpoint_path + ".saved"
+    shutil.copy(indexer.checkpoint_path, saved)
+    indexer.apply_block(blocks[-1])
+    indexer.close()
+    os.replace(saved, indexer.checkpoint_path)
+
+    indexer = Indexer(expected["contract"], directory)
+    replayed = [indexer.apply_block(block) for block in blocks]
+    holders = indexer.snapshot.holders()
+    total, supply = indexer.reconcile()
+    assert indexer.snapshot.capacity > 16
+    assert replayed == [False] * (len(blocks) - 1) + [True]
+    assert {address: balance for address, balance, _ in holders} == expected["balances"]
+    assert {address: lock for address, _, lock in holders if lock} == expected["locks"]
+    assert total == supply == expected["circulatingSupply"]
+    for address, until in expected["locks"].items():
+        if until is not True:
+            assert indexer.snapshot.get(address, until - 1)[1] == until
+            assert indexer.snapshot.get(address, until)[1] is False
+    indexer.close()
+
+
+def test_dump_and_load(tmp_path):
+    expected, blocks = load_fixtures()
+    indexer = Indexer(expected["contract"], str(tmp_path / "source"))
+    for block in blocks:
+        indexer.apply_block(block)
+    with open(tmp_path / "holders.packed", "wb") as f:
+        indexer.snapshot.dump(f)
+    loaded = Snapshot(str(tmp_path / "loaded.bin"), 16)
+    count, total = loaded.load((tmp_path / "holders.packed").read_bytes())
+    assert (count, total) == (len(expected["balances"]), expected["circulatingSupply"])
+    assert sorted(loaded.holders()) == sorted(indexer.snapshot.holders())
+    loaded.close()
+    indexer.close()
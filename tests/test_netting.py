@@ -0,0 +1,59 @@
+from indexer import Snapshot
+from micheline import IMPLICIT_PREFIXES, b58check_encode, blake2b, encode, forge
+from netting import PARAMETER_TYPE, check, groups, net_changes, plan, settle
+from royalties import Limits
+
+
+ADDRESSES = [b58check_encode(IMPLICIT_PREFIXES["tz1"][0], blake2b(b"cvr-netting-%d" % i)[:20]) for i in range(60)]
+TRANSFERS = [(ADDRESSES[i % 40], ADDRESSES[(7 * i + 3) % 60], 1000 + 37 * i) for i in range(400)
+             if ADDRESSES[i % 40] != ADDRESSES[(7 * i + 3) % 60]]
+NOW = 1800000000
+
+
+def test_settle():
+    changes = net_changes(TRANSFERS)
+    net = settle(changes)
+    assert net_changes(net) == changes
+    assert not {fromAddr for fromAddr, _, _ in net} & {toAddr for _, toAddr, _ in net}
+    assert len(net) <= len(changes) - 1
+
+
+def test_check():
+    changes = net_changes(TRANSFERS)
+    net = settle(changes)
+    holders = {address: (-change, False) for address, change in changes.items() if change < 0}
+    short, locked, ended, running = sorted({fromAddr for fromAddr, _, _ in net})[:4]
+    holders[short] = (holders[short][0] - 1, False)
+    holders[locked] = (holders[locked][0], True)
+    holders[ended] = (holders[ended][0], NOW - 1)
+    holders[running] = (holders[running][0], NOW + 1)
+    errors = dict(check(groups(net), holders, NOW))
+    assert errors == {short: "FA2_INSUFFICIENT_BALANCE", locked: "FA2_TX_DENIED", running: "FA2_TX_DENIED"}
+
+
+def test_plan_within_limits():
+    net = settle(net_changes(TRANSFERS))
+    limits = Limits(call_gas=3000, transfer_gas=1600, max_gas=40000, max_bytes=900, max_transfers=16)
+    calls = plan(groups(net), limits)
+    assert len(calls) > 1
+    for call in calls:
+        count = sum(len(group["txs"]) + 1 for group in call)
+        assert count <= limits.max_transfers
+        assert len(forge(encode(PARAMETER_TYPE, call))) <= limits.max_bytes
+        assert limits.call_gas + limits.transfer_gas * count <= limits.max_gas
+    assert ([(group["from_"], tx) for call in calls for group in call for tx in group["txs"]]
+            == [(group["from_"], tx) for group in groups(net) for tx in group["txs"]])
+
+
+def test_check_on_indexed_locks(tmp_path):
+    net = settle(net_changes(TRANSFERS))
+    senders = sorted({fromAddr for fromAddr, _, _ in net})
+    snapshot = Snapshot(str(tmp_path / "holders.bin"), 16)
+    for address, change in net_changes(TRANSFERS).items():
+        if change < 0:
+            snapshot.set(address, -change, False)
+    snapshot.set(senders[0], snapshot.get(senders[0])[0], NOW + 1)
+    holders = {address: snapshot.get(address) for address in senders}
+    snapshot.close()
+    assert dict(check(groups(net), holders, NOW)) == {senders[0]: "FA2_TX_DENIED"}
+    assert check(groups(net), holders, NOW + 1) == []
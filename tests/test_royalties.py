@@ -0,0 +1,95 @@
+import json
+import random
+
+import pytest
+
+import royalties
+from micheline import IMPLICIT_PREFIXES, b58check_encode, blake2b
+
+
+HOLDERS = [(b58check_encode(IMPLICIT_PREFIXES["tz1"][0], blake2b(b"cvr-royalties-%d" % i)[:20]),
+            random.Random(i).choice([1, 10**3, 10**6, 10**9, 10**12]) * random.Random(-i).randrange(1, 10**4))
+           for i in range(300)]
+SUPPLY = sum(balance for _, balance in HOLDERS) + 10**9
+
+
+@pytest.fixture(params=["numpy", "lists"])
+def arrays(request, monkeypatch):
+    if request.param == "lists":
+        monkeypatch.setattr(royalties, "numpy", None)
+    else:
+        pytest.importorskip("numpy")
+    return request.param
+
+
+def expected(holders, supply, amount):
+    mu = supply * 10**10 // amount + 1
+    return [balance * 10**10 // mu if balance * 10**10 > mu else 0 for _, balance in holders]
+
+
+def test_payouts(arrays):
+    # the last amount makes mu larger than 64 bits
+    for amount in (1, 999, 10**6, 10**9, 10**12, 10**15):
+        paid = royalties.payouts(royalties.balance_array(HOLDERS), SUPPLY, amount)
+        assert [int(mutez) for mutez in paid] == expected(HOLDERS, SUPPLY, amount)
+    paid = royalties.payouts(royalties.balance_array(HOLDERS), 10**20, 1)
+    assert [int(mutez) for mutez in paid] == expected(HOLDERS, 10**20, 1)
+
+
+def test_what_if(arrays):
+    amounts = [10**2, 10**6, 10**9, 10**12]
+    burns = {HOLDERS[0][0]: HOLDERS[0][1], HOLDERS[7][0]: 1}
+    results = royalties.what_if(HOLDERS, SUPPLY, amounts, burns)
+    assert len(results) == 2 * len(amounts)
+    after = [(address, balance - burns.get(address, 0)) for address, balance in HOLDERS]
+    supply_after = SUPPLY - sum(burns.values())
+    for result, amount in zip(results, amounts):
+        paid = expected(HOLDERS, SUPPLY, amount)
+        assert (result["paid"], result["paidHolders"]) == (sum(paid), sum(1 for mutez in paid if mutez))
+        assert result["unlistedSupply"] == 10**9
+    for result, amount in zip(results[len(amounts):], amounts):
+        paid = expected(after, supply_after, amount)
+        assert (result["paid"], result["paidHolders"]) == (sum(paid), sum(1 for mutez in paid if mutez))
+        assert result["burned"] == sum(burns.values()) and result["unlistedSupply"] == 10**9
+    with pytest.raises(ValueError):
+        royalties.what_if(HOLDERS, SUPPLY, amounts, {HOLDERS[1][0]: HOLDERS[1][1] + 1})
+
+
+def test_same_results_on_both_paths(monkeypatch):
+    pytest.importorskip("numpy")
+    amounts = [10**3, 10**7, 10**11]
+    with_numpy = royalties.what_if(HOLDERS, SUPPLY, amounts, {HOLDERS[3][0]: 5})
+    shares = royalties.shares(HOLDERS, SUPPLY, 10**7)
+    monkeypatch.setattr(royalties, "numpy", None)
+    assert royalties.what_if(HOLDERS, SUPPLY, amounts, {HOLDERS[3][0]: 5}) == with_numpy
+    assert royalties.shares(HOLDERS, SUPPLY, 10**7) == shares
+
+
+def report(tmp_path, limits):
+    results = [{"entrypoint": "dispatchRoyalties", "accounts": accounts, "listSize": size, "gas": 5000 + 900 * size + accounts / 1000}
+               for accounts in (1000, 10000) for size in (1, 10, 100)]
+    results.append({"entrypoint": "transfer", "accounts": 1000, "listSize": None, "gas": 2000})
+    path = tmp_path / "bench.json"
+    path.write_text(json.dumps({"contract": "", "results": results, "limits": limits}))
+    return str(path)
+
+
+def test_limits_from_bench(tmp_path):
+    limits = royalties.Limits.from_bench(report(tmp_path, {"1000": {"dispatchRoyalties": 700}, "10000": {"dispatchRoyalties": 650}}))
+    assert limits.transfer_gas == pytest.approx(900, rel=1e-3) and limits.call_gas == pytest.approx(5010, abs=1)
+    assert limits.max_transfers == 650
+    assert royalties.Limits.from_bench(report(tmp_path, {}), max_transfers=10).max_transfers == 10
+    with pytest.raises(ValueError):
+        royalties.Limits.from_bench(report(tmp_path, {}), "transfer")
+
+
+def test_gas_costs_required(tmp_path, capsys):
+    holders = tmp_path / "holders.csv"
+    holders.write_text("".join("%s,%d\n" % holder for holder in HOLDERS))
+    argv = ["--amount", "1000000", "--supply", str(SUPPLY), "--holders", str(holders)]
+    with pytest.raises(SystemExit):
+        royalties.main(argv + ["--bench", str(tmp_path / "missing.json")])
+    assert "bench.py" in capsys.readouterr().err
+    royalties.main(argv + ["--call-gas", "5000", "--transfer-gas", "900"])
+    calls = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert sum(call["mutez"] for call in calls) == sum(mutez for _, mutez in royalties.shares(HOLDERS, SUPPLY, 10**6))